@@ -1,42 +1,217 @@
+import asyncio
+import io
+import itertools
+import json
 import os
 import re
+import shutil
+import threading
+import time
+from typing import Optional, List, Tuple
 
 import discord
+from discord import app_commands
 from discord.ext import commands
 from ditk import logging
 from hbutils.string import plural_word
-from hbutils.system import TemporaryDirectory
 
-from maid_assistant.calc import safe_eval
-from maid_assistant.explain import tag_explain
-from maid_assistant.sites.danbooru import query_danbooru_images, download_danbooru_images
-from maid_assistant.sites.gelbooru import query_gelbooru_images, download_gelbooru_images
+from maid_assistant.utils import get_worker_pool, PoolBusyError, get_cache, list_cache_names, get_single_flight, \
+    list_single_flight_names, get_job_queue, JobQueue, JobContext, JobQuotaError, get_metrics, start_metrics_server, \
+    lazy_import, prewarm_modules
+from maid_assistant.utils.env import get_int_env, get_float_env
+from maid_assistant.utils.jobs import JOB_QUEUED, JOB_RUNNING, JOB_DONE, JOB_CANCELLED
 
 logging.try_init_root(logging.INFO)
 
+# the heavy modules (cheesechaser, waifuc, openai, numpy ...) are imported on first use or prewarmed after ready,
+# so the bot gets connected without waiting for them, see `python -m maid_assistant.bench.imports`
+_tags_module = lazy_import('maid_assistant.utils.tags')
+_danbooru_module = lazy_import('maid_assistant.sites.danbooru')
+_gelbooru_module = lazy_import('maid_assistant.sites.gelbooru')
+_image_module = lazy_import('maid_assistant.utils.image')
+_dedup_module = lazy_import('maid_assistant.utils.dedup')
+_explain_module = lazy_import('maid_assistant.explain')
+_calc_module = lazy_import('maid_assistant.calc')
+_wiki_module = lazy_import('maid_assistant.utils.wiki')
+_packcache_module = lazy_import('maid_assistant.utils.packcache')
+_danbooru_utils_module = lazy_import('maid_assistant.utils.danbooru')
+
+# modules needed by the commands, keyed by the first part of the command names, e.g. `explain_batch_cn`
+_COMMAND_MODULES = {
+    'calc': [_calc_module],
+    'plot': [_calc_module],
+    'danbooru': [_tags_module, _danbooru_module, _image_module],
+    'gelbooru': [_tags_module, _gelbooru_module, _image_module],
+    'search': [_tags_module, _danbooru_module, _gelbooru_module, _dedup_module, _image_module],
+    'explain': [_tags_module, _explain_module],
+    'cache': [_packcache_module],
+    'wikiindex': [_wiki_module, _tags_module],
+}
+
 intents = discord.Intents.default()
 intents.message_content = True
 intents.messages = True
 
-bot = commands.Bot(command_prefix='maid ', intents=intents)
+
+def _get_shard_ids() -> Optional[List[int]]:
+    # e.g. MAID_SHARD_IDS=0,2 with MAID_SHARD_COUNT=4, given by `python -m maid_assistant.cluster`
+    text = os.environ.get('MAID_SHARD_IDS')
+    return [int(item) for item in text.split(',') if item.strip()] if text else None
+
+
+if get_int_env('MAID_SHARD_COUNT', None):
+    bot = commands.AutoShardedBot(command_prefix='maid ', intents=intents,
+                                  shard_count=get_int_env('MAID_SHARD_COUNT', None), shard_ids=_get_shard_ids())
+else:
+    bot = commands.Bot(command_prefix='maid ', intents=intents)
+
+
+def _is_served_here(guild_id: Optional[int]) -> bool:
+    if not bot.shard_count:
+        return True
+    shard_id = (guild_id >> 22) % bot.shard_count if guild_id else 0
+    return shard_id in (bot.shard_ids or range(bot.shard_count))
+
+
+async def notify_busy(ctx, reply_message: Optional[discord.Message]):
+    busy_text = 'Maid is too busy now, please try again later.'
+    if reply_message is not None:
+        await reply_message.edit(content=busy_text)
+    else:
+        await ctx.reply(busy_text)
+
+
+async def run_in_pool(ctx, reply_message: Optional[discord.Message], pool_name: str, fn, *args,
+                      busy_notice: bool = True, **kwargs):
+    pool = get_worker_pool(pool_name)
+
+    async def _on_queued(position: int):
+        busy_text = f'Maid is busy, you are #{position} in queue, please wait a moment ...'
+        if reply_message is not None:
+            await reply_message.edit(content=f'{reply_message.content}\n{busy_text}')
+        else:
+            await ctx.reply(busy_text)
+
+    try:
+        return await pool.run(fn, *args, on_queued=_on_queued, **kwargs)
+    except PoolBusyError:
+        if busy_notice:
+            await notify_busy(ctx, reply_message)
+        raise
+
+
+async def run_single_flight(ctx, reply_message: Optional[discord.Message], name: str, key, fn):
+    # the merged requests get the busy error of the shared call too, so every one of them is notified here
+    try:
+        return await get_single_flight(name).do(key, fn)
+    except PoolBusyError:
+        await notify_busy(ctx, reply_message)
+        raise
+
+
+def _tags_key(tags) -> tuple:
+    return tuple(sorted({tag.lower() for tag in tags}))
+
+
+def _get_tag_resolver():
+    return _tags_module.get_tag_resolver()
+
+
+async def resolve_query_tags(ctx, tags: List[str], strict: bool = True) -> Tuple[List[str], str]:
+    resolver = await asyncio.to_thread(_get_tag_resolver)
+    if not len(resolver):
+        return tags, ''
+
+    # only the close enough matches are corrected, the index may be older than the sites,
+    # so the unknown tags are still searched as they are, with hints
+    resolved_tags, corrections, unknown = resolver.resolve_query(tags, fuzzy=strict)
+    note = ''.join(f'\nTag `{tag}` is corrected to `{new_tag}`.' for tag, new_tag in corrections.items())
+    if strict:
+        note += ''.join(f'\nTag `{tag}` is unknown, did you mean {", ".join(f"`{s}`" for s in suggestions)}?'
+                        for tag, suggestions in unknown.items() if suggestions)
+    return resolved_tags, note
+
+
+async def reply_not_found(reply_message: discord.Message, tags: List[str], note: str):
+    # the hints of unknown tags are shown again, for they are the likely reason
+    await reply_message.edit(content=f'No image found with tags {", ".join([f"`{tag}`" for tag in tags])}.{note}')
+
+
+def _make_tag_autocomplete(multiple: bool):
+    async def _autocomplete(interaction: discord.Interaction, current: str) -> List[app_commands.Choice[str]]:
+        resolver = await asyncio.to_thread(_get_tag_resolver)
+        # only the last tag is completed when multiple tags are given
+        head, last = re.fullmatch(r'(.*?\s*)(\S*)', current).groups() if multiple else ('', current.strip())
+        prefix, name = re.fullmatch(r'([-~]?)(.*)', last).groups()
+        if not name:
+            return []
+
+        choices = []
+        for tag, count in resolver.complete(name, limit=25):
+            value = f'{head}{prefix}{tag}'
+            if len(value) <= 100:
+                choices.append(app_commands.Choice(name=f'{value} ({count})'[-100:], value=value))
+        return choices
+
+    return _autocomplete
+
+
+_tag_autocomplete = _make_tag_autocomplete(multiple=False)
+_tags_autocomplete = _make_tag_autocomplete(multiple=True)
+
+_DEFAULT_FILESIZE_LIMIT = 10 * 1024 ** 2
+
+
+def _make_image_files(ctx, result):
+    max_total_size = ctx.guild.filesize_limit if ctx.guild else _DEFAULT_FILESIZE_LIMIT
+    images = _image_module.fit_images_to_size([(f'{id_}.webp', data) for id_, data in result], max_total_size)
+    return [discord.File(io.BytesIO(data), filename=filename) for filename, data in images]
+
+
+def _format_calc_result(result) -> str:
+    if isinstance(result, _calc_module.RangeResult):
+        return f"Result of `{result.expr}`:\n```\n{result}\n```"
+    else:
+        return f"Result: {result}"
 
 
 @bot.command(name='calc',
-             help="Calculate python-based math expression.")
+             help="Calculate python-based math expression, e.g. `maid calc max(2 ** 10, comb(10, 3)) > pi`, "
+                  "or over a range, e.g. `maid calc sin(x) * x for x in 0..10 step 0.01`.")
 async def calc_command(ctx, *, expression: str):
     logging.info(f'Calculate expression {expression!r} ...')
     try:
-        result = safe_eval(expression)
-        ret_text = f"Result: {result}"
+        result = await run_in_pool(ctx, None, 'calc', _calc_module.isolated_eval, expression)
+        ret_text = _format_calc_result(result)
+    except PoolBusyError:
+        raise
     except Exception as e:
         ret_text = f'Calculation Error: {e}'
-    await ctx.message.reply(ret_text)
+    await ctx.reply(ret_text)
 
 
-@bot.command(name='danbooru',
-             help='Search danbooru images')
+@bot.command(name='plot',
+             help="Plot python-based math expression over a range, e.g. `maid plot sin(x) * x for x in 0..10`.")
+async def plot_command(ctx, *, expression: str):
+    logging.info(f'Plot expression {expression!r} ...')
+    try:
+        result = await run_in_pool(ctx, None, 'calc', _calc_module.isolated_eval, expression, chart=True)
+    except PoolBusyError:
+        raise
+    except Exception as e:
+        await ctx.reply(f'Calculation Error: {e}')
+        return
+
+    files = [discord.File(io.BytesIO(result.chart), filename='plot.png')] if result.chart else []
+    with get_metrics().timer('maid_discord_upload_seconds', command=ctx.command.name):
+        await ctx.reply(_format_calc_result(result), files=files)
+
+
+@bot.hybrid_command(name='danbooru',
+                    help='Search danbooru images')
+@app_commands.autocomplete(tags_text=_tags_autocomplete)
 async def danbooru_command(ctx, *, tags_text: str):
-    tags = list(filter(bool, re.split(r'\s+', tags_text)))
+    tags, note = await resolve_query_tags(ctx, list(filter(bool, re.split(r'\s+', tags_text))))
     if hasattr(ctx.channel, 'is_nsfw'):
         is_nsfw = ctx.channel.is_nsfw()
         level_name = f'{"NSFW" if ctx.channel.is_nsfw() else "SFW"} '
@@ -44,59 +219,180 @@ async def danbooru_command(ctx, *, tags_text: str):
     else:
         level_name = ''
         allowed_ratings = {'g', 's', 'q', 'e'}
-    reply_message = await ctx.message.reply(
+    reply_message = await ctx.reply(
         f'Cute maid is searching {level_name}images '
-        f'with tags {", ".join([f"`{tag}`" for tag in tags])} from danbooru ...')
-    with TemporaryDirectory() as td:
-        result = query_danbooru_images(tags, count=10, allowed_ratings=allowed_ratings)
-        embed = discord.Embed(
-            title="Danbooru Images",
-            description=f"This is the search result of tags: {tags!r}.\n"
-                        f"{plural_word(len(result), 'image')} found in total.\n"
-                        f"Powered by [deepghs/danbooru2023-webp-4Mpixel_index](https://huggingface.co/datasets/deepghs/danbooru2023-webp-4Mpixel_index) "
-                        f"and [deepghs/cheesechaser](https://github.com/deepghs/cheesechaser).",
-            color=0x00ff00
-        )
-        files = []
-        for id_, image in result:
-            dst_file = os.path.join(td, f'{id_}.webp')
-            image.save(dst_file, quality=90)
-            files.append(discord.File(dst_file, filename=os.path.basename(dst_file)))
+        f'with tags {", ".join([f"`{tag}`" for tag in tags])} from danbooru ...{note}')
+
+    async def _search():
+        stats = _danbooru_module.QueryStats()
+        images = await run_in_pool(ctx, reply_message, 'search', _danbooru_module.query_danbooru_images,
+                                   tags, count=10, allowed_ratings=allowed_ratings, stats=stats, raw=True,
+                                   busy_notice=False)
+        return images, stats
+
+    result, query_stats = await run_single_flight(
+        ctx, reply_message, 'danbooru',
+        (_tags_key(tags), tuple(sorted(allowed_ratings))),
+        _search,
+    )
+    if not result:
+        await reply_not_found(reply_message, tags, note)
+        return
+    files = await asyncio.to_thread(_make_image_files, ctx, result)
+    embed = discord.Embed(
+        title="Danbooru Images",
+        description=f"This is the search result of tags: {tags!r}.\n"
+                    f"{plural_word(len(files), 'image')} found in total.\n"
+                    f"Powered by [deepghs/danbooru2023-webp-4Mpixel_index](https://huggingface.co/datasets/deepghs/danbooru2023-webp-4Mpixel_index) "
+                    f"and [deepghs/cheesechaser](https://github.com/deepghs/cheesechaser).",
+        color=0x00ff00
+    )
+    embed.set_footer(text=f'{plural_word(query_stats.posts, "post")} scanned '
+                          f'in {plural_word(query_stats.pages, "page")}.')
 
-        await reply_message.delete()
-        await ctx.message.reply(embed=embed, files=files)
+    await reply_message.delete()
+    with get_metrics().timer('maid_discord_upload_seconds', command=ctx.command.name):
+        await ctx.reply(embed=embed, files=files)
+
+
+_DOWNLOAD_SITES = {
+    'danbooru': (
+        _danbooru_module, 'download_danbooru_images', 'Danbooru Image Pack', 0x00ff00,
+        "Powered by [deepghs/danbooru2023-webp-4Mpixel_index](https://huggingface.co/datasets/deepghs/danbooru2023-webp-4Mpixel_index) "
+        "and [deepghs/cheesechaser](https://github.com/deepghs/cheesechaser).",
+    ),
+    'gelbooru': (
+        _gelbooru_module, 'download_gelbooru_images', 'Gelbooru Image Pack', 0x0000ff,
+        "Powered by [deepghs/gelbooru-webp-4Mpixel](https://huggingface.co/datasets/deepghs/gelbooru-webp-4Mpixel) "
+        "and [deepghs/cheesechaser](https://github.com/deepghs/cheesechaser).",
+    ),
+}
+
+
+def _run_download_job(job: JobContext):
+    module, func_name, _, _, _ = _DOWNLOAD_SITES[job.payload['site']]
+    download_func = getattr(module, func_name)
+    job.report(images=0, size=0)
+    with download_func(job.payload['tags'], max_total_size=job.payload['max_total_size'],
+                       on_progress=lambda images, size: job.report(images=images, size=size)) \
+            as (filenames, package_file):
+        # the cached pack may be evicted before it is sent, so the job keeps its own link or copy
+        output_file = os.path.join(job.output_dir, os.path.basename(package_file))
+        try:
+            os.link(package_file, output_file)
+        except OSError:
+            shutil.copyfile(package_file, output_file)
+    return {'images': len(filenames), 'package_file': output_file}
+
+
+def get_download_queue() -> JobQueue:
+    queue = get_job_queue('download')
+    queue.register('download', _run_download_job)
+    return queue
+
+
+def _get_job_progress_interval() -> float:
+    return get_float_env('MAID_JOB_PROGRESS_INTERVAL', 2.0)
+
+
+def _format_download_job(job: dict, position: int) -> str:
+    tags, site = job['payload']['tags'], job['payload']['site']
+    lines = [f'Cute maid is downloading and packing images '
+             f'with tags {", ".join([f"`{tag}`" for tag in tags])} from {site} (job #{job["id"]}) ...']
+    if job['status'] == JOB_QUEUED:
+        lines.append(f'Waiting in queue, you are #{position}. Use `maid cancel {job["id"]}` to cancel it.')
+    else:
+        images, size = job['progress'].get('images', 0), job['progress'].get('size', 0)
+        lines.append(f'{plural_word(images, "image")} packed, {size / 1024 ** 2:.1f} MiB in total.')
+    return '\n'.join(lines)
+
+
+async def watch_download_job(channel, job_id: int):
+    queue = get_download_queue()
+    job = await asyncio.to_thread(queue.get, job_id)
+    progress_message = channel.get_partial_message(job['meta']['progress_message_id'])
+    command_message = channel.get_partial_message(job['meta']['command_message_id'])
+
+    last_text = None
+    while job['status'] in {JOB_QUEUED, JOB_RUNNING}:
+        position = await asyncio.to_thread(queue.position, job_id) if job['status'] == JOB_QUEUED else 0
+        text = _format_download_job(job, position)
+        if text != last_text:
+            try:
+                await progress_message.edit(content=text)
+            except discord.HTTPException as err:
+                logging.warning(f'Unable to update progress of job #{job_id} - {err!r}')
+            last_text = text
+        await asyncio.sleep(_get_job_progress_interval())
+        job = await asyncio.to_thread(queue.get, job_id)
+
+    # only marked as delivered when the result is sent, so when cancelled on shutdown or failed to send,
+    # the job is watched again after restart
+    try:
+        if job['status'] == JOB_DONE:
+            _, _, title, color, powered_by = _DOWNLOAD_SITES[job['payload']['site']]
+            package_file = job['result']['package_file']
+            embed = discord.Embed(
+                title=title,
+                description=f"This is the image package of tags: {job['payload']['tags']!r}.\n"
+                            f"{plural_word(job['result']['images'], 'image')} inside.\n"
+                            f"{powered_by}",
+                color=color,
+            )
+            with get_metrics().timer('maid_discord_upload_seconds', command=f'{job["payload"]["site"]}_dl'):
+                await command_message.reply(
+                    embed=embed,
+                    files=[
+                        discord.File(package_file, filename=os.path.basename(package_file))
+                    ]
+                )
+            try:
+                await progress_message.delete()
+            except discord.HTTPException as err:
+                logging.warning(f'Unable to delete progress message of job #{job_id} - {err!r}')
+        elif job['status'] == JOB_CANCELLED:
+            await progress_message.edit(content=f'Download job #{job_id} cancelled.')
+        else:
+            await progress_message.edit(content=f'Download job #{job_id} failed - {job["error"]}')
+    except (discord.NotFound, discord.Forbidden) as err:
+        # the channel or messages are gone, it will never be delivered
+        logging.warning(f'Unable to deliver job #{job_id} - {err!r}')
+    await asyncio.to_thread(queue.mark_delivered, job_id)
+
+
+async def download_command_raw(ctx, *, tags_text: str, site: str, strict: bool = True):
+    tags, note = await resolve_query_tags(ctx, list(filter(bool, re.split(r'\s+', tags_text))), strict=strict)
+    reply_message = await ctx.reply(
+        f'Cute maid is downloading and packing images '
+        f'with tags {", ".join([f"`{tag}`" for tag in tags])} from {site} ...{note}')
+
+    queue = get_download_queue()
+    try:
+        job_id = await asyncio.to_thread(
+            queue.submit, 'download',
+            payload={'site': site, 'tags': tags, 'max_total_size': 25 * 1024 ** 2},
+            user_id=ctx.author.id,
+            guild_id=ctx.guild.id if ctx.guild else None,
+            meta={'channel_id': ctx.channel.id, 'command_message_id': ctx.message.id,
+                  'progress_message_id': reply_message.id},
+        )
+    except JobQuotaError as err:
+        await reply_message.edit(content=f'Maid is still packing your images, please wait - {err}')
+        return
+    await watch_download_job(ctx.channel, job_id)
 
 
 @bot.command(name='danbooru_dl',
              help='Batch download danbooru images')
 async def danbooru_dl_command(ctx, *, tags_text: str):
-    tags = list(filter(bool, re.split(r'\s+', tags_text)))
-    reply_message = await ctx.message.reply(
-        f'Cute maid is downloading and packing images '
-        f'with tags {", ".join([f"`{tag}`" for tag in tags])} from danbooru ...')
-    with download_danbooru_images(tags, max_total_size=25 * 1024 ** 2) as (file_count, package_file):
-        embed = discord.Embed(
-            title="Danbooru Image Pack",
-            description=f"This is the image package of tags: {tags!r}.\n"
-                        f"{plural_word(len(file_count), 'image')} inside.\n"
-                        f"Powered by [deepghs/danbooru2023-webp-4Mpixel_index](https://huggingface.co/datasets/deepghs/danbooru2023-webp-4Mpixel_index) "
-                        f"and [deepghs/cheesechaser](https://github.com/deepghs/cheesechaser).",
-            color=0x00ff00,
-        )
-
-        await reply_message.delete()
-        await ctx.message.reply(
-            embed=embed,
-            files=[
-                discord.File(package_file, filename=os.path.basename(package_file))
-            ]
-        )
+    await download_command_raw(ctx, tags_text=tags_text, site='danbooru')
 
 
 @bot.command(name='gelbooru',
              help='Search gelbooru images')
 async def gelbooru_command(ctx, *, tags_text: str):
-    tags = list(filter(bool, re.split(r'\s+', tags_text)))
+    # gelbooru has its own tags, so only the exactly known aliases are corrected
+    tags, note = await resolve_query_tags(ctx, list(filter(bool, re.split(r'\s+', tags_text))), strict=False)
     if hasattr(ctx.channel, 'is_nsfw'):
         is_nsfw = ctx.channel.is_nsfw()
         level_name = f'{"NSFW" if ctx.channel.is_nsfw() else "SFW"} '
@@ -104,95 +400,548 @@ async def gelbooru_command(ctx, *, tags_text: str):
     else:
         level_name = ''
         allowed_ratings = {'general', 'sensitive', 'questionable', 'explicit'}
-    reply_message = await ctx.message.reply(
+    reply_message = await ctx.reply(
         f'Cute maid is searching {level_name}images '
-        f'with tags {", ".join([f"`{tag}`" for tag in tags])} from gelbooru ...')
-    with TemporaryDirectory() as td:
-        result = query_gelbooru_images(tags, count=10, allowed_ratings=allowed_ratings)
-        embed = discord.Embed(
-            title="Gelbooru Images",
-            description=f"This is the search result of tags: {tags!r}.\n"
-                        f"{plural_word(len(result), 'image')} found in total.\n"
-                        f"Powered by [deepghs/gelbooru-webp-4Mpixel](https://huggingface.co/datasets/deepghs/gelbooru-webp-4Mpixel) "
-                        f"and [deepghs/cheesechaser](https://github.com/deepghs/cheesechaser).",
-            color=0x0000ff
-        )
-        files = []
-        for id_, image in result:
-            dst_file = os.path.join(td, f'{id_}.webp')
-            image.save(dst_file, quality=90)
-            files.append(discord.File(dst_file, filename=os.path.basename(dst_file)))
+        f'with tags {", ".join([f"`{tag}`" for tag in tags])} from gelbooru ...{note}')
+    result = await run_single_flight(
+        ctx, reply_message, 'gelbooru',
+        (_tags_key(tags), tuple(sorted(allowed_ratings))),
+        lambda: run_in_pool(ctx, reply_message, 'search', _gelbooru_module.query_gelbooru_images,
+                            tags, count=10, allowed_ratings=allowed_ratings, raw=True, busy_notice=False),
+    )
+    if not result:
+        await reply_not_found(reply_message, tags, note)
+        return
+    files = await asyncio.to_thread(_make_image_files, ctx, result)
+    embed = discord.Embed(
+        title="Gelbooru Images",
+        description=f"This is the search result of tags: {tags!r}.\n"
+                    f"{plural_word(len(files), 'image')} found in total.\n"
+                    f"Powered by [deepghs/gelbooru-webp-4Mpixel](https://huggingface.co/datasets/deepghs/gelbooru-webp-4Mpixel) "
+                    f"and [deepghs/cheesechaser](https://github.com/deepghs/cheesechaser).",
+        color=0x0000ff
+    )
 
-        await reply_message.delete()
-        await ctx.message.reply(embed=embed, files=files)
+    await reply_message.delete()
+    with get_metrics().timer('maid_discord_upload_seconds', command=ctx.command.name):
+        await ctx.reply(embed=embed, files=files)
 
 
 @bot.command(name='gelbooru_dl',
              help='Batch download gelbooru images')
 async def gelbooru_dl_command(ctx, *, tags_text: str):
-    tags = list(filter(bool, re.split(r'\s+', tags_text)))
-    reply_message = await ctx.message.reply(
-        f'Cute maid is downloading and packing images '
-        f'with tags {", ".join([f"`{tag}`" for tag in tags])} from gelbooru ...')
-    with download_gelbooru_images(tags, max_total_size=25 * 1024 ** 2) as (file_count, package_file):
-        embed = discord.Embed(
-            title="Danbooru Image Pack",
-            description=f"This is the image package of tags: {tags!r}.\n"
-                        f"{plural_word(len(file_count), 'image')} inside.\n"
-                        f"Powered by [deepghs/gelbooru-webp-4Mpixel](https://huggingface.co/datasets/deepghs/gelbooru-webp-4Mpixel) "
-                        f"and [deepghs/cheesechaser](https://github.com/deepghs/cheesechaser).",
-            color=0x0000ff,
-        )
+    # gelbooru has its own tags, so only the exactly known aliases are corrected
+    await download_command_raw(ctx, tags_text=tags_text, site='gelbooru', strict=False)
 
-        await reply_message.delete()
-        await ctx.message.reply(
-            embed=embed,
-            files=[
-                discord.File(package_file, filename=os.path.basename(package_file))
-            ]
-        )
+
+_GELBOORU_RATINGS = {'g': 'general', 's': 'sensitive', 'q': 'questionable', 'e': 'explicit'}
+
+
+def _get_search_deadline(site: str) -> float:
+    return get_float_env(f'MAID_SEARCH_{site.upper()}_DEADLINE', 30.0)
+
+
+@bot.hybrid_command(name='search',
+                    help='Search danbooru and gelbooru images together')
+@app_commands.autocomplete(tags_text=_tags_autocomplete)
+async def search_command(ctx, *, tags_text: str):
+    tags, note = await resolve_query_tags(ctx, list(filter(bool, re.split(r'\s+', tags_text))))
+    if hasattr(ctx.channel, 'is_nsfw'):
+        is_nsfw = ctx.channel.is_nsfw()
+        level_name = f'{"NSFW" if ctx.channel.is_nsfw() else "SFW"} '
+        allowed_ratings = {'g', 's'} if not is_nsfw else {'q', 'e'}
+    else:
+        level_name = ''
+        allowed_ratings = {'g', 's', 'q', 'e'}
+    reply_text = f'Cute maid is searching {level_name}images ' \
+                 f'with tags {", ".join([f"`{tag}`" for tag in tags])} from danbooru and gelbooru ...{note}'
+    reply_message = await ctx.reply(reply_text)
+
+    site_queries = {
+        'danbooru': (_danbooru_module.query_danbooru_images, allowed_ratings),
+        'gelbooru': (_gelbooru_module.query_gelbooru_images, {_GELBOORU_RATINGS[rating] for rating in allowed_ratings}),
+    }
+    # share the hash index, so that the same artwork posted on both sites only takes one place
+    tasks, hash_index = {}, _dedup_module.ImageHashIndex()
+    for site, (query_func, site_ratings) in site_queries.items():
+        task = asyncio.ensure_future(run_in_pool(
+            ctx, reply_message, 'search', query_func, tags,
+            count=10, allowed_ratings=site_ratings, raw=True, timeout=_get_search_deadline(site), dedup=hash_index,
+        ))
+        tasks[task] = site
+
+    # the sites give up by themselves at their deadlines, this is only for the time waiting in queue
+    loop = asyncio.get_running_loop()
+    hard_deadline = loop.time() + max(_get_search_deadline(site) for site in site_queries) + 10.0
+    site_results, pending = {}, set(tasks)
+    while pending:
+        done, pending = await asyncio.wait(pending, timeout=max(hard_deadline - loop.time(), 0),
+                                           return_when=asyncio.FIRST_COMPLETED)
+        if not done:
+            break
+        for task in done:
+            site = tasks[task]
+            if task.exception() is not None:
+                logging.error(f'Error occurred when searching {site} - {task.exception()!r}')
+                site_results[site] = []
+            else:
+                site_results[site] = task.result()
+            if pending:
+                reply_text = f'{reply_text}\n{plural_word(len(site_results[site]), "image")} found from {site}.'
+                await reply_message.edit(content=reply_text)
+    for task in pending:
+        logging.warning(f'Searching {tasks[task]} timed out.')
+        task.cancel()
+
+    # interleave the results, so that every site gets its place
+    result, site_lists = [], [
+        [(f'{site}_{id_}', data) for id_, data in site_results[site]]
+        for site in site_queries if site in site_results
+    ]
+    for items in itertools.zip_longest(*site_lists):
+        result.extend(item for item in items if item is not None)
+    result = result[:10]
+    if not result and len(site_results) == len(site_queries):
+        await reply_not_found(reply_message, tags, note)
+        return
+
+    files = await asyncio.to_thread(_make_image_files, ctx, result)
+    site_lines = [
+        f'{site}: {plural_word(len(site_results[site]), "image")}' if site in site_results else f'{site}: timed out'
+        for site in site_queries
+    ]
+    embed = discord.Embed(
+        title="Danbooru & Gelbooru Images",
+        description=f"This is the search result of tags: {tags!r}.\n"
+                    f"{plural_word(len(files), 'image')} found in total ({', '.join(site_lines)}).\n"
+                    f"Powered by [deepghs/danbooru2023-webp-4Mpixel_index](https://huggingface.co/datasets/deepghs/danbooru2023-webp-4Mpixel_index), "
+                    f"[deepghs/gelbooru-webp-4Mpixel](https://huggingface.co/datasets/deepghs/gelbooru-webp-4Mpixel) "
+                    f"and [deepghs/cheesechaser](https://github.com/deepghs/cheesechaser).",
+        color=0x00ffff
+    )
+
+    await reply_message.delete()
+    with get_metrics().timer('maid_discord_upload_seconds', command=ctx.command.name):
+        await ctx.reply(embed=embed, files=files)
+
+
+_DISCORD_MESSAGE_LIMIT = 2000
+
+
+def _split_message(text: str, limit: int = _DISCORD_MESSAGE_LIMIT):
+    # split at line breaks when possible, the pages before the last one stay stable while the text grows
+    pages = []
+    while len(text) > limit:
+        cut = text.rfind('\n', 0, limit)
+        if cut <= 0:
+            cut = limit
+        pages.append(text[:cut])
+        text = text[cut:].lstrip('\n')
+    pages.append(text)
+    return pages
+
+
+def _is_explain_stream_enabled() -> bool:
+    return os.environ.get('MAID_EXPLAIN_STREAM', '1').lower() not in {'0', 'false', 'no', 'off'}
+
+
+async def stream_to_messages(ctx, reply_message: discord.Message, future: asyncio.Future, buffer: list):
+    # discord allows about 5 edits per 5 seconds in one channel
+    interval = get_float_env('MAID_EXPLAIN_EDIT_INTERVAL', 1.2)
+    messages, contents = [reply_message], [reply_message.content]
+    while True:
+        finished = future.done()
+        text = ''.join(buffer).strip()
+        if text:
+            for i, page in enumerate(_split_message(text)):
+                if i < len(messages):
+                    if contents[i] != page:
+                        await messages[i].edit(content=page)
+                        contents[i] = page
+                else:
+                    messages.append(await ctx.reply(page))
+                    contents.append(page)
+
+        if finished:
+            break
+        # poll faster before the first text arrives, so it can be shown as early as possible
+        await asyncio.wait({future}, timeout=interval if text else min(interval, 0.2))
+
+    return future.result()
 
 
 async def explain_command_raw(ctx, *, tag: str, lang: str):
-    reply_message = await ctx.message.reply(f'Cute maid is trying to understand '
-                                            f'and explain tag `{tag}` in {lang} ...')
+    tags, note = await resolve_query_tags(ctx, [tag.strip()])
+    tag, = tags
+    reply_message = await ctx.reply(f'Cute maid is trying to understand '
+                                    f'and explain tag `{tag}` in {lang} ...{note}')
+    streamed = False
+
+    async def _explain():
+        nonlocal streamed
+        if not _is_explain_stream_enabled():
+            return await run_in_pool(ctx, reply_message, 'explain', _explain_module.tag_explain, tag, lang,
+                                     use_other_names=True, busy_notice=False)
+
+        buffer = []
+
+        def _consume():
+            for delta in _explain_module.tag_explain_stream(tag, lang, use_other_names=True):
+                buffer.append(delta)
+            return ''.join(buffer).strip()
+
+        future = asyncio.ensure_future(run_in_pool(ctx, reply_message, 'explain', _consume, busy_notice=False))
+        streamed = True
+        return await stream_to_messages(ctx, reply_message, future, buffer)
+
     try:
-        reply_text = tag_explain(tag, lang, use_other_names=True)
+        reply_text = await run_single_flight(ctx, reply_message, 'explain', (tag.strip().lower(), lang), _explain)
+    except PoolBusyError:
+        raise
+    except Exception as err:
+        streamed = False
+        reply_text = f'Explain error - {err!r}'
+
+    # the streamed answer is already shown, only the merged requests and errors need a new reply
+    if not streamed:
+        await reply_message.delete()
+        for page in _split_message(reply_text):
+            await ctx.reply(page)
+
+
+_MAX_BATCH_EXPLAIN_TAGS = 30
+
+
+async def explain_batch_command_raw(ctx, *, tags_text: str, lang: str):
+    tags = list(dict.fromkeys(filter(bool, re.split(r'\s+', tags_text))))
+    if len(tags) > _MAX_BATCH_EXPLAIN_TAGS:
+        await ctx.reply(f'Too many tags, at most {_MAX_BATCH_EXPLAIN_TAGS} tags can be explained at once.')
+        return
+    tags, note = await resolve_query_tags(ctx, tags)
+    tags = list(dict.fromkeys(tags))
+
+    reply_message = await ctx.reply(f'Cute maid is trying to understand '
+                                    f'and explain {plural_word(len(tags), "tag")} in {lang} ...{note}')
+    try:
+        answers = await run_single_flight(
+            ctx, reply_message, 'explain_batch',
+            (tuple(sorted(tags)), lang),
+            lambda: run_in_pool(ctx, reply_message, 'explain', _explain_module.tag_explain_batch, tags, lang,
+                                use_other_names=True, busy_notice=False),
+        )
+        reply_text = '\n\n'.join(f'**`{tag}`**\n{answers[tag]}' for tag in tags)
+    except PoolBusyError:
+        raise
     except Exception as err:
         reply_text = f'Explain error - {err!r}'
 
     await reply_message.delete()
-    await ctx.message.reply(reply_text)
+    for page in _split_message(reply_text):
+        await ctx.reply(page)
 
 
-@bot.command(name='explain',
-             help='Explain tags in english')
+@bot.hybrid_command(name='explain',
+                    help='Explain tags in english')
+@app_commands.autocomplete(tag=_tag_autocomplete)
 async def explain_en_command(ctx, *, tag: str):
     await explain_command_raw(ctx, tag=tag, lang='english')
 
 
-@bot.command(name='explain_cn',
-             help='Explain tags in chinese')
+@bot.hybrid_command(name='explain_cn',
+                    help='Explain tags in chinese')
+@app_commands.autocomplete(tag=_tag_autocomplete)
 async def explain_cn_command(ctx, *, tag: str):
     await explain_command_raw(ctx, tag=tag, lang='simplified chinese')
 
 
-@bot.command(name='explain_jp',
-             help='Explain tags in japanese')
+@bot.hybrid_command(name='explain_jp',
+                    help='Explain tags in japanese')
+@app_commands.autocomplete(tag=_tag_autocomplete)
 async def explain_jp_command(ctx, *, tag: str):
     await explain_command_raw(ctx, tag=tag, lang='japanese')
 
 
-@bot.command(name='explain_kr',
-             help='Explain tags in korean')
+@bot.hybrid_command(name='explain_kr',
+                    help='Explain tags in korean')
+@app_commands.autocomplete(tag=_tag_autocomplete)
 async def explain_kr_command(ctx, *, tag: str):
     await explain_command_raw(ctx, tag=tag, lang='korean')
 
 
+@bot.hybrid_command(name='explain_batch',
+                    help='Explain multiple tags in english')
+@app_commands.autocomplete(tags_text=_tags_autocomplete)
+async def explain_batch_en_command(ctx, *, tags_text: str):
+    await explain_batch_command_raw(ctx, tags_text=tags_text, lang='english')
+
+
+@bot.hybrid_command(name='explain_batch_cn',
+                    help='Explain multiple tags in chinese')
+@app_commands.autocomplete(tags_text=_tags_autocomplete)
+async def explain_batch_cn_command(ctx, *, tags_text: str):
+    await explain_batch_command_raw(ctx, tags_text=tags_text, lang='simplified chinese')
+
+
+@bot.hybrid_command(name='explain_batch_jp',
+                    help='Explain multiple tags in japanese')
+@app_commands.autocomplete(tags_text=_tags_autocomplete)
+async def explain_batch_jp_command(ctx, *, tags_text: str):
+    await explain_batch_command_raw(ctx, tags_text=tags_text, lang='japanese')
+
+
+@bot.hybrid_command(name='explain_batch_kr',
+                    help='Explain multiple tags in korean')
+@app_commands.autocomplete(tags_text=_tags_autocomplete)
+async def explain_batch_kr_command(ctx, *, tags_text: str):
+    await explain_batch_command_raw(ctx, tags_text=tags_text, lang='korean')
+
+
+@bot.command(name='cache',
+             help='Inspect or purge the caches (owner only). '
+                  'Usage: `maid cache stats`, `maid cache list <name> [prefix]`, `maid cache purge <name> [prefix]`')
+@commands.is_owner()
+async def cache_command(ctx, action: str = 'stats', name: Optional[str] = None, prefix: Optional[str] = None):
+    names = [name] if name else list_cache_names()
+    if name and name not in list_cache_names():
+        await ctx.reply(f'Unknown cache {name!r}, available caches: {", ".join(list_cache_names())}.')
+        return
+
+    def _run_action() -> List[str]:
+        lines = []
+        if action == 'stats':
+            for cache_name in names:
+                stats = get_cache(cache_name).stats()
+                lines.append(f'**{cache_name}**: ' + ', '.join(f'{key}: {value}' for key, value in stats.items()))
+            if not name:
+                stats = _packcache_module.get_pack_cache().stats()
+                lines.append('**packs**: ' + ', '.join(f'{key}: {value}' for key, value in stats.items()))
+        elif action == 'list':
+            for cache_name in names:
+                lines.append(f'**{cache_name}**:')
+                for key, created_at, size in get_cache(cache_name).list_items(prefix=prefix):
+                    lines.append(f'- `{key}` ({size} bytes, created <t:{int(created_at)}:R>)')
+        elif action == 'purge':
+            for cache_name in names:
+                count = get_cache(cache_name).purge(prefix=prefix)
+                lines.append(f'**{cache_name}**: {plural_word(count, "item")} purged.')
+            if not name and not prefix:
+                lines.append(f'**packs**: {plural_word(_packcache_module.get_pack_cache().purge(), "pack")} purged.')
+        else:
+            lines.append(f'Unknown cache action {action!r}.')
+        return lines
+
+    # sqlite and the pack files may take a while, keep them out of the event loop
+    lines = await asyncio.to_thread(_run_action)
+    await ctx.reply('\n'.join(lines)[:2000])
+
+
+@bot.command(name='inflight',
+             help='Show the request coalescing statistics (owner only).')
+@commands.is_owner()
+async def inflight_command(ctx):
+    lines = []
+    for name in list_single_flight_names():
+        stats = get_single_flight(name).stats()
+        lines.append(f'**{name}**: ' + ', '.join(f'{key}: {value}' for key, value in stats.items()))
+    await ctx.reply('\n'.join(lines) or 'No request coalesced yet.')
+
+
+@bot.command(name='wikiindex',
+             help='Inspect or update the local wiki index (owner only). '
+                  'Usage: `maid wikiindex stats`, `maid wikiindex update [max_pages]`, `maid wikiindex ingest <file>`')
+@commands.is_owner()
+async def wiki_index_command(ctx, action: str = 'stats', arg: Optional[str] = None):
+    wiki_index = _wiki_module.get_wiki_index()
+    if action == 'stats':
+        stats = wiki_index.stats()
+        await ctx.reply(', '.join(f'{key}: {value}' for key, value in stats.items()))
+    elif action in {'update', 'ingest'}:
+        if action == 'ingest' and not arg:
+            await ctx.reply('Dump file should be specified.')
+            return
+
+        reply_message = await ctx.reply(f'Maid is running wiki index {action} ...')
+        try:
+            if action == 'update':
+                result = await asyncio.to_thread(wiki_index.update_from_danbooru, max_pages=int(arg or 50))
+            else:
+                result = await asyncio.to_thread(wiki_index.ingest, arg)
+        except Exception as err:
+            await reply_message.edit(content=f'Wiki index {action} failed - {err!r}')
+            raise
+        await reply_message.edit(content=f'Wiki index {action} completed, ' +
+                                         ', '.join(f'{key}: {value}' for key, value in result.items()) + '.')
+    else:
+        await ctx.reply(f'Unknown wiki index action {action!r}.')
+
+
+@bot.command(name='jobs',
+             help='List your download jobs in queue.')
+async def jobs_command(ctx):
+    jobs = await asyncio.to_thread(get_download_queue().list_jobs, statuses=[JOB_QUEUED, JOB_RUNNING],
+                                   user_id=ctx.author.id)
+    lines = [f'- Job #{job["id"]}: {job["payload"]["site"]} '
+             f'{", ".join(f"`{tag}`" for tag in job["payload"]["tags"])} ({job["status"]})' for job in jobs]
+    await ctx.reply('\n'.join(lines) or 'No download job in queue.')
+
+
+@bot.command(name='cancel',
+             help='Cancel your download job. Usage: `maid cancel <job_id>`')
+async def cancel_command(ctx, job_id: int):
+    queue = get_download_queue()
+    job = await asyncio.to_thread(queue.get, job_id)
+    if job is None or (job['user_id'] != ctx.author.id and not await bot.is_owner(ctx.author)):
+        await ctx.reply(f'Download job #{job_id} not found.')
+    elif await asyncio.to_thread(queue.cancel, job_id):
+        await ctx.reply(f'Download job #{job_id} is being cancelled.')
+    else:
+        await ctx.reply(f'Download job #{job_id} is already {job["status"]}.')
+
+
+@bot.command(name='stats',
+             help='Show the latency and counter metrics of the commands and stages (owner only). '
+                  'Usage: `maid stats [prefix]`, e.g. `maid stats maid_command`')
+@commands.is_owner()
+async def stats_command(ctx, prefix: Optional[str] = None):
+    lines = get_metrics().summary(prefix=prefix)
+    for page in _split_message('\n'.join(lines) or 'No metrics recorded yet.'):
+        await ctx.reply(page)
+
+
+def _collect_gauges():
+    for name in list_cache_names():
+        for key, value in get_cache(name).stats().items():
+            yield f'maid_cache_{key}', {'cache': name}, value
+    # the modules not loaded yet have nothing to report
+    if _packcache_module.loaded:
+        for key, value in _packcache_module.get_pack_cache().stats().items():
+            yield f'maid_pack_cache_{key}', {}, value
+    for name in list_single_flight_names():
+        for key, value in get_single_flight(name).stats().items():
+            yield f'maid_single_flight_{key}', {'name': name}, value
+    for name in ['search', 'explain', 'calc']:
+        yield 'maid_pool_pending', {'pool': name}, get_worker_pool(name).pending
+    for status, count in get_download_queue().stats().items():
+        yield 'maid_jobs', {'queue': 'download', 'status': status}, count
+    if _danbooru_utils_module.loaded:
+        for key, value in _danbooru_utils_module.get_danbooru_client().stats().items():
+            yield f'maid_danbooru_client_{key}', {}, value
+    if _calc_module.loaded:
+        for key, value in _calc_module.get_calc_evaluator().stats().items():
+            yield f'maid_calc_workers_{key}', {}, value
+
+
+async def resume_download_jobs():
+    # progress messages of the jobs submitted before restart are still updated
+    await bot.wait_until_ready()
+    queue = get_download_queue()
+    for job in await asyncio.to_thread(queue.list_jobs, undelivered=True, limit=100):
+        # the other shards resume their own jobs
+        if not _is_served_here(job['guild_id']):
+            continue
+        try:
+            channel = bot.get_channel(job['meta']['channel_id']) or \
+                      await bot.fetch_channel(job['meta']['channel_id'])
+        except discord.HTTPException as err:
+            logging.warning(f'Unable to resume job #{job["id"]} - {err!r}')
+            await asyncio.to_thread(queue.mark_delivered, job['id'])
+            continue
+        logging.info(f'Resuming download job #{job["id"]} ...')
+        asyncio.ensure_future(watch_download_job(channel, job['id']))
+
+
+@bot.before_invoke
+async def before_any_command(ctx):
+    ctx.start_time = time.perf_counter()
+    modules = [module for module in _COMMAND_MODULES.get(ctx.command.name.split('_')[0], []) if not module.loaded]
+    if modules:
+        # used before prewarmed, import them out of the event loop
+        await asyncio.to_thread(lambda: [module.load() for module in modules])
+
+
+_RECORD_LOCK = threading.Lock()
+
+
+def _append_record(record_file: str, line: str):
+    with _RECORD_LOCK, open(record_file, 'a') as f:
+        f.write(line + '\n')
+
+
+async def _record_command(ctx):
+    # recorded commands can be replayed with `python -m maid_assistant.bench --mix <file>`
+    record_file = os.environ.get('MAID_COMMAND_RECORD')
+    if record_file:
+        args = ' '.join(str(value) for value in ctx.kwargs.values() if value is not None)
+        line = json.dumps({'command': ctx.command.name, 'args': args, 'time': time.time()})
+        await asyncio.to_thread(_append_record, record_file, line)
+
+
+@bot.after_invoke
+async def after_any_command(ctx):
+    # also called when the command failed, so the failed ones are timed as well
+    if getattr(ctx, 'start_time', None) is not None:
+        get_metrics().observe('maid_command_seconds', time.perf_counter() - ctx.start_time,
+                              command=ctx.command.name)
+    await _record_command(ctx)
+
+
+@bot.event
+async def on_command_error(ctx, error):
+    get_metrics().inc('maid_command_errors_total', command=ctx.command.name if ctx.command else 'unknown',
+                      error=type(getattr(error, 'original', error)).__name__)
+    if isinstance(error, commands.CommandInvokeError) and isinstance(error.original, PoolBusyError):
+        logging.warning(f'Command {ctx.command} rejected - {error.original}')
+    elif isinstance(error, commands.CheckFailure):
+        logging.warning(f'Command {ctx.command} check failed - {error!r}')
+    else:
+        logging.error(f'Error occurred in command {ctx.command} - {error!r}', exc_info=error)
+
+
+@bot.event
+async def setup_hook():
+    get_download_queue().start()
+    get_metrics().register_collector(_collect_gauges)
+    start_metrics_server()
+    asyncio.ensure_future(resume_download_jobs())
+    # slash commands are global, synced once by the process running shard 0
+    if _is_served_here(None):
+        synced = await bot.tree.sync()
+        logging.info(f'{plural_word(len(synced), "slash command")} synced.')
+
+
+async def prewarm():
+    start_time = time.perf_counter()
+    durations = await asyncio.to_thread(prewarm_modules)
+    # the first calculation will not wait for the workers to start
+    await asyncio.to_thread(lambda: _calc_module.get_calc_evaluator().prewarm())
+    logging.info(f'{plural_word(len(durations), "module")} and calc workers prewarmed '
+                 f'in {time.perf_counter() - start_time:.3f}s.')
+
+
+_prewarm_task: Optional[asyncio.Task] = None
+
+
 @bot.event
 async def on_ready():
+    global _prewarm_task
     logging.info(f'Bot logged in as {bot.user}')
+    # MAID_PREWARM=0 leaves everything to be loaded on first use, e.g. for the short-lived test instances
+    if _prewarm_task is None and get_int_env('MAID_PREWARM', 1):
+        _prewarm_task = asyncio.ensure_future(prewarm())
+
+
+def run_job_worker():
+    # a process without gateway connection, only runs the download jobs submitted by the shards
+    start_metrics_server()
+    get_metrics().register_collector(_collect_gauges)
+    prewarm_modules([_danbooru_module.name, _gelbooru_module.name])
+    get_download_queue().start()
+    logging.info('Job worker started.')
+    threading.Event().wait()
 
 
 if __name__ == '__main__':
-    bot.run(os.environ['DC_BOT_TOKEN'])
+    if os.environ.get('MAID_PROCESS_ROLE') == 'worker':
+        run_job_worker()
+    else:
+        bot.run(os.environ['DC_BOT_TOKEN'])
@@ -0,0 +1,3 @@
+from .mock import MockBooruServer, MockBooruData, MockLLMServer, make_local_data_pool
+from .runner import COMMANDS, DEFAULT_MIX, load_command_mix, mock_environment, run_benchmark, format_report, \
+    compare_reports
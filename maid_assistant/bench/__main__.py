@@ -0,0 +1,66 @@
+import argparse
+import json
+import logging
+import sys
+
+from .runner import DEFAULT_MIX, load_command_mix, mock_environment, run_benchmark, format_report, compare_reports
+
+
+def _parse_rating_mix(text: str):
+    # e.g. g=0.45,s=0.3,q=0.15,e=0.1
+    return {key.strip(): float(value) for key, value in (item.split('=', 1) for item in text.split(','))}
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m maid_assistant.bench',
+                                     description='Replay command mixes against local mock services.')
+    parser.add_argument('--mix', help='Command mix in jsonl, e.g. the file recorded with MAID_COMMAND_RECORD.')
+    parser.add_argument('--repeat', type=int, default=1, help='Times to replay the whole mix.')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='Commands running at the same time, upstream requests and memory are only '
+                             'attributed to commands when it is 1.')
+    parser.add_argument('--work-dir', help='Directory to keep the generated data pool images between runs.')
+    parser.add_argument('--posts', type=int, default=2000, help='Posts on each mock site.')
+    parser.add_argument('--rating-mix', type=_parse_rating_mix, default=None, help='e.g. g=0.45,s=0.3,q=0.15,e=0.1')
+    parser.add_argument('--booru-latency', type=float, default=0.05, help='Mean latency of the mock sites.')
+    parser.add_argument('--llm-latency', type=float, default=0.3, help='Time to the first token of the mock LLM.')
+    parser.add_argument('--llm-tps', type=float, default=200.0, help='Tokens per second of the mock LLM.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Ratio of the 503 responses.')
+    parser.add_argument('--missing-ratio', type=float, default=0.05, help='Ratio of the posts missing in data pools.')
+    parser.add_argument('--no-trace-memory', action='store_true', help='Do not trace memory, which is slower.')
+    parser.add_argument('--json', help='Save the report into this json file.')
+    parser.add_argument('--baseline', help='Report json to compare with, exit with 1 when regressed.')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed regression ratio.')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    mix = load_command_mix(args.mix) if args.mix else DEFAULT_MIX
+    with mock_environment(
+            work_dir=args.work_dir, n_posts=args.posts, rating_weights=args.rating_mix,
+            booru_latency=args.booru_latency, llm_latency=args.llm_latency, llm_tokens_per_second=args.llm_tps,
+            error_rate=args.error_rate, missing_ratio=args.missing_ratio,
+    ) as servers:
+        report = run_benchmark(mix, servers, concurrency=args.concurrency, trace_memory=not args.no_trace_memory,
+                               repeat=args.repeat)
+
+    print(format_report(report))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare_reports(baseline, report, tolerance=args.tolerance)
+        if regressions:
+            print('\nRegressions found:')
+            for line in regressions:
+                print(f'- {line}')
+            sys.exit(1)
+        else:
+            print('\nNo regression found.')
+
+
+if __name__ == '__main__':
+    main()
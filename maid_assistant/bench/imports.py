@@ -0,0 +1,110 @@
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+from collections import defaultdict
+from typing import List, Dict, Optional
+
+# import time:       245 |        245 |     _io
+_IMPORT_TIME_PATTERN = re.compile(r'^import time:\s*(?P<self>\d+)\s*\|\s*(?P<cumulative>\d+)\s*\|(?P<name>\s*\S+)\s*$')
+
+
+def profile_imports(module: str = 'app', cwd: Optional[str] = None, env: Optional[Dict[str, str]] = None,
+                    repeat: int = 3) -> dict:
+    # measured in new interpreters with `python -X importtime`, the fastest run is taken to reduce the noises
+    best = None
+    for _ in range(repeat):
+        process = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+            cwd=cwd, env={**os.environ, **(env or {})}, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            text=True, check=False,
+        )
+        modules = []
+        for line in process.stderr.splitlines():
+            matching = _IMPORT_TIME_PATTERN.match(line)
+            if matching:
+                name = matching.group('name')
+                modules.append({
+                    'name': name.strip(),
+                    'depth': (len(name) - len(name.lstrip())) // 2,
+                    'self': int(matching.group('self')) / 1e6,
+                    'cumulative': int(matching.group('cumulative')) / 1e6,
+                })
+        if process.returncode != 0:
+            errors = [line for line in process.stderr.splitlines() if not _IMPORT_TIME_PATTERN.match(line)]
+            raise RuntimeError(f'Failed to import {module!r}:\n' + '\n'.join(errors[-20:]))
+
+        # children are printed before their parents, so the last top level entry is the measured module
+        index = max(i for i, item in enumerate(modules) if item['depth'] == 0)
+        first = max([i + 1 for i, item in enumerate(modules[:index]) if item['depth'] == 0], default=0)
+        report = {
+            'module': module,
+            'total': modules[index]['cumulative'],
+            'modules': modules[first:index + 1],
+        }
+        if best is None or report['total'] < best['total']:
+            best = report
+    return best
+
+
+def summarize_packages(report: dict) -> Dict[str, float]:
+    packages = defaultdict(float)
+    for item in report['modules']:
+        packages[item['name'].split('.')[0]] += item['self']
+    return dict(sorted(packages.items(), key=lambda x: -x[1]))
+
+
+def format_import_report(report: dict, top: int = 20) -> str:
+    lines = [f'Import time of {report["module"]!r}: {report["total"]:.3f}s, '
+             f'{len(report["modules"])} modules', '', f'{"Package":<32} {"self":>8}']
+    for name, seconds in list(summarize_packages(report).items())[:top]:
+        lines.append(f'{name:<32} {seconds:>8.3f}')
+
+    # the modules imported directly by the measured one, which are the ones can be deferred
+    lines.extend(['', f'{"Imported by " + report["module"]:<56} {"cumulative":>10}'])
+    direct = [item for item in report['modules'] if item['depth'] == 1]
+    for item in sorted(direct, key=lambda x: -x['cumulative'])[:top]:
+        lines.append(f'{item["name"]:<56} {item["cumulative"]:>10.3f}')
+    return '\n'.join(lines)
+
+
+def check_import_budget(report: dict, max_seconds: Optional[float] = None,
+                        forbidden: Optional[List[str]] = None) -> List[str]:
+    problems = []
+    if max_seconds is not None and report['total'] > max_seconds:
+        problems.append(f'Import time {report["total"]:.3f}s is more than {max_seconds:.3f}s.')
+    names = {item['name'] for item in report['modules']}
+    for name in forbidden or []:
+        if name in names:
+            problems.append(f'Module {name!r} should not be imported on startup.')
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m maid_assistant.bench.imports',
+                                     description='Profile the import time of the bot on startup.')
+    parser.add_argument('--module', default='app', help='Module to import.')
+    parser.add_argument('--repeat', type=int, default=3, help='Times to measure, the fastest one is reported.')
+    parser.add_argument('--top', type=int, default=20, help='Lines of each table.')
+    parser.add_argument('--json', help='Save the report into this json file.')
+    parser.add_argument('--max-seconds', type=float, default=None, help='Exit with 1 when the import is slower.')
+    parser.add_argument('--forbid', action='append', default=[],
+                        help='Exit with 1 when this module is imported on startup, e.g. openai, can be repeated.')
+    args = parser.parse_args()
+
+    report = profile_imports(args.module, repeat=args.repeat)
+    print(format_import_report(report, top=args.top))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    problems = check_import_budget(report, max_seconds=args.max_seconds, forbidden=args.forbid)
+    if problems:
+        print('\n' + '\n'.join(problems))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
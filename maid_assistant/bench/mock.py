@@ -0,0 +1,367 @@
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter
+from fnmatch import fnmatch
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import List, Optional, Dict, Tuple
+from urllib.parse import urlsplit, parse_qs, unquote
+
+import numpy as np
+from PIL import Image
+
+_DEFAULT_TAGS = [
+    '1girl', 'solo', 'long_hair', 'smile', 'looking_at_viewer', 'blush', 'short_hair', 'open_mouth',
+    'blue_eyes', 'red_eyes', 'white_background', 'simple_background', 'multiple_girls', '2girls', 'dress',
+    'arknights', 'surtr_(arknights)', 'amiya_(arknights)', 'genshin_impact', 'hu_tao_(genshin_impact)',
+    'vocaloid', 'hatsune_miku', 'hololive', 'gawr_gura', 'fate_(series)', 'saber_(fate)', 'animal_ears',
+    'cat_ears', 'school_uniform', 'thighhighs', 'holding', 'outdoors', 'sky', 'flower', 'hat',
+]
+_DEFAULT_RATING_WEIGHTS = {'g': 0.45, 's': 0.3, 'q': 0.15, 'e': 0.1}
+_GELBOORU_RATINGS = {'g': 'general', 's': 'sensitive', 'q': 'questionable', 'e': 'explicit'}
+
+_LOREM = ('Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt '
+          'ut labore et dolore magna aliqua. ').split(' ')
+
+
+class MockBooruData:
+    def __init__(self, n_posts: int = 2000, tags: Optional[List[str]] = None,
+                 rating_weights: Optional[Dict[str, float]] = None, parent_ratio: float = 0.05,
+                 tags_per_post: int = 8, start_id: int = 1000000, seed: int = 0):
+        rnd = random.Random(seed)
+        self.tags = list(tags or _DEFAULT_TAGS)
+        rating_weights = rating_weights or _DEFAULT_RATING_WEIGHTS
+        ratings, weights = list(rating_weights.keys()), list(rating_weights.values())
+        # zipf-like popularity, so there are both huge and rare tags
+        tag_weights = [1.0 / (i + 1) for i in range(len(self.tags))]
+
+        self.posts = []
+        for i in range(n_posts):
+            post_id = start_id + i * rnd.randint(1, 5)
+            if self.posts and post_id <= self.posts[-1]['id']:
+                post_id = self.posts[-1]['id'] + 1
+            post_tags = set(rnd.choices(self.tags, weights=tag_weights, k=tags_per_post))
+            self.posts.append({
+                'id': post_id,
+                'rating': rnd.choices(ratings, weights=weights)[0],
+                'score': rnd.randint(0, 500),
+                'parent_id': self.posts[-1]['id'] if self.posts and rnd.random() < parent_ratio else None,
+                'tag_string': ' '.join(sorted(post_tags)),
+                '_tags': post_tags,
+            })
+        # newest first, like the real sites
+        self.posts.sort(key=lambda x: -x['id'])
+        self.post_counts = Counter(tag for post in self.posts for tag in post['_tags'])
+
+        self.wiki_pages = {}
+        for tag in self.tags:
+            refs = rnd.sample(self.tags, k=min(3, len(self.tags)))
+            self.wiki_pages[tag] = {
+                'id': len(self.wiki_pages) + 1,
+                'title': tag,
+                'body': f'A tag about {tag.replace("_", " ")}. ' + ' '.join(rnd.choices(_LOREM, k=60)) +
+                        '\n\nSee also: ' + ', '.join(f'[[{ref.replace("_", " ")}]]' for ref in refs if ref != tag),
+                'other_names': [tag.replace('_', ' ').title()],
+                'is_deleted': False,
+                'updated_at': '2024-01-01T00:00:00.000+00:00',
+            }
+
+    @property
+    def max_id(self) -> int:
+        return self.posts[0]['id'] + 1 if self.posts else 1
+
+    def _match(self, post: dict, terms: List[str], gelbooru: bool) -> bool:
+        for term in terms:
+            negative = term.startswith('-')
+            term = term.lstrip('-~')
+            if not term:
+                continue
+            if term.startswith('rating:'):
+                values = term.split(':', 1)[1].split(',')
+                rating = _GELBOORU_RATINGS[post['rating']] if gelbooru else post['rating']
+                ok = rating in values
+            elif term.startswith('id:<'):
+                ok = post['id'] < int(term[4:])
+            elif term == 'parent:none':
+                ok = not post['parent_id']
+            elif re.match(r'^[a-z_]+:', term) and term.split(':', 1)[0] in {'order', 'sort', 'parent', 'id'}:
+                continue
+            elif '*' in term:
+                ok = any(fnmatch(tag, term) for tag in post['_tags'])
+            else:
+                ok = term in post['_tags']
+            if ok == negative:
+                return False
+        return True
+
+    def search(self, tags: List[str], gelbooru: bool = False) -> List[dict]:
+        posts = [post for post in self.posts if self._match(post, tags, gelbooru)]
+        if any(tag.startswith(('order:score', 'sort:score')) for tag in tags):
+            posts = sorted(posts, key=lambda x: -x['score'])
+        return posts
+
+    def format_post(self, post: dict, gelbooru: bool = False) -> dict:
+        item = {key: value for key, value in post.items() if not key.startswith('_')}
+        if gelbooru:
+            item['rating'] = _GELBOORU_RATINGS[post['rating']]
+            item['tags'] = item.pop('tag_string')
+            item['parent_id'] = item['parent_id'] or 0
+        return item
+
+
+class _MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server: '_MockHTTPServer'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, data, status: int = 200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _delay(self) -> bool:
+        owner = self.server.owner
+        if owner.latency:
+            time.sleep(max(random.gauss(owner.latency, owner.latency * owner.jitter), 0.0))
+        if owner.error_rate and random.random() < owner.error_rate:
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.send_header('Retry-After', '0')
+            self.end_headers()
+            return False
+        return True
+
+
+class _MockHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    owner = None
+
+
+class _MockServer:
+    _handler_class = _MockHandler
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.2, error_rate: float = 0.0, host: str = '127.0.0.1'):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.host = host
+        self._server: Optional[_MockHTTPServer] = None
+        self._lock = threading.Lock()
+        self._requests = Counter()
+
+    def count(self, endpoint: str):
+        with self._lock:
+            self._requests[endpoint] += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._requests)
+
+    @property
+    def url(self) -> str:
+        return f'http://{self.host}:{self._server.server_address[1]}'
+
+    def start(self):
+        self._server = _MockHTTPServer((self.host, 0), self._handler_class)
+        self._server.owner = self
+        threading.Thread(target=self._server.serve_forever, name=f'maid_{type(self).__name__}', daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+class _BooruHandler(_MockHandler):
+    server: '_MockHTTPServer'
+
+    def do_GET(self):
+        owner: MockBooruServer = self.server.owner
+        split = urlsplit(self.path)
+        path, query = unquote(split.path), {key: values[-1] for key, values in parse_qs(split.query).items()}
+        path = re.sub(r'/+', '/', path)
+
+        if path == '/posts.json':
+            endpoint = 'danbooru/posts'
+        elif path == '/index.php' and query.get('s') == 'post':
+            endpoint = 'gelbooru/posts'
+        elif path == '/wiki_pages.json' or path.startswith('/wiki_pages/'):
+            endpoint = 'danbooru/wiki_pages'
+        elif path == '/tags.json':
+            endpoint = 'danbooru/tags'
+        else:
+            self.send_error(404)
+            return
+
+        owner.count(endpoint)
+        if not self._delay():
+            return
+        if endpoint == 'danbooru/posts':
+            self._send_json(self._danbooru_posts(owner.danbooru, query))
+        elif endpoint == 'gelbooru/posts':
+            self._send_json(self._gelbooru_posts(owner.gelbooru, query))
+        elif path.startswith('/wiki_pages/'):
+            page = owner.danbooru.wiki_pages.get(path[len('/wiki_pages/'):-len('.json')])
+            self._send_json(page if page else {'success': False}, status=200 if page else 404)
+        elif endpoint == 'danbooru/wiki_pages':
+            titles = parse_qs(split.query).get('search[title_array][]') or \
+                     query.get('search[title_normalize]', '').split(',')
+            self._send_json([owner.danbooru.wiki_pages[title] for title in titles
+                             if title in owner.danbooru.wiki_pages])
+        else:
+            names = query.get('search[name_comma]', '').split(',')
+            self._send_json([{'name': name, 'post_count': owner.danbooru.post_counts[name]}
+                             for name in names if name in owner.danbooru.post_counts])
+
+    @staticmethod
+    def _danbooru_posts(data: MockBooruData, query: dict) -> List[dict]:
+        posts = data.search(query.get('tags', '').split())
+        limit = min(int(query.get('limit') or 20), 200)
+        page = query.get('page') or '1'
+        if page.startswith('b'):
+            min_id = int(page[1:])
+            posts = [post for post in posts if post['id'] < min_id][:limit]
+        else:
+            offset = (int(page) - 1) * limit
+            posts = posts[offset:offset + limit]
+        return [data.format_post(post) for post in posts]
+
+    @staticmethod
+    def _gelbooru_posts(data: MockBooruData, query: dict) -> dict:
+        posts = data.search(query.get('tags', '').split(), gelbooru=True)
+        limit = min(int(query.get('limit') or 100), 100)
+        offset = int(query.get('pid') or 0) * limit
+        retval = {'@attributes': {'limit': limit, 'offset': offset, 'count': len(posts)}}
+        page_posts = posts[offset:offset + limit]
+        if page_posts:
+            retval['post'] = [data.format_post(post, gelbooru=True) for post in page_posts]
+        return retval
+
+
+class MockBooruServer(_MockServer):
+    _handler_class = _BooruHandler
+
+    def __init__(self, danbooru: Optional[MockBooruData] = None, gelbooru: Optional[MockBooruData] = None,
+                 latency: float = 0.05, jitter: float = 0.2, error_rate: float = 0.0, host: str = '127.0.0.1'):
+        _MockServer.__init__(self, latency=latency, jitter=jitter, error_rate=error_rate, host=host)
+        self.danbooru = danbooru or MockBooruData(seed=0)
+        self.gelbooru = gelbooru or MockBooruData(seed=1)
+
+
+class _LLMHandler(_MockHandler):
+    def do_POST(self):
+        owner: MockLLMServer = self.server.owner
+        if not urlsplit(self.path).path.endswith('/chat/completions'):
+            self.send_error(404)
+            return
+
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+        owner.count('llm/stream' if request.get('stream') else 'llm/chat')
+        if not self._delay():
+            return
+
+        prompt = '\n'.join(message.get('content') or '' for message in request.get('messages', []))
+        answer = owner.make_answer(request.get('messages', [])[-1].get('content') or '')
+        model = request.get('model') or 'mock'
+        usage = {'prompt_tokens': len(prompt) // 4, 'completion_tokens': len(answer) // 4}
+        usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+        if not request.get('stream'):
+            time.sleep(owner.get_generation_time(answer))
+            self._send_json({
+                'id': 'chatcmpl-mock', 'object': 'chat.completion', 'created': int(time.time()), 'model': model,
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': answer}, 'finish_reason': 'stop'}],
+                'usage': usage,
+            })
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        words = re.findall(r'\S+\s*', answer)
+        for i in range(0, len(words), owner.words_per_chunk):
+            text = ''.join(words[i:i + owner.words_per_chunk])
+            time.sleep(owner.get_generation_time(text))
+            self._send_event({
+                'id': 'chatcmpl-mock', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model,
+                'choices': [{'index': 0, 'delta': {'content': text}, 'finish_reason': None}],
+            })
+        self._send_event({
+            'id': 'chatcmpl-mock', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model,
+            'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}],
+        })
+        self.wfile.write(b'data: [DONE]\n\n')
+        self.wfile.flush()
+
+    def _send_event(self, data: dict):
+        self.wfile.write(f'data: {json.dumps(data)}\n\n'.encode())
+        self.wfile.flush()
+
+
+class MockLLMServer(_MockServer):
+    _handler_class = _LLMHandler
+
+    def __init__(self, latency: float = 0.3, tokens_per_second: float = 200.0, answer_words: int = 80,
+                 words_per_chunk: int = 4, jitter: float = 0.2, error_rate: float = 0.0, host: str = '127.0.0.1'):
+        # latency is the time to the first token
+        _MockServer.__init__(self, latency=latency, jitter=jitter, error_rate=error_rate, host=host)
+        self.tokens_per_second = tokens_per_second
+        self.answer_words = answer_words
+        self.words_per_chunk = words_per_chunk
+
+    @property
+    def url(self) -> str:
+        return f'http://{self.host}:{self._server.server_address[1]}/v1'
+
+    def get_generation_time(self, text: str) -> float:
+        return len(text) / 4 / self.tokens_per_second if self.tokens_per_second else 0.0
+
+    def make_answer(self, message: str) -> str:
+        # answers every tag of batched messages, in the format asked by the system prompt
+        batch_tags = re.findall(r'^@@@ (.+)$', message, flags=re.MULTILINE)
+        tags = batch_tags or re.findall(r'^Tag: (.+)$', message, flags=re.MULTILINE)[:1] or ['unknown']
+        parts = []
+        for tag in tags:
+            text = f'## {tag}\n\n' + ' '.join(_LOREM[i % len(_LOREM)] for i in range(self.answer_words))
+            parts.append(f'@@@ {tag}\n\n{text}' if batch_tags else text)
+        return '\n\n'.join(parts)
+
+
+def make_local_data_pool(directory: str, data: MockBooruData, missing_ratio: float = 0.05, size: int = 384,
+                         seed: int = 0) -> Tuple[int, int]:
+    # some of the posts are missing, just like the real data pools
+    os.makedirs(directory, exist_ok=True)
+    created, exists = 0, 0
+    for post in data.posts:
+        # seeded by post, so the same images are missing when the pool is reused
+        rnd = np.random.default_rng([seed, post['id']])
+        if rnd.random() < missing_ratio:
+            continue
+        image_file = os.path.join(directory, f'{post["id"]}.webp')
+        if os.path.exists(image_file):
+            exists += 1
+            continue
+
+        # blurred noise, so that the images are different from each other, but still compressible
+        small = rnd.integers(0, 256, size=(16, 16, 3), dtype=np.uint8)
+        image = Image.fromarray(small).resize((size, size), Image.BICUBIC)
+        image.save(image_file, format='webp', quality=80)
+        created += 1
+    return created, exists
@@ -0,0 +1,318 @@
+import json
+import logging
+import os
+import re
+import resource
+import time
+import tracemalloc
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from typing import List, Tuple, Dict, Optional, Callable
+
+import numpy as np
+from hbutils.string import plural_word
+from hbutils.system import TemporaryDirectory
+
+from .mock import MockBooruServer, MockLLMServer, MockBooruData, make_local_data_pool
+
+
+def _split_tags(args: str) -> List[str]:
+    return list(filter(bool, re.split(r'\s+', args)))
+
+
+def _run_query(site: str, args: str):
+    # same as what the bot does in sfw channels
+    if site == 'danbooru':
+        from ..sites.danbooru import query_danbooru_images
+        return query_danbooru_images(_split_tags(args), count=10, allowed_ratings={'g', 's'}, raw=True)
+    else:
+        from ..sites.gelbooru import query_gelbooru_images
+        return query_gelbooru_images(_split_tags(args), count=10, allowed_ratings={'general', 'sensitive'}, raw=True)
+
+
+def _run_search(args: str):
+    from ..sites.danbooru import query_danbooru_images
+    from ..sites.gelbooru import query_gelbooru_images
+    from ..utils import ImageHashIndex
+
+    hash_index = ImageHashIndex()
+    with ThreadPoolExecutor(max_workers=2) as tp:
+        futures = [
+            tp.submit(query_danbooru_images, _split_tags(args), count=10, allowed_ratings={'g', 's'},
+                      raw=True, timeout=30.0, dedup=hash_index),
+            tp.submit(query_gelbooru_images, _split_tags(args), count=10, allowed_ratings={'general', 'sensitive'},
+                      raw=True, timeout=30.0, dedup=hash_index),
+        ]
+        return [future.result() for future in futures]
+
+
+def _run_download(site: str, args: str):
+    from ..sites.danbooru import download_danbooru_images
+    from ..sites.gelbooru import download_gelbooru_images
+
+    download_func = download_danbooru_images if site == 'danbooru' else download_gelbooru_images
+    with download_func(_split_tags(args), max_total_size=24 * 1024 ** 2) as (filenames, package_file):
+        return len(filenames)
+
+
+def _run_explain(lang: str, args: str):
+    from ..explain import tag_explain
+    return tag_explain(args.strip(), lang, use_other_names=True)
+
+
+def _run_explain_stream(lang: str, args: str):
+    from ..explain import tag_explain_stream
+    return ''.join(tag_explain_stream(args.strip(), lang, use_other_names=True))
+
+
+def _run_explain_batch(lang: str, args: str):
+    from ..explain import tag_explain_batch
+    return tag_explain_batch(_split_tags(args), lang, use_other_names=True)
+
+
+def _run_calc(args: str):
+    from ..calc import isolated_eval
+    return isolated_eval(args)
+
+
+def _run_plot(args: str):
+    from ..calc import isolated_eval
+    return isolated_eval(args, chart=True)
+
+
+_LANGS = {'': 'english', '_cn': 'simplified chinese', '_jp': 'japanese', '_kr': 'korean'}
+
+# names are the same as the bot commands, so the recorded commands can be replayed
+COMMANDS: Dict[str, Callable[[str], object]] = {
+    'danbooru': partial(_run_query, 'danbooru'),
+    'gelbooru': partial(_run_query, 'gelbooru'),
+    'search': _run_search,
+    'danbooru_dl': partial(_run_download, 'danbooru'),
+    'gelbooru_dl': partial(_run_download, 'gelbooru'),
+    'calc': _run_calc,
+    'plot': _run_plot,
+    **{f'explain{suffix}': partial(_run_explain, lang) for suffix, lang in _LANGS.items()},
+    **{f'explain_stream{suffix}': partial(_run_explain_stream, lang) for suffix, lang in _LANGS.items()},
+    **{f'explain_batch{suffix}': partial(_run_explain_batch, lang) for suffix, lang in _LANGS.items()},
+}
+
+DEFAULT_MIX = [
+    ('danbooru', '1girl solo', 3),
+    ('danbooru', 'surtr_(arknights)', 2),
+    ('gelbooru', '1girl long_hair', 2),
+    ('search', 'hatsune_miku', 2),
+    ('danbooru_dl', 'arknights', 2),
+    ('gelbooru_dl', 'smile', 1),
+    ('explain', 'surtr_(arknights)', 2),
+    ('explain_stream_cn', 'hatsune_miku', 2),
+    ('explain_batch', '1girl solo smile long_hair blue_eyes', 2),
+    ('calc', '(1 + 2) * 3 ** 4', 5),
+    ('calc', 'sin(x) * x for x in 0..10 step 0.01', 3),
+    ('plot', 'sin(x) * exp(-x / 10) for x in 0..100 step 0.001', 2),
+]
+
+
+def load_command_mix(mix_file: str) -> List[Tuple[str, str, int]]:
+    # jsonl, e.g. {"command": "danbooru", "args": "1girl solo", "repeat": 3}, same as the recorded commands
+    mix = []
+    with open(mix_file, 'r') as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                if item['command'] not in COMMANDS:
+                    logging.warning(f'Unknown command {item["command"]!r}, skipped.')
+                    continue
+                mix.append((item['command'], item.get('args') or '', int(item.get('repeat', 1))))
+    return mix
+
+
+def _pin_max_ids(booru: MockBooruServer):
+    # max id services read the pinned values from their cache files, instead of asking huggingface
+    from ..sites import danbooru, gelbooru
+    from ..utils import get_max_id_service
+
+    for repo_id, data in [(danbooru._N_REPO_ID, booru.danbooru), (gelbooru._N_REPO_ID, booru.gelbooru)]:
+        cache_file = get_max_id_service(repo_id).cache_file
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(cache_file, 'w') as f:
+            json.dump({'max_id': data.max_id, 'etag': 'mock', 'checked_at': time.time()}, f)
+    get_max_id_service.cache_clear()
+
+
+@contextmanager
+def mock_environment(work_dir: Optional[str] = None, n_posts: int = 2000,
+                     rating_weights: Optional[Dict[str, float]] = None, booru_latency: float = 0.05,
+                     llm_latency: float = 0.3, llm_tokens_per_second: float = 200.0, error_rate: float = 0.0,
+                     missing_ratio: float = 0.05):
+    # should be used before anything of maid_assistant is initialized, for the settings are cached once loaded
+    with TemporaryDirectory() as td:
+        work_dir = work_dir or td
+        booru = MockBooruServer(
+            danbooru=MockBooruData(n_posts=n_posts, rating_weights=rating_weights, seed=0),
+            gelbooru=MockBooruData(n_posts=n_posts, rating_weights=rating_weights, start_id=5000000, seed=1),
+            latency=booru_latency, error_rate=error_rate,
+        )
+        llm = MockLLMServer(latency=llm_latency, tokens_per_second=llm_tokens_per_second, error_rate=error_rate)
+
+        pool_dir = os.path.join(work_dir, 'pools')
+        for site, data in [('danbooru', booru.danbooru), ('gelbooru', booru.gelbooru)]:
+            created, exists = make_local_data_pool(os.path.join(pool_dir, site), data, missing_ratio=missing_ratio)
+            logging.info(f'Local {site} data pool prepared, {plural_word(created, "image")} created, '
+                         f'{plural_word(exists, "image")} reused.')
+
+        with booru, llm:
+            env = {
+                'DANBOORU_BASE_URL': booru.url,
+                'GELBOORU_BASE_URL': booru.url,
+                'LLM_BASE_URL': llm.url,
+                'LLM_API_KEY': 'mock',
+                'LLM_DEFAULT_MODEL': 'mock-model',
+                'MAID_LOCAL_DATA_POOL': pool_dir,
+                # cold caches for every run, the data pool images are kept in work_dir
+                'MAID_CACHE_DIR': os.path.join(td, 'cache'),
+                'MAID_WIKI_INDEX': os.path.join(td, 'cache', 'wiki_index.sqlite'),
+                'MAID_MAXID_TTL': str(10 ** 9),
+            }
+            origin_env = {key: os.environ.get(key) for key in env}
+            os.environ.update(env)
+            try:
+                _pin_max_ids(booru)
+                yield booru, llm
+            finally:
+                for key, value in origin_env.items():
+                    if value is None:
+                        os.environ.pop(key, None)
+                    else:
+                        os.environ[key] = value
+
+
+class CommandStats:
+    def __init__(self, command: str):
+        self.command = command
+        self.latencies: List[float] = []
+        self.errors = 0
+        self.upstream = Counter()
+        self.peak_memory = 0
+
+    def to_dict(self) -> dict:
+        latencies = np.array(self.latencies or [0.0])
+        runs = max(len(self.latencies), 1)
+        return {
+            'runs': len(self.latencies),
+            'errors': self.errors,
+            'p50': float(np.percentile(latencies, 50)),
+            'p95': float(np.percentile(latencies, 95)),
+            'p99': float(np.percentile(latencies, 99)),
+            'max': float(latencies.max()),
+            'upstream_per_run': {key: value / runs for key, value in sorted(self.upstream.items())},
+            'peak_memory': self.peak_memory,
+        }
+
+
+def _get_upstream_counts(servers) -> Counter:
+    counts = Counter()
+    for server in servers:
+        counts.update(server.stats())
+    return counts
+
+
+def run_benchmark(mix: List[Tuple[str, str, int]], servers, concurrency: int = 1, trace_memory: bool = True,
+                  repeat: int = 1) -> dict:
+    # the upstream requests and memory of each command can only be told apart when running one by one
+    items = [(command, args) for _ in range(repeat) for command, args, count in mix for _ in range(count)]
+    stats: Dict[str, CommandStats] = {}
+    sequential = concurrency <= 1
+    peak_traced = 0
+
+    def _run_item(command: str, args: str):
+        nonlocal peak_traced
+        before = _get_upstream_counts(servers) if sequential else None
+        if trace_memory and sequential:
+            tracemalloc.reset_peak()
+            base_memory = tracemalloc.get_traced_memory()[0]
+        start_time = time.perf_counter()
+        error = None
+        try:
+            COMMANDS[command](args)
+        except Exception as err:
+            logging.warning(f'Command {command!r} with {args!r} failed - {err!r}')
+            error = err
+        elapsed = time.perf_counter() - start_time
+
+        item_stats = stats.setdefault(command, CommandStats(command))
+        item_stats.latencies.append(elapsed)
+        item_stats.errors += error is not None
+        if sequential:
+            item_stats.upstream.update(_get_upstream_counts(servers) - before)
+            if trace_memory:
+                # the peak is reset for every command, so the overall peak is kept here
+                current_peak = tracemalloc.get_traced_memory()[1]
+                item_stats.peak_memory = max(item_stats.peak_memory, current_peak - base_memory)
+                peak_traced = max(peak_traced, current_peak)
+
+    if trace_memory:
+        tracemalloc.start()
+    start_time = time.perf_counter()
+    try:
+        if sequential:
+            for command, args in items:
+                _run_item(command, args)
+        else:
+            with ThreadPoolExecutor(max_workers=concurrency) as tp:
+                for future in [tp.submit(_run_item, command, args) for command, args in items]:
+                    future.result()
+        peak_traced = max(peak_traced, tracemalloc.get_traced_memory()[1]) if trace_memory else None
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+
+    return {
+        'commands': {command: item_stats.to_dict() for command, item_stats in sorted(stats.items())},
+        'upstream': dict(sorted(_get_upstream_counts(servers).items())),
+        'wall_time': time.perf_counter() - start_time,
+        'concurrency': concurrency,
+        'peak_traced_memory': peak_traced,
+        # kilobytes on linux
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+
+
+def _format_size(size: Optional[int]) -> str:
+    if size is None:
+        return '-'
+    return f'{size / 1024 ** 2:.1f}MiB'
+
+
+def format_report(report: dict) -> str:
+    lines = [f'{"command":<22}{"runs":>6}{"errors":>8}{"p50":>9}{"p95":>9}{"p99":>9}{"peak mem":>11}  upstream/run']
+    for command, item in report['commands'].items():
+        upstream = ', '.join(f'{key}: {value:g}' for key, value in item['upstream_per_run'].items())
+        lines.append(f'{command:<22}{item["runs"]:>6}{item["errors"]:>8}{item["p50"]:>9.3f}{item["p95"]:>9.3f}'
+                     f'{item["p99"]:>9.3f}{_format_size(item["peak_memory"] or None):>11}  {upstream or "-"}')
+    lines.append('')
+    lines.append(f'Upstream requests: {", ".join(f"{key}: {value}" for key, value in report["upstream"].items())}')
+    lines.append(f'Wall time: {report["wall_time"]:.2f}s, concurrency: {report["concurrency"]}, '
+                 f'peak traced memory: {_format_size(report["peak_traced_memory"])}, '
+                 f'peak rss: {_format_size(report["peak_rss"])}')
+    return '\n'.join(lines)
+
+
+def compare_reports(baseline: dict, report: dict, tolerance: float = 0.2) -> List[str]:
+    regressions = []
+    for command, item in report['commands'].items():
+        base_item = baseline['commands'].get(command)
+        if not base_item:
+            continue
+        for key in ['p50', 'p95']:
+            if item[key] > base_item[key] * (1 + tolerance):
+                regressions.append(f'{command} {key}: {base_item[key]:.3f}s -> {item[key]:.3f}s')
+        for key, value in item['upstream_per_run'].items():
+            base_value = base_item['upstream_per_run'].get(key, 0)
+            if value > base_value * (1 + tolerance):
+                regressions.append(f'{command} {key} requests/run: {base_value:g} -> {value:g}')
+        if base_item['peak_memory'] and item['peak_memory'] > base_item['peak_memory'] * (1 + tolerance):
+            regressions.append(f'{command} peak memory: {_format_size(base_item["peak_memory"])} -> '
+                               f'{_format_size(item["peak_memory"])}')
+    return regressions
@@ -1,56 +1,687 @@
 import ast
+import io
+import logging
 import math
+import multiprocessing
 import operator
+import os
+import re
+import threading
+import time
+from functools import lru_cache, reduce
+from typing import Callable, Any, Optional, List, Tuple, Dict
+
+import numpy as np
+
+from maid_assistant.utils.env import get_int_env, get_float_env
+
+_MAX_EXPR_LENGTH = 1000
+_MAX_DEPTH = 64
+_MAX_STEPS = 10000
+_MAX_INT_BITS = 4096
+_MAX_STR_LENGTH = 1000
+_MAX_FACTORIAL = 1000
+_MAX_COMB = 10000
+_MAX_RANGE_POINTS = 1000000
+# points * nodes, every node creates a temporary array when evaluating over a range
+_MAX_RANGE_CELLS = 50000000
+_DEFAULT_RANGE_POINTS = 1001
+
+
+class CalcLimitError(ValueError):
+    pass
+
+
+class CalcTimeoutError(CalcLimitError):
+    pass
+
+
+def _check_value(value):
+    if isinstance(value, int) and value.bit_length() > _MAX_INT_BITS:
+        raise CalcLimitError(f'Integer result too large, more than {_MAX_INT_BITS} bits.')
+    elif isinstance(value, str) and len(value) > _MAX_STR_LENGTH:
+        raise CalcLimitError(f'String result too long, more than {_MAX_STR_LENGTH} characters.')
+    return value
+
+
+def _checked_pow(a, b):
+    # check before calculating, 9 ** 9 ** 9 takes forever to finish
+    if isinstance(a, int) and isinstance(b, int) and b > 0 and abs(a) > 1 and \
+            b * math.log2(abs(a)) > _MAX_INT_BITS:
+        raise CalcLimitError(f'Power result too large, more than {_MAX_INT_BITS} bits.')
+    return operator.pow(a, b)
+
+
+def _checked_mul(a, b):
+    if isinstance(a, int) and isinstance(b, int) and a.bit_length() + b.bit_length() > _MAX_INT_BITS + 1:
+        raise CalcLimitError(f'Product too large, more than {_MAX_INT_BITS} bits.')
+    if isinstance(a, str) or isinstance(b, str):
+        text, times = (a, b) if isinstance(a, str) else (b, a)
+        if isinstance(times, int) and len(text) * times > _MAX_STR_LENGTH:
+            raise CalcLimitError(f'String result too long, more than {_MAX_STR_LENGTH} characters.')
+    return operator.mul(a, b)
+
 
 # 允许的运算符
 allowed_operators = {
     ast.Add: operator.add,
     ast.Sub: operator.sub,
-    ast.Mult: operator.mul,
+    ast.Mult: _checked_mul,
     ast.Div: operator.truediv,
-    ast.Pow: operator.pow,
+    ast.Pow: _checked_pow,
     ast.Mod: operator.mod,
     ast.FloorDiv: operator.floordiv
 }
 
+
+def _logical_not(x):
+    return np.logical_not(x) if isinstance(x, np.ndarray) else not x
+
+
+allowed_unary_operators = {
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+    ast.Not: _logical_not,
+}
+
+allowed_comparators = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+}
+
+
+def _checked_factorial(x):
+    if isinstance(x, int) and x > _MAX_FACTORIAL:
+        raise CalcLimitError(f'Factorial of number larger than {_MAX_FACTORIAL} is not allowed.')
+    return math.factorial(x)
+
+
+def _make_checked_comb(func):
+    def _checked(n, *args):
+        if isinstance(n, int) and n > _MAX_COMB:
+            raise CalcLimitError(f'{func.__name__} of number larger than {_MAX_COMB} is not allowed.')
+        return func(n, *args)
+
+    return _checked
+
+
 # 允许的数学函数
 allowed_math_functions = {
-    name: getattr(math, name)
-    for name in dir(math) if callable(getattr(math, name))
+    **{name: getattr(math, name) for name in dir(math) if callable(getattr(math, name))},
+    'factorial': _checked_factorial,
+    'comb': _make_checked_comb(math.comb),
+    'perm': _make_checked_comb(math.perm),
+    'abs': abs,
+    'round': round,
+    'min': min,
+    'max': max,
+    'int': int,
+    'float': float,
 }
 
 
-def safe_eval(expr):
-    node = ast.parse(expr, mode='eval').body
+def _vector_log(x, base=None):
+    return np.log(x) if base is None else np.log(x) / np.log(base)
 
-    def eval_(node):
-        if isinstance(node, ast.Num):  # number
-            return node.n
-        elif isinstance(node, ast.Str):  # string
-            return node.s
-        elif isinstance(node, ast.BinOp):  # binary operator
-            if type(node.op) in allowed_operators:
-                return allowed_operators[type(node.op)](eval_(node.left), eval_(node.right))
-            else:
-                raise ValueError(f"Unsupported operator: {type(node.op).__name__}")
-        elif isinstance(node, ast.UnaryOp):  # unary operator
-            if isinstance(node.op, ast.USub):
-                return -eval_(node.operand)
-            if isinstance(node.op, ast.UAdd):
-                return +eval_(node.operand)
-            else:
-                raise ValueError(f"Unsupported unary operator: {type(node.op).__name__}")
-        elif isinstance(node, ast.Call):  # function call
-            if node.func.id in allowed_math_functions:
-                func = allowed_math_functions[node.func.id]
-                arg = eval_(*node.args)
-                return func(arg)
+
+# numpy versions of the math functions, used when the arguments are arrays
+vector_functions = {
+    **{name: getattr(np, name) for name in [
+        'sin', 'cos', 'tan', 'sinh', 'cosh', 'tanh', 'exp', 'expm1', 'log2', 'log10', 'log1p', 'sqrt', 'cbrt',
+        'fabs', 'floor', 'ceil', 'trunc', 'hypot', 'copysign', 'fmod', 'degrees', 'radians',
+        'isnan', 'isinf', 'isfinite', 'sign',
+    ]},
+    'asin': np.arcsin,
+    'acos': np.arccos,
+    'atan': np.arctan,
+    'asinh': np.arcsinh,
+    'acosh': np.arccosh,
+    'atanh': np.arctanh,
+    'atan2': np.arctan2,
+    'log': _vector_log,
+    'pow': np.power,
+    'abs': np.abs,
+    'round': np.round,
+    'min': lambda *args: reduce(np.minimum, args),
+    'max': lambda *args: reduce(np.maximum, args),
+    'int': np.trunc,
+    'float': lambda x: np.asarray(x, dtype=np.float64),
+}
+
+allowed_constants = {
+    'pi': math.pi,
+    'e': math.e,
+    'tau': math.tau,
+    'inf': math.inf,
+    'nan': math.nan,
+}
+
+
+class _Budget:
+    def __init__(self, max_steps: int, timeout: Optional[float], variables: Optional[Dict[str, Any]] = None):
+        self.steps = max_steps
+        self.deadline = time.monotonic() + timeout if timeout is not None else None
+        self.variables = variables or {}
+
+    def step(self):
+        self.steps -= 1
+        if self.steps < 0:
+            raise CalcLimitError('Too many calculation steps.')
+        if self.deadline is not None and not self.steps % 64 and time.monotonic() > self.deadline:
+            raise CalcTimeoutError('Calculation timed out.')
+
+
+_Compiled = Callable[[_Budget], Any]
+
+
+def _make_vector_call(name: str):
+    scalar_func, vector_func = allowed_math_functions.get(name), vector_functions.get(name)
+
+    def _vector_call(*args):
+        if any(isinstance(arg, np.ndarray) for arg in args):
+            if vector_func is None:
+                raise ValueError(f'Function {name} is not supported over ranges.')
+            return vector_func(*args)
+        else:
+            return (scalar_func or vector_func)(*args)
+
+    return _vector_call
+
+
+def _compile_node(node, depth: int = 0, variables: Tuple[str, ...] = ()) -> _Compiled:
+    if depth > _MAX_DEPTH:
+        raise CalcLimitError(f'Expression too deep, more than {_MAX_DEPTH} levels.')
+
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float, complex, str)):
+        value = _check_value(node.value)
+        return lambda budget: value
+    elif isinstance(node, ast.Name):
+        if node.id in variables:
+            name = node.id
+            return lambda budget: budget.variables[name]
+        if node.id not in allowed_constants:
+            raise ValueError(f"Unknown name: {node.id}")
+        value = allowed_constants[node.id]
+        return lambda budget: value
+    elif isinstance(node, ast.BinOp):
+        if type(node.op) not in allowed_operators:
+            raise ValueError(f"Unsupported operator: {type(node.op).__name__}")
+        op = allowed_operators[type(node.op)]
+        left = _compile_node(node.left, depth + 1, variables)
+        right = _compile_node(node.right, depth + 1, variables)
+
+        def _binop(budget):
+            budget.step()
+            return _check_value(op(left(budget), right(budget)))
+
+        return _binop
+    elif isinstance(node, ast.UnaryOp):
+        if type(node.op) not in allowed_unary_operators:
+            raise ValueError(f"Unsupported unary operator: {type(node.op).__name__}")
+        op, operand = allowed_unary_operators[type(node.op)], _compile_node(node.operand, depth + 1, variables)
+
+        def _unaryop(budget):
+            budget.step()
+            return op(operand(budget))
+
+        return _unaryop
+    elif isinstance(node, ast.Compare):
+        for op in node.ops:
+            if type(op) not in allowed_comparators:
+                raise ValueError(f"Unsupported comparator: {type(op).__name__}")
+        ops = [allowed_comparators[type(op)] for op in node.ops]
+        left = _compile_node(node.left, depth + 1, variables)
+        comparators = [_compile_node(item, depth + 1, variables) for item in node.comparators]
+
+        def _compare(budget):
+            # chained, 1 < x < 3 means 1 < x and x < 3
+            budget.step()
+            a, result = left(budget), True
+            for op, comparator in zip(ops, comparators):
+                b = comparator(budget)
+                r = op(a, b)
+                if isinstance(r, np.ndarray):
+                    result = np.logical_and(result, r)
+                elif not r:
+                    return False
+                a = b
+            return result
+
+        return _compare
+    elif isinstance(node, ast.BoolOp):
+        values = [_compile_node(item, depth + 1, variables) for item in node.values]
+        is_and = isinstance(node.op, ast.And)
+
+        def _boolop(budget):
+            budget.step()
+            result = values[0](budget)
+            for value in values[1:]:
+                if isinstance(result, np.ndarray):
+                    # element-wise, no short circuit for arrays
+                    result = (np.logical_and if is_and else np.logical_or)(result, value(budget))
+                elif bool(result) != is_and:
+                    break
+                else:
+                    result = value(budget)
+            return result
+
+        return _boolop
+    elif isinstance(node, ast.Call):
+        if not isinstance(node.func, ast.Name):
+            raise ValueError(f"Unsupported function call: {ast.unparse(node.func)}")
+        if node.func.id not in allowed_math_functions and \
+                (not variables or node.func.id not in vector_functions):
+            raise ValueError(f"Unsupported function call: {node.func.id}")
+        if node.keywords or any(isinstance(arg, ast.Starred) for arg in node.args):
+            raise ValueError(f"Only positional arguments are supported: {node.func.id}")
+        if variables:
+            func = _make_vector_call(node.func.id)
+        else:
+            func = allowed_math_functions[node.func.id]
+        args = [_compile_node(arg, depth + 1, variables) for arg in node.args]
+
+        def _call(budget):
+            budget.step()
+            return _check_value(func(*(arg(budget) for arg in args)))
+
+        return _call
+    else:
+        raise ValueError(f"Not allowed expression type - {type(node).__name__}")
+
+
+def _parse_expression(expr: str):
+    if len(expr) > _MAX_EXPR_LENGTH:
+        raise CalcLimitError(f'Expression too long, more than {_MAX_EXPR_LENGTH} characters.')
+    try:
+        return ast.parse(expr.strip(), mode='eval').body
+    except (SyntaxError, RecursionError, MemoryError) as err:
+        raise ValueError(f'Invalid expression - {err}')
+
+
+@lru_cache(maxsize=1024)
+def compile_expression(expr: str) -> _Compiled:
+    # the same expressions are asked again and again, parse and validate them only once
+    return _compile_node(_parse_expression(expr))
+
+
+def safe_eval(expr, max_steps: int = _MAX_STEPS, timeout: Optional[float] = None):
+    return compile_expression(expr)(_Budget(max_steps, timeout))
+
+
+# e.g. sin(x) * x for x in 0..10 step 0.01
+_RANGE_PATTERN = re.compile(
+    r'^\s*(?P<expr>.+?)\s+for\s+(?P<var>[A-Za-z_]\w*)\s+in\s+(?P<start>.+?)\s*\.\.\s*(?P<stop>.+?)'
+    r'(?:\s+step\s+(?P<step>.+?))?\s*$',
+    re.DOTALL
+)
+
+
+def is_range_expression(expr: str) -> bool:
+    return bool(_RANGE_PATTERN.match(expr))
+
+
+def _range_bound(func: _Compiled, budget: _Budget, name: str) -> float:
+    value = func(budget)
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        raise ValueError(f'Range {name} should be a finite real number, but {value!r} found.')
+    return float(value)
+
+
+class _RangeExpression:
+    def __init__(self, func: _Compiled, nodes: int, variable: str,
+                 start: _Compiled, stop: _Compiled, step: Optional[_Compiled]):
+        self.func = func
+        self.nodes = nodes
+        self.variable = variable
+        self.start = start
+        self.stop = stop
+        self.step = step
+
+    def xs(self, budget: _Budget) -> np.ndarray:
+        start, stop = _range_bound(self.start, budget, 'start'), _range_bound(self.stop, budget, 'stop')
+        if not math.isfinite(stop - start):
+            raise CalcLimitError(f'Range from {start} to {stop} is too wide.')
+        if self.step is not None:
+            step = _range_bound(self.step, budget, 'step')
+            if step == 0:
+                raise ValueError('Range step should not be 0.')
+            # the overflowed ones are limited here as well, math.floor fails on them
+            span = (stop - start) / step
+            if not span < _MAX_RANGE_POINTS:
+                raise CalcLimitError(f'Too many points in range, more than {_MAX_RANGE_POINTS}.')
+            # stop is included, with tolerance for the float steps like 0.1
+            points = math.floor(span + 1e-9) + 1
+            if points < 1:
+                raise ValueError(f'Empty range from {start} to {stop} with step {step}.')
+        elif start == stop:
+            points, step = 1, 1.0
+        else:
+            points = _DEFAULT_RANGE_POINTS
+            step = (stop - start) / (points - 1)
+
+        # check before allocating any array
+        if points > _MAX_RANGE_POINTS:
+            raise CalcLimitError(f'Too many points in range, more than {_MAX_RANGE_POINTS}.')
+        if points * self.nodes > _MAX_RANGE_CELLS:
+            raise CalcLimitError(f'Range expression too large, {points} points with {self.nodes} nodes '
+                                 f'is more than {_MAX_RANGE_CELLS} cells.')
+        return start + np.arange(points, dtype=np.float64) * step
+
+
+@lru_cache(maxsize=256)
+def compile_range_expression(expr: str) -> _RangeExpression:
+    if len(expr) > _MAX_EXPR_LENGTH:
+        raise CalcLimitError(f'Expression too long, more than {_MAX_EXPR_LENGTH} characters.')
+    matching = _RANGE_PATTERN.match(expr)
+    if not matching:
+        raise ValueError('Invalid range expression, should be like `sin(x) for x in 0..10 step 0.01`.')
+
+    node = _parse_expression(matching.group('expr'))
+    variable = matching.group('var')
+    return _RangeExpression(
+        func=_compile_node(node, variables=(variable,)),
+        nodes=sum(1 for _ in ast.walk(node)),
+        variable=variable,
+        start=compile_expression(matching.group('start')),
+        stop=compile_expression(matching.group('stop')),
+        step=compile_expression(matching.group('step')) if matching.group('step') else None,
+    )
+
+
+def _render_chart(xs: np.ndarray, ys: np.ndarray, title: str, width: int = 800, height: int = 450) -> Optional[bytes]:
+    from PIL import Image, ImageDraw
+
+    finite = np.isfinite(ys)
+    if not finite.any():
+        return None
+    if xs[0] > xs[-1]:
+        xs, ys, finite = xs[::-1], ys[::-1], finite[::-1]
+    x_min, x_max = float(xs[0]), float(xs[-1])
+    if x_min == x_max:
+        x_min, x_max = x_min - 1, x_max + 1
+    y_min, y_max = float(ys[finite].min()), float(ys[finite].max())
+    if y_min == y_max:
+        y_min, y_max = y_min - 1, y_max + 1
+
+    left, right, top, bottom = 70, width - 20, 30, height - 30
+    image = Image.new('RGB', (width, height), 'white')
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((left, top, right, bottom), outline=(160, 160, 160))
+    if y_min < 0 < y_max:
+        zero_y = bottom - (0 - y_min) / (y_max - y_min) * (bottom - top)
+        draw.line(((left, zero_y), (right, zero_y)), fill=(210, 210, 210))
+    if x_min < 0 < x_max:
+        zero_x = left + (0 - x_min) / (x_max - x_min) * (right - left)
+        draw.line(((zero_x, top), (zero_x, bottom)), fill=(210, 210, 210))
+
+    px = left + (xs - x_min) / (x_max - x_min) * (right - left)
+    py = bottom - (ys - y_min) / (y_max - y_min) * (bottom - top)
+    color = (52, 101, 164)
+    # the non-finite values break the curve into segments
+    for segment in np.split(np.arange(len(xs)), np.flatnonzero(~finite)):
+        segment = segment[finite[segment]]
+        if len(segment) == 0:
+            continue
+        elif len(segment) == 1:
+            draw.point((float(px[segment[0]]), float(py[segment[0]])), fill=color)
+        elif len(segment) > 2 * (right - left):
+            # too many points, draw the min-max envelope of each pixel column instead
+            columns, first = np.unique(np.round(px[segment]).astype(int), return_index=True)
+            lows, highs = np.minimum.reduceat(py[segment], first), np.maximum.reduceat(py[segment], first)
+            for column, low, high in zip(columns.tolist(), lows.tolist(), highs.tolist()):
+                draw.line(((column, low), (column, high)), fill=color, width=2)
+            draw.line(list(zip(columns.tolist(), py[segment][first].tolist())), fill=color, width=2)
+        else:
+            draw.line(list(zip(px[segment].tolist(), py[segment].tolist())), fill=color, width=2)
+
+    text_color = (80, 80, 80)
+    draw.text((left, 8), title if len(title) <= 100 else f'{title[:97]}...', fill=text_color)
+    draw.text((5, top), f'{y_max:.4g}', fill=text_color)
+    draw.text((5, bottom - 10), f'{y_min:.4g}', fill=text_color)
+    draw.text((left, bottom + 8), f'{x_min:.4g}', fill=text_color)
+    x_max_text = f'{x_max:.4g}'
+    draw.text((right - draw.textlength(x_max_text), bottom + 8), x_max_text, fill=text_color)
+
+    with io.BytesIO() as f:
+        image.save(f, format='PNG', optimize=True)
+        return f.getvalue()
+
+
+class RangeResult:
+    def __init__(self, expr: str, variable: str, xs: np.ndarray, ys: np.ndarray, chart: Optional[bytes] = None):
+        # only the summary is kept, the arrays are too large to send back from the workers
+        self.expr = expr
+        self.variable = variable
+        self.points = len(xs)
+        self.start, self.stop = float(xs[0]), float(xs[-1])
+        finite = np.isfinite(ys)
+        self.non_finite = int(self.points - finite.sum())
+        if finite.any():
+            values = np.where(finite, ys, np.nan)
+            min_index, max_index = int(np.nanargmin(values)), int(np.nanargmax(values))
+            self.min = (float(xs[min_index]), float(ys[min_index]))
+            self.max = (float(xs[max_index]), float(ys[max_index]))
+            self.mean, self.std = float(np.nanmean(values)), float(np.nanstd(values))
+        else:
+            self.min, self.max, self.mean, self.std = None, None, None, None
+        if self.points > 1 and not self.non_finite:
+            self.integral = float(np.sum((ys[1:] + ys[:-1]) * np.diff(xs)) / 2)
+        else:
+            self.integral = None
+        indices = np.unique(np.linspace(0, self.points - 1, min(self.points, 11)).round().astype(int))
+        self.samples = [(float(xs[i]), float(ys[i])) for i in indices.tolist()]
+        self.chart = chart
+
+    def __str__(self):
+        v = self.variable
+        lines = [f'{v} in {self.start:.6g} .. {self.stop:.6g}, {self.points} points']
+        if self.min is not None:
+            lines.append(f'min: {self.min[1]:.6g} at {v} = {self.min[0]:.6g}')
+            lines.append(f'max: {self.max[1]:.6g} at {v} = {self.max[0]:.6g}')
+            lines.append(f'mean: {self.mean:.6g}, std: {self.std:.6g}')
+        if self.integral is not None:
+            lines.append(f'integral: {self.integral:.6g}')
+        if self.non_finite:
+            lines.append(f'non-finite values: {self.non_finite}')
+        lines.append('')
+        lines.append(f'{v:>12} | value')
+        for x, y in self.samples:
+            lines.append(f'{x:>12.6g} | {y:.6g}')
+        return '\n'.join(lines)
+
+
+def range_eval(expr: str, max_steps: int = _MAX_STEPS, timeout: Optional[float] = None,
+               chart: bool = False) -> RangeResult:
+    compiled = compile_range_expression(expr)
+    budget = _Budget(max_steps, timeout)
+    xs = compiled.xs(budget)
+    budget.variables[compiled.variable] = xs
+    # inf and nan are expected over ranges, e.g. log(x) for x in -1..1
+    with np.errstate(all='ignore'):
+        ys = np.asarray(compiled.func(budget))
+    if ys.dtype.kind not in 'biuf':
+        raise ValueError(f'Range expression should be evaluated to real numbers, but {ys.dtype} found.')
+    ys = np.broadcast_to(ys.astype(np.float64), xs.shape)
+    return RangeResult(
+        expr=expr,
+        variable=compiled.variable,
+        xs=xs,
+        ys=ys,
+        chart=_render_chart(xs, ys, expr) if chart else None,
+    )
+
+
+def calc_eval(expr: str, max_steps: int = _MAX_STEPS, timeout: Optional[float] = None, chart: bool = False):
+    if is_range_expression(expr):
+        return range_eval(expr, max_steps=max_steps, timeout=timeout, chart=chart)
+    elif chart:
+        raise ValueError('Only range expressions can be plotted, e.g. `sin(x) for x in 0..2*pi`.')
+    else:
+        return safe_eval(expr, max_steps=max_steps, timeout=timeout)
+
+
+def compile_calc_expression(expr: str):
+    if is_range_expression(expr):
+        return compile_range_expression(expr)
+    else:
+        return compile_expression(expr)
+
+
+def _limit_memory(max_memory: int):
+    # limit the address space growth of the worker, so huge allocations fail in the worker only
+    try:
+        import resource
+        with open('/proc/self/statm', 'r') as f:
+            current = int(f.read().split()[0]) * os.sysconf('SC_PAGE_SIZE')
+        resource.setrlimit(resource.RLIMIT_AS, (current + max_memory, current + max_memory))
+    except (ImportError, OSError, ValueError) as err:
+        logging.warning(f'Unable to limit memory of calc worker - {err!r}')
+
+
+def _worker_main(conn, max_memory: Optional[int]):
+    if max_memory:
+        _limit_memory(max_memory)
+    conn.send('ready')
+    while True:
+        try:
+            expr, max_steps, timeout, chart = conn.recv()
+        except (EOFError, OSError):
+            break
+
+        try:
+            retval = ('ok', calc_eval(expr, max_steps=max_steps, timeout=timeout, chart=chart))
+        except Exception as err:
+            retval = ('error', err)
+        try:
+            conn.send(retval)
+        except Exception as err:
+            # the error or result may be not picklable, only the error type and message are sent then
+            status, value = retval
+            if status == 'error':
+                conn.send(('error', ValueError(f'{type(value).__name__}: {value}')))
             else:
-                raise ValueError(f"Unsupported function call: {node.func.id}")
+                conn.send(('error', ValueError(f'Unable to send the result - {type(err).__name__}: {err}')))
+
+
+class IsolatedEvaluator:
+    def __init__(self, processes: int = 2, timeout: float = 3.0, max_steps: int = _MAX_STEPS,
+                 max_memory: Optional[int] = 256 * 1024 ** 2, grace: float = 0.5, startup_timeout: float = 60.0):
+        self.processes = processes
+        self.timeout = timeout
+        self.max_steps = max_steps
+        self.max_memory = max_memory
+        # the cooperative timeout in worker goes first, killing is for the calculations that can not be interrupted
+        self.grace = grace
+        self.startup_timeout = startup_timeout
+
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            # workers are forked with this module loaded, so the killed ones are replaced quickly,
+            # the main module is not preloaded, which may be the whole bot
+            self._context = multiprocessing.get_context('forkserver')
+            self._context.set_forkserver_preload([__name__])
+        else:
+            self._context = multiprocessing.get_context('spawn')
+        self._slots = threading.BoundedSemaphore(processes)
+        self._lock = threading.Lock()
+        self._idle: List[Tuple[Any, Any]] = []
+        self._killed = 0
+
+    def _start_worker(self):
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(target=_worker_main, args=(child_conn, self.max_memory),
+                                        name='maid_calc', daemon=True)
+        process.start()
+        child_conn.close()
+        # wait until the worker is ready, the startup time should not be counted as calculation time
+        try:
+            ready = parent_conn.poll(self.startup_timeout) and parent_conn.recv() == 'ready'
+        except (EOFError, OSError):
+            # died when starting, e.g. killed by the memory limit
+            ready = False
+        if not ready:
+            self._kill_worker((process, parent_conn))
+            raise RuntimeError('Calculation worker failed to start.')
+        return process, parent_conn
+
+    def _kill_worker(self, worker):
+        process, conn = worker
+        process.kill()
+        process.join(timeout=1.0)
+        conn.close()
+        with self._lock:
+            self._killed += 1
+
+    def evaluate(self, expr: str, chart: bool = False):
+        # invalid expressions fail here, without bothering the workers
+        compile_calc_expression(expr)
+
+        with self._slots:
+            with self._lock:
+                worker = self._idle.pop() if self._idle else None
+            if worker is None or not worker[0].is_alive():
+                worker = self._start_worker()
+
+            process, conn = worker
+            try:
+                conn.send((expr, self.max_steps, self.timeout, chart))
+                if not conn.poll(self.timeout + self.grace):
+                    self._kill_worker(worker)
+                    worker = None
+                    raise CalcTimeoutError(f'Calculation timed out after {self.timeout:.1f}s.')
+                status, value = conn.recv()
+            except (EOFError, OSError):
+                # usually killed by the memory limit
+                self._kill_worker(worker)
+                worker = None
+                raise CalcLimitError('Calculation worker crashed, the expression may need too much memory.')
+            finally:
+                if worker is not None:
+                    with self._lock:
+                        # the prewarmed workers may be more than needed
+                        keep = len(self._idle) < self.processes
+                        if keep:
+                            self._idle.append(worker)
+                    if not keep:
+                        process.terminate()
+                        conn.close()
+
+        if status == 'ok':
+            return value
         else:
-            raise ValueError(f"Not allowed expression type - {type(node).__name__}")
+            raise value
+
+    def prewarm(self):
+        while True:
+            with self._lock:
+                if len(self._idle) >= self.processes:
+                    break
+            worker = self._start_worker()
+            with self._lock:
+                self._idle.append(worker)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'idle': len(self._idle),
+                'killed': self._killed,
+            }
+
+
+@lru_cache()
+def get_calc_evaluator() -> IsolatedEvaluator:
+    return IsolatedEvaluator(
+        processes=get_int_env('MAID_CALC_PROCESSES', 2),
+        timeout=get_float_env('MAID_CALC_TIMEOUT', 3.0),
+        max_memory=get_int_env('MAID_CALC_MEMORY', 256 * 1024 ** 2),
+    )
+
 
-    return eval_(node)
+def isolated_eval(expr: str, chart: bool = False):
+    return get_calc_evaluator().evaluate(expr, chart=chart)
 
 
 if __name__ == '__main__':
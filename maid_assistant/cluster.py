@@ -0,0 +1,160 @@
+import argparse
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+from typing import List, Dict, Optional
+
+import httpx
+
+
+def get_recommended_shards(token: str) -> int:
+    resp = httpx.get('https://discord.com/api/v10/gateway/bot',
+                     headers={'Authorization': f'Bot {token}'}, timeout=15.0)
+    resp.raise_for_status()
+    return resp.json()['shards']
+
+
+def plan_processes(processes: int, shard_count: int, workers: int = 0,
+                   metrics_port: Optional[int] = None) -> List[Dict[str, str]]:
+    # shards are spread over the processes, e.g. 8 shards in 3 processes: [0, 3, 6], [1, 4, 7], [2, 5]
+    processes = max(min(processes, shard_count), 1)
+    envs = []
+    for i in range(processes):
+        env = {
+            'MAID_PROCESS_ROLE': 'shard',
+            'MAID_SHARD_COUNT': str(shard_count),
+            'MAID_SHARD_IDS': ','.join(map(str, range(i, shard_count, processes))),
+        }
+        if workers > 0:
+            # the download jobs are left to the worker processes
+            env['MAID_DOWNLOAD_JOB_WORKERS'] = '0'
+        envs.append(env)
+    for _ in range(workers):
+        envs.append({'MAID_PROCESS_ROLE': 'worker'})
+
+    if metrics_port:
+        for i, env in enumerate(envs):
+            env['MAID_METRICS_PORT'] = str(metrics_port + i)
+    return envs
+
+
+class _Child:
+    def __init__(self, index: int, env: Dict[str, str]):
+        self.index = index
+        self.env = env
+        self.process: Optional[subprocess.Popen] = None
+        self.started_at = 0.0
+        self.restart_delay = 0.0
+        self.restart_at: Optional[float] = None
+
+    @property
+    def name(self) -> str:
+        if self.env['MAID_PROCESS_ROLE'] == 'shard':
+            return f'shard process #{self.index} (shards {self.env["MAID_SHARD_IDS"]})'
+        else:
+            return f'worker process #{self.index}'
+
+
+class ClusterSupervisor:
+    def __init__(self, script: str, envs: List[Dict[str, str]], start_interval: float = 5.0,
+                 min_restart_delay: float = 5.0, max_restart_delay: float = 300.0, stop_timeout: float = 30.0):
+        self.script = script
+        self.children = [_Child(i, env) for i, env in enumerate(envs)]
+        # shards connected at the same time may hit the identify limit of discord
+        self.start_interval = start_interval
+        self.min_restart_delay = min_restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.stop_timeout = stop_timeout
+        self._stopping = False
+
+    def _spawn(self, child: _Child):
+        logging.info(f'Starting {child.name} ...')
+        child.process = subprocess.Popen([sys.executable, self.script], env={**os.environ, **child.env})
+        child.started_at = time.monotonic()
+        child.restart_at = None
+
+    def _check(self, child: _Child):
+        if child.restart_at is not None:
+            if time.monotonic() >= child.restart_at:
+                self._spawn(child)
+            return
+
+        returncode = child.process.poll()
+        if returncode is None:
+            return
+        # restarted with backoff, the delay is reset after it has been running for a while
+        if time.monotonic() - child.started_at > self.max_restart_delay:
+            child.restart_delay = self.min_restart_delay
+        else:
+            child.restart_delay = min(max(child.restart_delay * 2, self.min_restart_delay), self.max_restart_delay)
+        logging.warning(f'{child.name.capitalize()} exited with code {returncode}, '
+                        f'restarting in {child.restart_delay:.1f}s ...')
+        child.restart_at = time.monotonic() + child.restart_delay
+
+    def stop(self, *_):
+        self._stopping = True
+
+    def _shutdown(self):
+        running = [child.process for child in self.children if child.process and child.process.poll() is None]
+        logging.info(f'Stopping {len(running)} process(es) ...')
+        for process in running:
+            process.terminate()
+        deadline = time.monotonic() + self.stop_timeout
+        for process in running:
+            try:
+                process.wait(timeout=max(deadline - time.monotonic(), 0.1))
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        try:
+            for i, child in enumerate(self.children):
+                if self._stopping:
+                    break
+                if i and child.env['MAID_PROCESS_ROLE'] == 'shard':
+                    time.sleep(self.start_interval)
+                self._spawn(child)
+
+            while not self._stopping:
+                for child in self.children:
+                    self._check(child)
+                time.sleep(1.0)
+        finally:
+            self._shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m maid_assistant.cluster',
+                                     description='Run the bot as sharded processes with job worker processes, '
+                                                 'which share the cache and job queue in MAID_CACHE_DIR.')
+    parser.add_argument('--script', default='app.py', help='Script of the bot.')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, help='Shard processes.')
+    parser.add_argument('--shards', default=None,
+                        help='Total shards, `auto` for the number recommended by discord, '
+                             'the same as processes by default.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Job worker processes, 0 to run the download jobs in the shard processes.')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='Metrics port of the first process, the others use the following ports.')
+    parser.add_argument('--start-interval', type=float, default=5.0, help='Seconds between starting shard processes.')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s %(message)s')
+
+    if args.shards == 'auto':
+        shard_count = get_recommended_shards(os.environ['DC_BOT_TOKEN'])
+        logging.info(f'{shard_count} shard(s) recommended by discord.')
+    else:
+        shard_count = int(args.shards) if args.shards else args.processes
+
+    envs = plan_processes(args.processes, shard_count, workers=args.workers, metrics_port=args.metrics_port)
+    ClusterSupervisor(args.script, envs, start_interval=args.start_interval).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,26 @@
+import hashlib
 import io
 import json
 import logging
+import math
 import os
 import re
-from typing import Optional
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Dict, Iterator, Tuple
 
-from hbutils.string import ordinalize
+from hbutils.string import ordinalize, plural_word
 from requests import JSONDecodeError
 from rich.errors import MarkupError
-from waifuc.utils import srequest
 
-from maid_assistant.utils import get_openai_client, get_llm_default_model, get_danbooru_session
+from maid_assistant.utils import get_openai_client, get_llm_default_model, get_danbooru_client, get_cache, \
+    get_llm_input_token_budget, count_tokens, truncate_tokens, get_wiki_index, normalize_wiki_title, get_metrics, \
+    get_danbooru_base_url
+from maid_assistant.utils.env import get_int_env
 
 
-def ask_chatgpt(message: str, lang: str = 'english', model_name: Optional[str] = None):
-    client = get_openai_client()
-    model_name = model_name or get_llm_default_model()
-
-    _system_text = f"""
+def _get_system_text(lang: str) -> str:
+    return f"""
 I have an anime image dataset that contains many image labels. 
 When I provide an image label, containing its name and its wiki description text, 
 you need to translate the label into explicit {lang}, as accurate as you can, as provide the {lang} description in a paragraph.
@@ -56,23 +59,57 @@ You answer:
 
 <{lang} description>
 """
+
+
+def ask_chatgpt(message: str, lang: str = 'english', model_name: Optional[str] = None):
+    client = get_openai_client()
+    model_name = model_name or get_llm_default_model()
+    _system_text = _get_system_text(lang)
+
     logging.info(f'Asking LLM model {model_name!r} ...')
-    response = client.chat.completions.create(
+    with get_metrics().timer('maid_llm_seconds', mode='plain', model=model_name):
+        response = client.chat.completions.create(
+            model=model_name,
+            messages=[
+                {'role': 'system', 'content': _system_text},
+                {"role": "user", "content": message},
+            ],
+        )
+    return response.choices[0].message.content.strip()
+
+
+def ask_chatgpt_stream(message: str, lang: str = 'english', model_name: Optional[str] = None) -> Iterator[str]:
+    client = get_openai_client()
+    model_name = model_name or get_llm_default_model()
+    logging.info(f'Asking LLM model {model_name!r} in streaming mode ...')
+    metrics = get_metrics()
+    start_time, first_token = time.perf_counter(), True
+    stream = client.chat.completions.create(
         model=model_name,
         messages=[
-            {'role': 'system', 'content': _system_text},
+            {'role': 'system', 'content': _get_system_text(lang)},
             {"role": "user", "content": message},
         ],
+        stream=True,
     )
-    return response.choices[0].message.content.strip()
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            if first_token:
+                metrics.observe('maid_llm_first_token_seconds', time.perf_counter() - start_time, model=model_name)
+                first_token = False
+            yield chunk.choices[0].delta.content
+    metrics.observe('maid_llm_seconds', time.perf_counter() - start_time, mode='stream', model=model_name)
 
 
-def _get_desc_by_wiki_data(data, tag=None, use_other_names: bool = False):
+def _get_desc_by_wiki_data(data, tag=None, use_other_names: bool = False, max_tokens: Optional[int] = None,
+                           model_name: Optional[str] = None):
     with io.StringIO() as sf:
         print(f'Tag: {tag or data["title"]}', file=sf)
         if use_other_names and data['other_names']:
             print(f'Other Names: {", ".join(data["other_names"])}', file=sf)
         desc = data['body']
+        if desc and max_tokens is not None:
+            desc = truncate_tokens(desc, max(max_tokens - count_tokens(sf.getvalue(), model_name), 1), model_name)
         if desc:
             print(f'Description: {desc}', file=sf)
         else:
@@ -95,67 +132,317 @@ def _extract_wiki_titles(wiki_text):
 
 
 def _get_wiki_info_by_title(title: str):
-    session = get_danbooru_session()
-    resp = srequest(session, 'GET', f'https://danbooru.donmai.us//wiki_pages.json',
-                    params={'search[title_normalize]': title}, raise_for_status=False)
-
-    if resp.json():
-        return resp.json()[0]
+    local_data = get_wiki_index().get_wiki(title)
+    if local_data:
+        return local_data
+
+    client = get_danbooru_client()
+    resp = client.get(f'{get_danbooru_base_url()}/wiki_pages.json',
+                      params={'search[title_normalize]': title}, raise_for_status=False)
+    if resp.status_code // 100 != 2:
+        logging.warning(f'Unable to fetch wiki page {title!r}, status: {resp.status_code!r}.')
+        return None
+    try:
+        data = resp.json()
+    except (JSONDecodeError, json.JSONDecodeError):
+        return None
+    if isinstance(data, list) and data and isinstance(data[0], dict):
+        return data[0]
     else:
         return None
 
 
-def _get_desc(tag: str, use_other_names: bool = False, max_refs: int = 10):
-    session = get_danbooru_session()
-    resp = srequest(session, 'GET', f'https://danbooru.donmai.us/wiki_pages/{tag}.json', raise_for_status=False)
+_WIKI_BATCH_SIZE = 20
+
+
+def _get_wiki_infos_by_batch(titles: List[str]) -> Optional[Dict[str, dict]]:
+    # None when failed, the titles not in a successful result have no wiki pages
+    client = get_danbooru_client()
+    # sent as array, so the titles containing comma are fine
+    resp = client.get(f'{get_danbooru_base_url()}/wiki_pages.json',
+                      params={'search[title_array][]': titles, 'limit': str(len(titles))},
+                      raise_for_status=False)
+    if resp.status_code // 100 != 2:
+        return None
+    try:
+        data = resp.json()
+    except (JSONDecodeError, json.JSONDecodeError):
+        return None
+    if not isinstance(data, list):
+        return None
+    return {item['title']: item for item in data if isinstance(item, dict) and item.get('title')}
+
+
+def _get_wiki_infos_by_titles(titles: List[str], max_workers: int = 4) -> Dict[str, dict]:
+    titles = list(dict.fromkeys(normalize_wiki_title(title) for title in titles))
+    titles = [title for title in titles if title]
+    retval = get_wiki_index().get_wikis(titles)
+    # most of the referred titles without wiki pages are red links, which are kept shortly
+    missing_cache = get_cache('wiki_missing')
+    titles = [title for title in titles if title not in retval and missing_cache.get(f'title|{title}') is None]
+    if not titles:
+        return retval
+
+    batches = [titles[i:i + _WIKI_BATCH_SIZE] for i in range(0, len(titles), _WIKI_BATCH_SIZE)]
+    failed_titles = []
+    with ThreadPoolExecutor(max_workers=max(min(max_workers, len(titles)), 1)) as tp:
+        for batch, result in zip(batches, tp.map(_get_wiki_infos_by_batch, batches)):
+            if result is None:
+                failed_titles.extend(batch)
+            else:
+                retval.update(result)
+                for title in batch:
+                    if title not in result:
+                        missing_cache.set(f'title|{title}', True)
+
+        if failed_titles:
+            logging.info(f'Fetching {plural_word(len(failed_titles), "wiki page")} one by one ...')
+            for title, data in zip(failed_titles, tp.map(_get_wiki_info_by_title, failed_titles)):
+                if data:
+                    retval[title] = data
+
+    return retval
+
+
+def _get_wiki_page(tag: str) -> Optional[dict]:
+    wiki_index = get_wiki_index()
+    local_data = wiki_index.get_wiki(tag)
+    if local_data:
+        return local_data
+
+    client = get_danbooru_client()
+    resp = client.get(f'{get_danbooru_base_url()}/wiki_pages/{tag}.json', raise_for_status=False)
     if resp.status_code == 404:
-        return False, f'Tag: {tag}\nNo description found.'
+        # the given tag may be one of the other names, e.g. japanese name of the character
+        return wiki_index.find_wiki_by_other_name(tag)
     else:
         resp.raise_for_status()
         try:
-            _ = resp.json()
+            return resp.json()
         except (JSONDecodeError, json.JSONDecodeError):
-            return False, f'Tag: {tag}\nNo description found.'
-
-        title_attachments = []
-        if resp.json()['body']:
-            exist_related_tag_titles = {resp.json()['title']}
-            tag_titles = _extract_wiki_titles(resp.json()['body'])
-            for title in tag_titles:
-                title_data = _get_wiki_info_by_title(title)
-                if title_data and title_data['title'] not in exist_related_tag_titles:
-                    title_attachments.append((title, title_data))
-                    exist_related_tag_titles.add(title_data['title'])
-                    if max_refs is not None and len(title_attachments) >= max_refs:
-                        break
+            return None
+
+
+def _get_ref_candidates(wiki_data: dict) -> List[Tuple[str, str]]:
+    candidates, exist_candidates = [], {wiki_data['title']}
+    if wiki_data['body']:
+        for title in _extract_wiki_titles(wiki_data['body']):
+            n_title = normalize_wiki_title(title)
+            if n_title and n_title not in exist_candidates:
+                candidates.append((title, n_title))
+                exist_candidates.add(n_title)
+    return candidates
+
+
+_TAG_BATCH_SIZE = 50
+
+
+def _get_tag_post_counts_by_batch(names: List[str]) -> Dict[str, int]:
+    client = get_danbooru_client()
+    resp = client.get(f'{get_danbooru_base_url()}/tags.json',
+                      params={'search[name_comma]': ','.join(names), 'limit': str(len(names))},
+                      raise_for_status=False)
+    if resp.status_code // 100 != 2:
+        return {}
+    try:
+        data = resp.json()
+    except (JSONDecodeError, json.JSONDecodeError):
+        return {}
+    return {item['name']: item.get('post_count') or 0 for item in data if isinstance(item, dict) and item.get('name')}
+
+
+def _get_tag_post_counts(names: List[str], max_workers: int = 4) -> Dict[str, int]:
+    names = list(dict.fromkeys(name for name in names if name and ',' not in name))
+    retval = get_wiki_index().get_post_counts(names)
+    names = [name for name in names if name not in retval]
+    batches = [names[i:i + _TAG_BATCH_SIZE] for i in range(0, len(names), _TAG_BATCH_SIZE)]
+    if batches:
+        with ThreadPoolExecutor(max_workers=max(min(max_workers, len(batches)), 1)) as tp:
+            for result in tp.map(_get_tag_post_counts_by_batch, batches):
+                retval.update(result)
+    return retval
+
+
+def _rank_attachments(title_attachments, post_counts: Dict[str, int]):
+    # the earlier mentioned and the more popular pages go first,
+    # pages which are not tags (e.g. help pages) only depend on their positions
+    def _score(x):
+        position, (_, title_data) = x
+        return math.log1p(post_counts.get(title_data['title'], 0) + 10) / (1 + 0.2 * position)
+
+    return [item for _, item in sorted(enumerate(title_attachments), key=_score, reverse=True)]
 
-        with io.StringIO() as sf:
-            found, text = _get_desc_by_wiki_data(resp.json(), tag=tag, use_other_names=use_other_names)
-            print(f'## Tag {tag!r}', file=sf)
+
+_MAIN_DESC_RATIO = 0.5
+_MIN_REF_TOKENS = 64
+
+
+def _format_desc(tag: str, wiki_data: dict, title_attachments, use_other_names: bool = False,
+                 max_tokens: Optional[int] = None, model_name: Optional[str] = None):
+    with io.StringIO() as sf:
+        found, text = _get_desc_by_wiki_data(
+            wiki_data, tag=tag, use_other_names=use_other_names,
+            max_tokens=int(max_tokens * _MAIN_DESC_RATIO) if max_tokens is not None else None,
+            model_name=model_name,
+        )
+        print(f'## Tag {tag!r}', file=sf)
+        print(f'', file=sf)
+        print(text, file=sf)
+        print(f'', file=sf)
+
+        if title_attachments:
+            print(f'## Mentioned Tags Information', file=sf)
             print(f'', file=sf)
-            print(text, file=sf)
+            print(f'The following parts are attachment tag '
+                  f'information mentioned in tag {tag!r}s description body.', file=sf)
             print(f'', file=sf)
+            for i, (title, title_data) in enumerate(title_attachments):
+                title_max_tokens = None
+                if max_tokens is not None:
+                    remaining_tokens = max_tokens - count_tokens(sf.getvalue(), model_name)
+                    if remaining_tokens < _MIN_REF_TOKENS:
+                        logging.info(f'Token budget {max_tokens!r} used up, '
+                                     f'{plural_word(len(title_attachments) - i, "mentioned tag")} skipped.')
+                        break
+                    # share the remaining budget, the unused part flows to the pages after
+                    title_max_tokens = max(remaining_tokens // (len(title_attachments) - i), _MIN_REF_TOKENS)
+
+                title_found, title_text = _get_desc_by_wiki_data(
+                    title_data, tag=title, use_other_names=use_other_names,
+                    max_tokens=title_max_tokens, model_name=model_name,
+                )
+                if title_found:
+                    print(f'### {title}', file=sf)
+                    print(f'', file=sf)
+                    print(title_text, file=sf)
+                    print(f'', file=sf)
+
+        return found, sf.getvalue()
+
+
+def _get_descs(tags: List[str], use_other_names: bool = False, max_refs: int = 10, max_workers: int = 4,
+               max_tokens: Optional[int] = None, model_name: Optional[str] = None) \
+        -> Dict[str, Tuple[bool, str, Optional[str]]]:
+    tags = list(dict.fromkeys(tags))
+    with ThreadPoolExecutor(max_workers=max(min(max_workers, len(tags)), 1)) as tp:
+        wiki_pages = dict(zip(tags, tp.map(_get_wiki_page, tags)))
+
+    # referenced pages of all the tags are fetched together, so the shared ones are only fetched once
+    candidates = {tag: _get_ref_candidates(wiki_data) for tag, wiki_data in wiki_pages.items() if wiki_data}
+    attachments = {tag: [] for tag in candidates}
+    exist_titles = {tag: {wiki_pages[tag]['title']} for tag in candidates}
+    wiki_infos = {}
+    while True:
+        current_candidates = {}
+        for tag, tag_candidates in candidates.items():
+            if tag_candidates and (max_refs is None or len(attachments[tag]) < max_refs):
+                n = len(tag_candidates) if max_refs is None else max_refs - len(attachments[tag])
+                current_candidates[tag], candidates[tag] = tag_candidates[:n], tag_candidates[n:]
+        if not current_candidates:
+            break
+
+        titles_to_fetch = [
+            n_title for tag_candidates in current_candidates.values()
+            for _, n_title in tag_candidates if n_title not in wiki_infos
+        ]
+        new_infos = _get_wiki_infos_by_titles(titles_to_fetch, max_workers=max_workers)
+        wiki_infos.update({title: new_infos.get(title) for title in titles_to_fetch})
+        for tag, tag_candidates in current_candidates.items():
+            for title, n_title in tag_candidates:
+                title_data = wiki_infos.get(n_title)
+                if title_data and title_data['title'] not in exist_titles[tag]:
+                    attachments[tag].append((title, title_data))
+                    exist_titles[tag].add(title_data['title'])
+                    if max_refs is not None and len(attachments[tag]) >= max_refs:
+                        break
+
+    if max_tokens is not None:
+        post_counts = _get_tag_post_counts([
+            title_data['title'] for tag_attachments in attachments.values() for _, title_data in tag_attachments
+        ], max_workers=max_workers)
+        attachments = {tag: _rank_attachments(tag_attachments, post_counts)
+                       for tag, tag_attachments in attachments.items()}
+
+    retval = {}
+    for tag in tags:
+        wiki_data = wiki_pages[tag]
+        if wiki_data:
+            found, text = _format_desc(tag, wiki_data, attachments[tag], use_other_names=use_other_names,
+                                       max_tokens=max_tokens, model_name=model_name)
+            retval[tag] = (found, text, wiki_data.get('updated_at'))
+        else:
+            retval[tag] = (False, f'Tag: {tag}\nNo description found.', None)
+    return retval
+
+
+def _get_desc(tag: str, use_other_names: bool = False, max_refs: int = 10, max_workers: int = 4,
+              max_tokens: Optional[int] = None, model_name: Optional[str] = None):
+    return _get_descs([tag], use_other_names=use_other_names, max_refs=max_refs, max_workers=max_workers,
+                      max_tokens=max_tokens, model_name=model_name)[tag]
+
+
+def _get_descs_cached(tags: List[str], use_other_names: bool = False, max_tokens: Optional[int] = None,
+                      model_name: Optional[str] = None) -> Dict[str, Tuple[bool, str, Optional[str]]]:
+    # descriptions are truncated with the tokenizer of the model
+    model_name = model_name or get_llm_default_model()
+    cache, missing_cache = get_cache('wiki'), get_cache('wiki_missing')
+    retval, missing_tags = {}, []
+    for tag in dict.fromkeys(tags):
+        key = f'{tag}|{int(use_other_names)}|{max_tokens}|{model_name}'
+        value = cache.get(key)
+        if value is None:
+            value = missing_cache.get(key)
+        if value is not None:
+            found, desc, updated_at = value
+            retval[tag] = (found, desc, updated_at)
+        else:
+            missing_tags.append(tag)
+
+    metrics = get_metrics()
+    metrics.inc('maid_wiki_desc_total', len(retval), result='hit')
+    if missing_tags:
+        metrics.inc('maid_wiki_desc_total', len(missing_tags), result='miss')
+        with metrics.timer('maid_wiki_desc_seconds'):
+            descs = _get_descs(missing_tags, use_other_names=use_other_names,
+                               max_tokens=max_tokens, model_name=model_name)
+        for tag, value in descs.items():
+            found, _, _ = value
+            (cache if found else missing_cache).set(f'{tag}|{int(use_other_names)}|{max_tokens}|{model_name}', value)
+            retval[tag] = value
+    return retval
 
-            if title_attachments:
-                print(f'## Mentioned Tags Information', file=sf)
-                print(f'', file=sf)
-                print(f'The following parts are attachment tag '
-                      f'information mentioned in tag {tag!r}s description body.', file=sf)
-                print(f'', file=sf)
-                for title, title_data in title_attachments:
-                    title_found, title_text = _get_desc_by_wiki_data(
-                        title_data, tag=title, use_other_names=use_other_names)
-                    if title_found:
-                        print(f'### {title}', file=sf)
-                        print(f'', file=sf)
-                        print(title_text, file=sf)
-                        print(f'', file=sf)
 
-            return found, sf.getvalue()
+def _get_desc_cached(tag: str, use_other_names: bool = False, max_tokens: Optional[int] = None,
+                     model_name: Optional[str] = None):
+    return _get_descs_cached([tag], use_other_names=use_other_names, max_tokens=max_tokens,
+                             model_name=model_name)[tag]
+
+
+def _llm_cache_key(tag: str, desc: str, updated_at: Optional[str], lang: str, model_name: str) -> str:
+    return f'{tag}|{lang}|{model_name}|{updated_at}|{hashlib.sha1(desc.encode()).hexdigest()[:16]}'
+
+
+def _ask_chatgpt_cached(tag: str, desc: str, updated_at: Optional[str], lang: str = 'english',
+                        model_name: Optional[str] = None):
+    model_name = model_name or get_llm_default_model()
+    cache = get_cache('llm')
+    key = _llm_cache_key(tag, desc, updated_at, lang, model_name)
+    result = cache.get(key)
+    get_metrics().inc('maid_llm_answer_total', result='miss' if result is None else 'hit')
+    if result is None:
+        result = ask_chatgpt(desc, lang=lang, model_name=model_name)
+        if result:
+            cache.set(key, result)
+    else:
+        logging.info(f'LLM answer of tag {tag!r} in {lang} hit the cache.')
+    return result
 
 
 def _raw_explain(tag: str, lang: str = 'english', use_other_names: bool = False):
-    tag_found, desc = _get_desc(tag, use_other_names=use_other_names)
+    model_name = get_llm_default_model()
+    tag_found, desc, updated_at = _get_desc_cached(tag, use_other_names=use_other_names,
+                                                   max_tokens=get_llm_input_token_budget(model_name),
+                                                   model_name=model_name)
     desc_lines = desc.splitlines(keepends=False)
     if len(desc_lines) > 20:
         desc_lines = desc_lines[:20] + ['(... more lines)']
@@ -163,21 +450,24 @@ def _raw_explain(tag: str, lang: str = 'english', use_other_names: bool = False)
         logging.info(f'Desc of tag {tag!r}:\n{os.linesep.join(desc_lines)}')
     except MarkupError:
         pass
-    result = ask_chatgpt(desc, lang=lang)
+    result = _ask_chatgpt_cached(tag, desc, updated_at, lang=lang, model_name=model_name)
     logging.info(f'Answer: {result}')
 
     if not tag_found:
-        with io.StringIO() as sf:
-            print(f'ATTENTION: Tag or wiki information not found for tag `{tag}`, '
-                  f'so this part of the explanation is automatically generated by LLM, '
-                  f'and **its accuracy is not worthy of high trust**.', file=sf)
-            print(f'', file=sf)
-            print(result, file=sf)
-            result = sf.getvalue()
+        result = _get_not_found_attention(tag) + result
 
     return result
 
 
+def _get_not_found_attention(tag: str) -> str:
+    with io.StringIO() as sf:
+        print(f'ATTENTION: Tag or wiki information not found for tag `{tag}`, '
+              f'so this part of the explanation is automatically generated by LLM, '
+              f'and **its accuracy is not worthy of high trust**.', file=sf)
+        print(f'', file=sf)
+        return sf.getvalue()
+
+
 def tag_explain(tag: str, lang: str = 'english', use_other_names: bool = False, max_retry: int = 5):
     i = 0
     while True:
@@ -189,3 +479,147 @@ def tag_explain(tag: str, lang: str = 'english', use_other_names: bool = False,
 
         if i >= max_retry:
             raise ValueError(f'Unable to explain {tag!r} ...')
+
+
+def tag_explain_stream(tag: str, lang: str = 'english', use_other_names: bool = False,
+                       model_name: Optional[str] = None) -> Iterator[str]:
+    logging.info(f'Explaining tag {tag!r} in {lang} in streaming mode ...')
+    model_name = model_name or get_llm_default_model()
+    tag_found, desc, updated_at = _get_desc_cached(tag, use_other_names=use_other_names,
+                                                   max_tokens=get_llm_input_token_budget(model_name),
+                                                   model_name=model_name)
+    if not tag_found:
+        yield _get_not_found_attention(tag)
+
+    cache = get_cache('llm')
+    key = _llm_cache_key(tag, desc, updated_at, lang, model_name)
+    result = cache.get(key)
+    get_metrics().inc('maid_llm_answer_total', result='miss' if result is None else 'hit')
+    if result is not None:
+        logging.info(f'LLM answer of tag {tag!r} in {lang} hit the cache.')
+        yield result
+        return
+
+    deltas = []
+    for delta in ask_chatgpt_stream(desc, lang=lang, model_name=model_name):
+        deltas.append(delta)
+        yield delta
+    result = ''.join(deltas).strip()
+    logging.info(f'Answer: {result}')
+    if result:
+        cache.set(key, result)
+
+
+_BATCH_MARKER = '@@@'
+
+
+def _get_batch_system_text(lang: str) -> str:
+    return _get_system_text(lang) + f"""
+Now I will provide multiple image labels in one message, each of them starts with a separate line `{_BATCH_MARKER} <tag>`.
+You have to answer all of them in the given order, and each answer MUST start with a separate line `{_BATCH_MARKER} <tag>`,
+with exactly the same tag as given, then followed by the answer in the format above.
+"""
+
+
+def _make_batch_message(descs: Dict[str, str]) -> str:
+    return '\n\n'.join(f'{_BATCH_MARKER} {tag}\n\n{desc}' for tag, desc in descs.items())
+
+
+def _split_batch_answer(text: str, tags: List[str]) -> Dict[str, str]:
+    parts = re.split(rf'^[ \t]*{re.escape(_BATCH_MARKER)}[ \t]*(.+?)[ \t]*$', text, flags=re.MULTILINE)
+    n_tags = {tag.strip().lower(): tag for tag in tags}
+    retval = {}
+    for name, answer in zip(parts[1::2], parts[2::2]):
+        tag = n_tags.get(name.strip('`\'" ').lower())
+        if tag and answer.strip():
+            retval[tag] = answer.strip()
+    return retval
+
+
+def ask_chatgpt_batch(descs: Dict[str, str], lang: str = 'english', model_name: Optional[str] = None) \
+        -> Dict[str, str]:
+    client = get_openai_client()
+    model_name = model_name or get_llm_default_model()
+    logging.info(f'Asking LLM model {model_name!r} for {plural_word(len(descs), "tag")} ...')
+    with get_metrics().timer('maid_llm_seconds', mode='batch', model=model_name):
+        response = client.chat.completions.create(
+            model=model_name,
+            messages=[
+                {'role': 'system', 'content': _get_batch_system_text(lang)},
+                {"role": "user", "content": _make_batch_message(descs)},
+            ],
+        )
+    return _split_batch_answer(response.choices[0].message.content, list(descs.keys()))
+
+
+def _pack_descs(descs: Dict[str, str], lang: str, max_input_tokens: int, max_tags: int,
+                model_name: Optional[str] = None) -> List[Dict[str, str]]:
+    base_tokens = count_tokens(_get_batch_system_text(lang), model_name)
+    packs, current, current_tokens = [], {}, base_tokens
+    for tag, desc in descs.items():
+        tokens = count_tokens(_make_batch_message({tag: desc}), model_name)
+        if current and (current_tokens + tokens > max_input_tokens or len(current) >= max_tags):
+            packs.append(current)
+            current, current_tokens = {}, base_tokens
+        current[tag] = desc
+        current_tokens += tokens
+    if current:
+        packs.append(current)
+    return packs
+
+
+def tag_explain_batch(tags: List[str], lang: str = 'english', use_other_names: bool = False,
+                      max_input_tokens: Optional[int] = None, max_tags_per_request: int = 10,
+                      max_workers: int = 4) -> Dict[str, str]:
+    tags = list(dict.fromkeys(tags))
+    if max_input_tokens is None:
+        max_input_tokens = get_int_env('MAID_EXPLAIN_BATCH_INPUT_TOKENS', 8000)
+    logging.info(f'Explaining {plural_word(len(tags), "tag")} in {lang} in batch ...')
+    model_name = get_llm_default_model()
+    descs = _get_descs_cached(tags, use_other_names=use_other_names,
+                              max_tokens=min(get_llm_input_token_budget(model_name), max_input_tokens),
+                              model_name=model_name)
+    cache = get_cache('llm')
+
+    answers, pending_descs = {}, {}
+    for tag in tags:
+        _, desc, updated_at = descs[tag]
+        result = cache.get(_llm_cache_key(tag, desc, updated_at, lang, model_name))
+        if result is not None:
+            answers[tag] = result
+        else:
+            pending_descs[tag] = desc
+    logging.info(f'{plural_word(len(answers), "answer")} hit the cache.')
+    get_metrics().inc('maid_llm_answer_total', len(answers), result='hit')
+    get_metrics().inc('maid_llm_answer_total', len(pending_descs), result='miss')
+
+    def _ask_pack(pack: Dict[str, str]) -> Dict[str, str]:
+        try:
+            return ask_chatgpt_batch(pack, lang=lang, model_name=model_name)
+        except Exception as err:
+            logging.exception(f'Error occurred when explaining {list(pack.keys())!r} in batch - {err!r}')
+            return {}
+
+    packs = _pack_descs(pending_descs, lang, max_input_tokens=max_input_tokens, max_tags=max_tags_per_request,
+                        model_name=model_name)
+    with ThreadPoolExecutor(max_workers=max(min(max_workers, len(packs)), 1)) as tp:
+        for result in tp.map(_ask_pack, packs):
+            for tag, answer in result.items():
+                _, desc, updated_at = descs[tag]
+                cache.set(_llm_cache_key(tag, desc, updated_at, lang, model_name), answer)
+                answers[tag] = answer
+
+        # the answers failed to be split out are asked one by one
+        missing_tags = [tag for tag in pending_descs if tag not in answers]
+        if missing_tags:
+            logging.info(f'{plural_word(len(missing_tags), "tag")} not answered in batch, asking one by one ...')
+            for tag, answer in zip(missing_tags, tp.map(
+                    lambda t: _ask_chatgpt_cached(t, descs[t][1], descs[t][2], lang=lang, model_name=model_name),
+                    missing_tags)):
+                answers[tag] = answer
+
+    retval = {}
+    for tag in tags:
+        tag_found, _, _ = descs[tag]
+        retval[tag] = answers[tag] if tag_found else _get_not_found_attention(tag) + answers[tag]
+    return retval
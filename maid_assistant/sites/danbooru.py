@@ -1,153 +1,234 @@
-import json
-import mimetypes
+import logging
+import math
 import os
 import re
-import shutil
-import zipfile
+import time
 from contextlib import contextmanager
 from datetime import datetime
-from functools import lru_cache
 from pprint import pprint
-from typing import List, Iterator, Optional
+from typing import List, Iterator, Optional, Tuple, Union, Callable
 
-from cheesechaser.datapool import DanbooruNewestWebpDataPool, ResourceNotFoundError, InvalidResourceDataError, DataPool
-from cheesechaser.pipe import SimpleImagePipe, PipeItem, Pipe
-from hbutils.system import TemporaryDirectory
-from huggingface_hub import HfFileSystem
-from waifuc.utils import srequest
+from cheesechaser.pipe import SimpleImagePipe, PipeItem
+from hbutils.string import plural_word
 
-from ..utils import get_danbooru_session
-
-mimetypes.add_type('image/webp', '.webp')
+from .pipe import ImageBytesPipe, NamedImageBytesPipe, pack_images_to_zip, iter_session_items, ImageHashPipe, \
+    make_hash_index, check_near_duplicate
+from .pool import get_data_pool
+from ..utils import get_danbooru_client, PrefetchIterator, BoundedIterator, get_max_id_service, ImageHashIndex, \
+    get_pack_cache, make_pack_key, get_metrics, get_danbooru_base_url
+from ..utils.env import get_int_env
 
 _N_REPO_ID = 'deepghs/danbooru_newest-webp-4Mpixel'
 
 
-@lru_cache()
 def _current_maxid():
-    hf_fs = HfFileSystem(token=os.environ.get('HF_TOKEN'))
-    return max(json.loads(hf_fs.read_text(f'datasets/{_N_REPO_ID}/exist_ids.json')))
+    return get_max_id_service(_N_REPO_ID).get()
 
 
 _DEFAULT = object()
 _DEFAULT_ALLOWED_RATINGS = {'g', 's', 'q', 'e'}
-
-
-def _iter_ids(tags: List[str], allowed_ratings=_DEFAULT) -> Iterator[int]:
-    session = get_danbooru_session()
-    page_no = 1
+_ALL_RATINGS = ['g', 's', 'q', 'e']
+
+_MAX_PAGE_SIZE = 200
+_MIN_PAGE_SIZE = 20
+_MAX_PAGES = 1000
+
+
+def _get_tag_limit() -> int:
+    return get_int_env('DANBOORU_TAG_LIMIT', 2)
+
+
+class QueryStats:
+    def __init__(self):
+        self.query_tags: List[str] = []
+        self.client_filters: List[str] = []
+        self.pages = 0
+        self.posts = 0
+        self.accepted = 0
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} tags: {self.query_tags!r}, client filters: {self.client_filters!r}, ' \
+               f'pages: {self.pages}, posts: {self.posts}, accepted: {self.accepted}>'
+
+
+def _is_ordered(tags: List[str]) -> bool:
+    return any(tag.lower().startswith('order:') for tag in tags)
+
+
+def _plan_query(tags: List[str], allowed_ratings, max_id: Optional[int] = None, tag_limit: Optional[int] = None) \
+        -> Tuple[List[str], bool, bool, bool]:
+    tag_limit = _get_tag_limit() if tag_limit is None else tag_limit
+    query_tags = list(tags)
+    budget = tag_limit - len(query_tags)
+
+    # server-side terms in order of how many posts they can save
+    need_rating = not (set(_ALL_RATINGS) <= set(allowed_ratings)) and \
+                  not any(tag.lower().startswith(('rating:', '-rating:')) for tag in tags)
+    # for the default id order, the pages start from `b<max_id>`, so id term is only needed by the ordered ones
+    need_id = max_id is not None and _is_ordered(tags) and not any(tag.lower().startswith('id:') for tag in tags)
+    need_parent = not any(tag.lower().startswith(('parent:', '-parent:')) for tag in tags)
+    rating_pushed, id_pushed, parent_pushed = False, False, False
+    if need_rating and budget > 0:
+        query_tags.append(f'rating:{",".join(r for r in _ALL_RATINGS if r in allowed_ratings)}')
+        budget -= 1
+        rating_pushed = True
+    if need_id and budget > 0:
+        query_tags.append(f'id:<{max_id}')
+        budget -= 1
+        id_pushed = True
+    if need_parent and budget > 0:
+        query_tags.append('parent:none')
+        budget -= 1
+        parent_pushed = True
+
+    return query_tags, rating_pushed, id_pushed, parent_pushed
+
+
+def _next_page_size(count_hint: Optional[int], accepted: int, posts: int, rating_filtered: bool) -> int:
+    if count_hint is None or accepted >= count_hint or (rating_filtered and not posts):
+        return _MAX_PAGE_SIZE
+    ratio = max(accepted / posts, 0.01) if posts else 1.0
+    # ask for some more posts, for some of them may be missing in data pool
+    size = int(math.ceil((count_hint - accepted) / ratio * 1.5))
+    return max(min(size, _MAX_PAGE_SIZE), _MIN_PAGE_SIZE)
+
+
+def _iter_ids(tags: List[str], allowed_ratings=_DEFAULT, max_id: Optional[int] = None,
+              count_hint: Optional[int] = None, stats: Optional[QueryStats] = None) -> Iterator[int]:
+    client = get_danbooru_client()
     if allowed_ratings is _DEFAULT:
         allowed_ratings = _DEFAULT_ALLOWED_RATINGS
+    stats = stats if stats is not None else QueryStats()
+    query_tags, rating_pushed, id_pushed, parent_pushed = _plan_query(tags, allowed_ratings, max_id=max_id)
+    stats.query_tags = query_tags
+    # cursor-based pages allow changing page size, but only work for the default id order
+    use_cursor = not _is_ordered(query_tags)
+    stats.client_filters = [
+        name for name, pushed in [('rating', rating_pushed or set(_ALL_RATINGS) <= set(allowed_ratings)),
+                                  ('id', id_pushed or max_id is None or use_cursor),
+                                  ('parent', parent_pushed)]
+        if not pushed
+    ]
+    logging.info(f'Danbooru query planned - {stats!r}')
+
+    page_no, min_id = 1, max_id
     while True:
-        resp = srequest(
-            session,
-            'GET', f'https://danbooru.donmai.us/posts.json',
-            params={
-                "format": "json",
-                "limit": "200",
-                "page": str(page_no),
-                "tags": ' '.join(tags),
-            }
-        )
-        if not resp.json():
+        if use_cursor:
+            # rating is the only client-side filter which usually drops a large part of the posts
+            page_size = _next_page_size(count_hint, stats.accepted, stats.posts, 'rating' in stats.client_filters)
+            page = f'b{min_id}' if min_id is not None else '1'
+        else:
+            page_size = _MAX_PAGE_SIZE
+            page = str(page_no)
+        with get_metrics().timer('maid_danbooru_page_seconds'):
+            resp = client.get(
+                f'{get_danbooru_base_url()}/posts.json',
+                params={
+                    "format": "json",
+                    "limit": str(page_size),
+                    "page": page,
+                    "tags": ' '.join(query_tags),
+                }
+            )
+            posts = resp.json()
+        if not posts:
             break
 
-        for item in resp.json():
-            if not item.get('parent_id') and item['rating'] in allowed_ratings:
+        stats.pages += 1
+        stats.posts += len(posts)
+        get_metrics().inc('maid_danbooru_posts_total', len(posts))
+        for item in posts:
+            if not item.get('parent_id') and item['rating'] in allowed_ratings and \
+                    (max_id is None or item['id'] < max_id):
+                stats.accepted += 1
                 yield item['id']
 
+        min_id = min(item['id'] for item in posts)
         page_no += 1
-        if page_no > 1000:
+        if page_no > _MAX_PAGES:
             break
 
 
-def query_danbooru_images(tags: List[str], count: int = 4, allowed_ratings=_DEFAULT):
-    pool = DanbooruNewestWebpDataPool()
-    pipe = SimpleImagePipe(pool)
+def query_danbooru_images(tags: List[str], count: int = 4, allowed_ratings=_DEFAULT,
+                          stats: Optional[QueryStats] = None, lookahead: Optional[int] = 100, raw: bool = False,
+                          timeout: Optional[float] = None, dedup: Union[bool, ImageHashIndex] = True):
+    start_time = time.perf_counter()
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    pool = get_data_pool('danbooru')
+    pipe = ImageBytesPipe(pool) if raw else SimpleImagePipe(pool)
+    hash_index = make_hash_index(dedup)
+    if hash_index is not None:
+        pipe = ImageHashPipe(pipe)
     images = []
     exist_ids = set()
-    if len(tags) < 2:
-        tags = [*tags, f'id:<{_current_maxid()}']
-    with pipe.batch_retrieve(_iter_ids(tags, allowed_ratings=allowed_ratings)) as session:
-        for i, item in enumerate(session):
+    stats = stats if stats is not None else QueryStats()
+    ids = _iter_ids(tags, allowed_ratings=allowed_ratings, max_id=_current_maxid(), count_hint=count, stats=stats)
+    bounded = None
+    if lookahead:
+        # keep paginating in background, so the next page is ready when images of this page are being retrieved,
+        # but no more than `lookahead` ids ahead of the results taken, or all the pages will be fetched at once
+        bounded = BoundedIterator(ids, limit=lookahead)
+        ids = PrefetchIterator(bounded, lookahead=lookahead, name='danbooru_ids')
+
+    session = pipe.batch_retrieve(ids)
+    try:
+        on_result = bounded.release if bounded is not None else None
+        for i, item in enumerate(iter_session_items(session, deadline=deadline, on_result=on_result)):
             item: PipeItem
             if item.id not in exist_ids:
-                images.append((item.id, item.data))
+                data = item.data
+                if hash_index is not None:
+                    data, is_duplicate = check_near_duplicate(hash_index, item, ('danbooru', item.id))
+                    if is_duplicate:
+                        continue
+                images.append((item.id, data))
                 exist_ids.add(item.id)
                 if len(images) >= count:
                     break
+    finally:
+        if bounded is not None:
+            bounded.close()
+            ids.close()
+        # stop the pagination and pending retrievals at once, do not wait for the running ones
+        session.shutdown(wait=False)
+        get_metrics().observe('maid_query_seconds', time.perf_counter() - start_time, site='danbooru')
+    get_metrics().inc('maid_query_images_total', len(images), site='danbooru')
+    logging.info(f'{plural_word(len(images), "image")} found - {stats!r}')
     return images
 
 
-class DownloadImagePipe(Pipe):
-    def __init__(self, pool: DataPool, dst_dir: str):
-        Pipe.__init__(self, pool)
-        self.dst_dir = dst_dir
-
-    def retrieve(self, resource_id, resource_metainfo, silent: bool = False):
-        with self.pool.mock_resource(resource_id, resource_metainfo, silent=silent) as (td, resource_metainfo):
-            files = os.listdir(td)
-            image_files = []
-            for file in files:
-                mimetype, _ = mimetypes.guess_type(file)
-                if not mimetype or mimetype.startswith('image/'):
-                    image_files.append(file)
-            if len(image_files) == 0:
-                raise ResourceNotFoundError(f'Image not found for resource {resource_id!r}.')
-            elif len(image_files) != 1:
-                raise InvalidResourceDataError(f'Image file not unique for resource {resource_id!r} '
-                                               f'- {image_files!r}.')
-
-            src_file = os.path.join(td, image_files[0])
-            dst_file = os.path.join(self.dst_dir, os.path.relpath(src_file, td))
-            if os.path.dirname(dst_file):
-                os.makedirs(os.path.dirname(dst_file), exist_ok=True)
-            shutil.copyfile(src_file, dst_file)
-            return dst_file
-
-
 def _tag_normalize(tag) -> str:
     return re.sub(r'[\W_]+', '_', tag).strip('_')
 
 
 @contextmanager
 def download_danbooru_images(tags: List[str], max_count: Optional[int] = None, max_total_size: int = 24 * 1024 ** 2,
-                             allowed_ratings=_DEFAULT):
-    pool = DanbooruNewestWebpDataPool()
-    if len(tags) < 2:
-        tags = [*tags, f'id:<{_current_maxid()}']
-
-    with TemporaryDirectory() as td:
-        image_dir = os.path.join(td, 'images')
-        os.makedirs(image_dir, exist_ok=True)
-
-        exist_ids = set()
-        pipe = DownloadImagePipe(pool, image_dir)
-        image_files = []
-        current_size = 0
-        with pipe.batch_retrieve(_iter_ids(tags, allowed_ratings=allowed_ratings)) as session:
-            for i, item in enumerate(session):
-                item: PipeItem
-                if item.id not in exist_ids:
-                    if current_size + os.path.getsize(item.data) > max_total_size:
-                        break
-
-                    image_files.append((item.id, item.data))
-                    exist_ids.add(item.id)
-                    current_size += os.path.getsize(item.data)
-                    if max_count is not None and len(image_files) >= max_count:
-                        break
+                             allowed_ratings=_DEFAULT, on_progress: Optional[Callable[[int, int], None]] = None):
+    pool = get_data_pool('danbooru')
+    if allowed_ratings is _DEFAULT:
+        allowed_ratings = _DEFAULT_ALLOWED_RATINGS
+    max_id = _current_maxid()
 
+    def _build(td):
         filename = f'{"__".join(map(_tag_normalize, tags))}__{datetime.now().strftime("%Y%m%d%H%M%S%f")}.zip'
-        file_count = os.listdir(image_dir)
         package_file = os.path.join(td, filename)
-        current_size = 0
-        with zipfile.ZipFile(package_file, 'w') as zf:
-            for _, img_file in image_files:
-                if (current_size + os.path.getsize(img_file)) < max_total_size:
-                    zf.write(img_file, os.path.basename(img_file))
-
-        yield file_count, package_file
+        filenames = pack_images_to_zip(
+            pipe=NamedImageBytesPipe(pool),
+            resource_ids=_iter_ids(tags, allowed_ratings=allowed_ratings, max_id=max_id),
+            package_file=package_file,
+            max_count=max_count,
+            max_total_size=max_total_size,
+            on_progress=on_progress,
+        )
+        return package_file, filenames
+
+    package_file, file_count = get_pack_cache().get_or_create(
+        make_pack_key('danbooru', tags, allowed_ratings, max_id, max_count, max_total_size),
+        _build,
+    )
+    if on_progress is not None:
+        on_progress(len(file_count), os.path.getsize(package_file))
+    yield file_count, package_file
 
 
 if __name__ == '__main__':
@@ -1,39 +1,44 @@
-import json
-import mimetypes
 import os
 import re
-import shutil
-import zipfile
+import time
 from contextlib import contextmanager
 from datetime import datetime
-from functools import lru_cache
 from pprint import pprint
-from typing import List, Optional
+from typing import List, Optional, Union, Callable
 
-from cheesechaser.datapool import GelbooruWebpDataPool, DataPool, ResourceNotFoundError, InvalidResourceDataError
-from cheesechaser.pipe import SimpleImagePipe, PipeItem, Pipe
+from cheesechaser.pipe import SimpleImagePipe, PipeItem
 from cheesechaser.query import GelbooruIdQuery
-from hbutils.system import TemporaryDirectory
-from huggingface_hub import HfFileSystem
 
-mimetypes.add_type('image/webp', '.webp')
+from .pipe import ImageBytesPipe, NamedImageBytesPipe, pack_images_to_zip, iter_session_items, ImageHashPipe, \
+    make_hash_index, check_near_duplicate
+from .pool import get_data_pool
+from ..utils import get_max_id_service, ImageHashIndex, get_pack_cache, make_pack_key, get_metrics, BoundedIterator
 
 _N_REPO_ID = 'deepghs/gelbooru-webp-4Mpixel'
 
 
-@lru_cache()
 def _current_maxid():
-    hf_fs = HfFileSystem(token=os.environ.get('HF_TOKEN'))
-    return max(json.loads(hf_fs.read_text(f'datasets/{_N_REPO_ID}/exist_ids.json')))
+    return get_max_id_service(_N_REPO_ID).get()
+
+
+def _get_site_url() -> str:
+    return (os.environ.get('GELBOORU_BASE_URL') or 'https://gelbooru.com').rstrip('/')
 
 
 _DEFAULT = object()
 _DEFAULT_ALLOWED_RATINGS = {'general', 'sensitive', 'questionable', 'explicit'}
 
 
-def query_gelbooru_images(tags: List[str], count: int = 4, allowed_ratings=_DEFAULT):
-    pool = GelbooruWebpDataPool()
-    pipe = SimpleImagePipe(pool)
+def query_gelbooru_images(tags: List[str], count: int = 4, allowed_ratings=_DEFAULT, raw: bool = False,
+                          timeout: Optional[float] = None, dedup: Union[bool, ImageHashIndex] = True,
+                          lookahead: int = 100):
+    start_time = time.perf_counter()
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    pool = get_data_pool('gelbooru')
+    pipe = ImageBytesPipe(pool) if raw else SimpleImagePipe(pool)
+    hash_index = make_hash_index(dedup)
+    if hash_index is not None:
+        pipe = ImageHashPipe(pipe)
     images = []
     exist_ids = set()
     tags = [*tags, f'id:<{_current_maxid()}']
@@ -46,99 +51,77 @@ def query_gelbooru_images(tags: List[str], count: int = 4, allowed_ratings=_DEFA
         tags=tags,
         filters=[
             lambda x: x['rating'] in allowed_ratings,
-        ]
+        ],
+        site_url=_get_site_url(),
     )
 
-    with pipe.batch_retrieve(query) as session:
-        for i, item in enumerate(session):
+    # pages are fetched only when the retrieved images are taken
+    ids = BoundedIterator(query, limit=lookahead)
+    session = pipe.batch_retrieve(ids)
+    try:
+        for i, item in enumerate(iter_session_items(session, deadline=deadline, on_result=ids.release)):
             item: PipeItem
             if item.id not in exist_ids:
-                images.append((item.id, item.data))
+                data = item.data
+                if hash_index is not None:
+                    data, is_duplicate = check_near_duplicate(hash_index, item, ('gelbooru', item.id))
+                    if is_duplicate:
+                        continue
+                images.append((item.id, data))
                 exist_ids.add(item.id)
                 if len(images) >= count:
                     break
+    finally:
+        # stop the pending retrievals at once, do not wait for the running ones
+        ids.close()
+        session.shutdown(wait=False)
+        get_metrics().observe('maid_query_seconds', time.perf_counter() - start_time, site='gelbooru')
+    get_metrics().inc('maid_query_images_total', len(images), site='gelbooru')
     return images
 
 
-class DownloadImagePipe(Pipe):
-    def __init__(self, pool: DataPool, dst_dir: str):
-        Pipe.__init__(self, pool)
-        self.dst_dir = dst_dir
-
-    def retrieve(self, resource_id, resource_metainfo, silent: bool = False):
-        with self.pool.mock_resource(resource_id, resource_metainfo, silent=silent) as (td, resource_metainfo):
-            files = os.listdir(td)
-            image_files = []
-            for file in files:
-                mimetype, _ = mimetypes.guess_type(file)
-                if not mimetype or mimetype.startswith('image/'):
-                    image_files.append(file)
-            if len(image_files) == 0:
-                raise ResourceNotFoundError(f'Image not found for resource {resource_id!r}.')
-            elif len(image_files) != 1:
-                raise InvalidResourceDataError(f'Image file not unique for resource {resource_id!r} '
-                                               f'- {image_files!r}.')
-
-            src_file = os.path.join(td, image_files[0])
-            dst_file = os.path.join(self.dst_dir, os.path.relpath(src_file, td))
-            if os.path.dirname(dst_file):
-                os.makedirs(os.path.dirname(dst_file), exist_ok=True)
-            shutil.copyfile(src_file, dst_file)
-            return dst_file
-
-
 def _tag_normalize(tag) -> str:
     return re.sub(r'[\W_]+', '_', tag).strip('_')
 
 
 @contextmanager
 def download_gelbooru_images(tags: List[str], max_count: Optional[int] = None, max_total_size: int = 24 * 1024 ** 2,
-                             allowed_ratings=_DEFAULT):
-    pool = GelbooruWebpDataPool()
-    tags = [*tags, f'id:<{_current_maxid()}']
+                             allowed_ratings=_DEFAULT, on_progress: Optional[Callable[[int, int], None]] = None):
+    pool = get_data_pool('gelbooru')
+    max_id = _current_maxid()
+    tags = [*tags, f'id:<{max_id}']
     if not any(tag.startswith('sort:') for tag in tags):
         tags = [*tags, 'sort:score:desc']
     if allowed_ratings is _DEFAULT:
         allowed_ratings = _DEFAULT_ALLOWED_RATINGS
 
-    query = GelbooruIdQuery(
-        tags=tags,
-        filters=[
-            lambda x: x['rating'] in allowed_ratings,
-        ]
-    )
-
-    with TemporaryDirectory() as td:
-        image_dir = os.path.join(td, 'images')
-        os.makedirs(image_dir, exist_ok=True)
-
-        exist_ids = set()
-        pipe = DownloadImagePipe(pool, image_dir)
-        image_files = []
-        current_size = 0
-        with pipe.batch_retrieve(query) as session:
-            for i, item in enumerate(session):
-                item: PipeItem
-                if item.id not in exist_ids:
-                    if current_size + os.path.getsize(item.data) > max_total_size:
-                        break
-
-                    image_files.append((item.id, item.data))
-                    exist_ids.add(item.id)
-                    current_size += os.path.getsize(item.data)
-                    if max_count is not None and len(image_files) >= max_count:
-                        break
-
+    def _build(td):
+        query = GelbooruIdQuery(
+            tags=tags,
+            filters=[
+                lambda x: x['rating'] in allowed_ratings,
+            ],
+            site_url=_get_site_url(),
+        )
         filename = f'{"__".join(map(_tag_normalize, tags))}__{datetime.now().strftime("%Y%m%d%H%M%S%f")}.zip'
-        file_count = os.listdir(image_dir)
         package_file = os.path.join(td, filename)
-        current_size = 0
-        with zipfile.ZipFile(package_file, 'w') as zf:
-            for _, img_file in image_files:
-                if (current_size + os.path.getsize(img_file)) < max_total_size:
-                    zf.write(img_file, os.path.basename(img_file))
-
-        yield file_count, package_file
+        filenames = pack_images_to_zip(
+            pipe=NamedImageBytesPipe(pool),
+            resource_ids=query,
+            package_file=package_file,
+            max_count=max_count,
+            max_total_size=max_total_size,
+            on_progress=on_progress,
+        )
+        return package_file, filenames
+
+    package_file, file_count = get_pack_cache().get_or_create(
+        make_pack_key('gelbooru', tags, allowed_ratings, max_id, max_count, max_total_size),
+        _build,
+    )
+    if on_progress is not None:
+        on_progress(len(file_count), os.path.getsize(package_file))
+    yield file_count, package_file
 
 
 if __name__ == '__main__':
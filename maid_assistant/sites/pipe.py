@@ -0,0 +1,157 @@
+import logging
+import mimetypes
+import os
+import time
+import zipfile
+from queue import Empty
+from typing import List, Optional, Iterator, Union, Tuple, Any, Callable
+
+from cheesechaser.datapool import ResourceNotFoundError, InvalidResourceDataError
+from cheesechaser.pipe import Pipe, PipeItem, PipeSession
+from hbutils.string import plural_word
+
+from ..utils import image_dhash, ImageHashIndex, get_metrics, BoundedIterator
+
+mimetypes.add_type('image/webp', '.webp')
+
+
+def _find_image_file(td: str, resource_id) -> str:
+    files = os.listdir(td)
+    image_files = []
+    for file in files:
+        mimetype, _ = mimetypes.guess_type(file)
+        if not mimetype or mimetype.startswith('image/'):
+            image_files.append(file)
+    if len(image_files) == 0:
+        raise ResourceNotFoundError(f'Image not found for resource {resource_id!r}.')
+    elif len(image_files) != 1:
+        raise InvalidResourceDataError(f'Image file not unique for resource {resource_id!r} '
+                                       f'- {image_files!r}.')
+    return image_files[0]
+
+
+class NamedImageBytesPipe(Pipe):
+    def retrieve(self, resource_id, resource_metainfo, silent: bool = False):
+        with get_metrics().timer('maid_image_retrieve_seconds', pool=type(self.pool).__name__), \
+                self.pool.mock_resource(resource_id, resource_metainfo, silent=silent) as (td, resource_metainfo):
+            filename = _find_image_file(td, resource_id)
+            with open(os.path.join(td, filename), 'rb') as f:
+                return filename, f.read()
+
+
+class ImageBytesPipe(NamedImageBytesPipe):
+    def retrieve(self, resource_id, resource_metainfo, silent: bool = False):
+        _, data = NamedImageBytesPipe.retrieve(self, resource_id, resource_metainfo, silent=silent)
+        return data
+
+
+def iter_session_items(session: PipeSession, deadline: Optional[float] = None,
+                       on_result: Optional[Callable[[Any], None]] = None) -> Iterator[PipeItem]:
+    # same as iterating the session, but able to give up when the deadline (time.monotonic based) is reached
+    # on_result is called with every result taken out, including the failed ones
+    while not (session.is_stopped.is_set() and session.queue.empty()):
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logging.info('Deadline reached, stop waiting for more items.')
+                break
+        else:
+            remaining = 1.0
+
+        try:
+            data = session.next(block=True, timeout=min(remaining, 1.0))
+        except Empty:
+            continue
+        if on_result is not None:
+            on_result(data)
+        if isinstance(data, PipeItem):
+            yield data
+
+
+class ImageHashPipe(Pipe):
+    def __init__(self, pipe: Pipe):
+        Pipe.__init__(self, pipe.pool)
+        self.pipe = pipe
+
+    def retrieve(self, resource_id, resource_metainfo, silent: bool = False):
+        data = self.pipe.retrieve(resource_id, resource_metainfo, silent=silent)
+        try:
+            with get_metrics().timer('maid_image_hash_seconds'):
+                hash_value = image_dhash(data)
+        except Exception as err:
+            logging.warning(f'Unable to hash image of resource {resource_id!r} - {err!r}')
+            hash_value = None
+        return data, hash_value
+
+
+def make_hash_index(dedup: Union[bool, ImageHashIndex]) -> Optional[ImageHashIndex]:
+    if isinstance(dedup, ImageHashIndex):
+        return dedup
+    elif dedup:
+        return ImageHashIndex()
+    else:
+        return None
+
+
+def check_near_duplicate(hash_index: ImageHashIndex, item: PipeItem, key) -> Tuple[Any, bool]:
+    data, hash_value = item.data
+    if hash_value is not None:
+        exist_key = hash_index.check_and_add(hash_value, key)
+        if exist_key is not None:
+            logging.info(f'Image {key!r} skipped, near duplicate of {exist_key!r}.')
+            get_metrics().inc('maid_duplicate_images_total')
+            return data, True
+    return data, False
+
+
+# sizes of local file header, central directory record and end of central directory, without file names
+_ZIP_LOCAL_HEADER_SIZE = 30
+_ZIP_CENTRAL_RECORD_SIZE = 46
+_ZIP_END_RECORD_SIZE = 22
+
+
+def pack_images_to_zip(pipe: NamedImageBytesPipe, resource_ids, package_file: str,
+                       max_count: Optional[int] = None, max_total_size: int = 24 * 1024 ** 2,
+                       max_workers: int = 6, on_progress: Optional[Callable[[int, int], None]] = None) -> List[str]:
+    filenames, exist_ids = [], set()
+    central_size = _ZIP_END_RECORD_SIZE
+    start_time = time.perf_counter()
+    # the pipe submits all the ids at once, so pagination has to be held back until the images are taken
+    resource_ids = BoundedIterator(resource_ids, limit=max_workers * 4)
+    session = pipe.batch_retrieve(resource_ids, max_workers=max_workers)
+    try:
+        # webp images are already compressed, so just store them
+        with zipfile.ZipFile(package_file, 'w', compression=zipfile.ZIP_STORED) as zf:
+            for item in iter_session_items(session, on_result=resource_ids.release):
+                item: PipeItem
+                if item.id in exist_ids:
+                    continue
+
+                filename, data = item.data
+                name_size = len(filename.encode())
+                entry_size = _ZIP_LOCAL_HEADER_SIZE + name_size + len(data)
+                if zf.fp.tell() + entry_size + central_size + _ZIP_CENTRAL_RECORD_SIZE + name_size > max_total_size:
+                    logging.info(f'Size limit {max_total_size!r} reached, stop packing.')
+                    break
+
+                zf.writestr(filename, data)
+                central_size += _ZIP_CENTRAL_RECORD_SIZE + name_size
+                filenames.append(filename)
+                exist_ids.add(item.id)
+                if on_progress is not None:
+                    # images packed, bytes packed
+                    on_progress(len(filenames), zf.fp.tell())
+                if max_count is not None and len(filenames) >= max_count:
+                    break
+    finally:
+        # stop retrieving at once, the images not packed yet are useless
+        resource_ids.close()
+        session.shutdown(wait=False)
+
+    metrics = get_metrics()
+    metrics.observe('maid_pack_seconds', time.perf_counter() - start_time)
+    metrics.inc('maid_pack_images_total', len(filenames))
+    metrics.inc('maid_pack_bytes_total', os.path.getsize(package_file))
+    logging.info(f'{plural_word(len(filenames), "image")} packed into {package_file!r}, '
+                 f'size: {os.path.getsize(package_file)}.')
+    return filenames
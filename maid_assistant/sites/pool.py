@@ -0,0 +1,51 @@
+import os
+import shutil
+from contextlib import contextmanager
+from typing import ContextManager, Tuple, Any
+
+from cheesechaser.datapool import DataPool, ResourceNotFoundError, DanbooruNewestWebpDataPool, GelbooruWebpDataPool
+from hbutils.system import TemporaryDirectory
+
+_HF_DATA_POOLS = {
+    'danbooru': DanbooruNewestWebpDataPool,
+    'gelbooru': GelbooruWebpDataPool,
+}
+
+
+class LocalDataPool(DataPool):
+    def __init__(self, directory: str):
+        # images are saved as <id>.<ext>, e.g. 7654321.webp
+        self.directory = directory
+        self._files = None
+
+    def _find_file(self, resource_id) -> str:
+        if self._files is None:
+            files = {}
+            if os.path.isdir(self.directory):
+                for filename in os.listdir(self.directory):
+                    files[os.path.splitext(filename)[0]] = os.path.join(self.directory, filename)
+            self._files = files
+
+        if str(resource_id) not in self._files:
+            raise ResourceNotFoundError(f'Resource {resource_id!r} not found in {self.directory!r}.')
+        return self._files[str(resource_id)]
+
+    @contextmanager
+    def mock_resource(self, resource_id, resource_info, silent: bool = False) -> ContextManager[Tuple[str, Any]]:
+        src_file = self._find_file(resource_id)
+        with TemporaryDirectory() as td:
+            dst_file = os.path.join(td, os.path.basename(src_file))
+            try:
+                os.link(src_file, dst_file)
+            except OSError:
+                shutil.copyfile(src_file, dst_file)
+            yield td, resource_info
+
+
+def get_data_pool(site: str) -> DataPool:
+    # MAID_LOCAL_DATA_POOL=/path/to/pools reads images from /path/to/pools/<site> instead of huggingface
+    local_dir = os.environ.get('MAID_LOCAL_DATA_POOL')
+    if local_dir:
+        return LocalDataPool(os.path.join(local_dir, site))
+    else:
+        return _HF_DATA_POOLS[site]()
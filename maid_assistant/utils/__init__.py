@@ -1,2 +1,67 @@
-from .danbooru import get_danbooru_session
-from .llm import get_openai_client, get_llm_default_model
+from importlib import import_module
+
+# the submodules are imported on first use, so `maid_assistant.utils.env` will not load openai or pandas
+_EXPORTS = {
+    'get_danbooru_session': 'danbooru',
+    'get_danbooru_client': 'danbooru',
+    'get_danbooru_base_url': 'danbooru',
+    'get_openai_client': 'llm',
+    'get_llm_default_model': 'llm',
+    'get_llm_input_token_budget': 'llm',
+    'get_worker_pool': 'workers',
+    'WorkerPool': 'workers',
+    'PoolBusyError': 'workers',
+    'get_cache': 'cache',
+    'list_cache_names': 'cache',
+    'TwoLevelCache': 'cache',
+    'get_single_flight': 'singleflight',
+    'list_single_flight_names': 'singleflight',
+    'SingleFlight': 'singleflight',
+    'PrefetchIterator': 'prefetch',
+    'BoundedIterator': 'prefetch',
+    'get_max_id_service': 'maxid',
+    'MaxIdService': 'maxid',
+    'fit_images_to_size': 'image',
+    'image_dhash': 'dedup',
+    'ImageHashIndex': 'dedup',
+    'count_tokens': 'tokens',
+    'truncate_tokens': 'tokens',
+    'get_wiki_index': 'wiki',
+    'WikiIndex': 'wiki',
+    'normalize_wiki_title': 'wiki',
+    'get_tag_resolver': 'tags',
+    'TagResolver': 'tags',
+    'HttpClient': 'http',
+    'TokenBucket': 'http',
+    'RetryBudget': 'http',
+    'get_host_limiter': 'http',
+    'get_job_queue': 'jobs',
+    'JobQueue': 'jobs',
+    'JobContext': 'jobs',
+    'JobCancelledError': 'jobs',
+    'JobQuotaError': 'jobs',
+    'get_pack_cache': 'packcache',
+    'make_pack_key': 'packcache',
+    'PackCache': 'packcache',
+    'get_metrics': 'metrics',
+    'MetricsRegistry': 'metrics',
+    'start_metrics_server': 'metrics',
+    'lazy_import': 'lazy',
+    'prewarm_modules': 'lazy',
+    'list_lazy_modules': 'lazy',
+    'LazyModule': 'lazy',
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(import_module(f'.{_EXPORTS[name]}', __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted([*globals(), *_EXPORTS])
@@ -0,0 +1,191 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any, Optional, List, Tuple
+
+from .env import get_int_env, get_float_env
+
+# name -> (ttl seconds, max memory items, max disk items)
+_DEFAULT_CACHE_SETTINGS = {
+    'wiki': (24 * 3600, 512, 20000),
+    # tags without wiki pages, kept shortly for the pages may be created soon
+    'wiki_missing': (10 * 60, 256, 5000),
+    'llm': (30 * 24 * 3600, 512, 50000),
+}
+
+_MISSING = object()
+
+
+class TwoLevelCache:
+    def __init__(self, name: str, db_file: str, ttl: Optional[float] = None,
+                 max_memory_items: int = 512, max_disk_items: int = 20000, generation_check_interval: float = 1.0):
+        self.name = name
+        self.db_file = db_file
+        self.ttl = ttl
+        self.max_memory_items = max_memory_items
+        self.max_disk_items = max_disk_items
+        # purges in the other processes are seen within this time
+        self.generation_check_interval = generation_check_interval
+
+        self._lock = threading.RLock()
+        self._memory: OrderedDict = OrderedDict()
+        self._hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+        self._generation = None
+        self._generation_checked_at = None
+
+        if os.path.dirname(db_file):
+            os.makedirs(os.path.dirname(db_file), exist_ok=True)
+        self._conn = sqlite3.connect(db_file, check_same_thread=False, isolation_level=None, timeout=30.0)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS cache_items ('
+                           'namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, '
+                           'created_at REAL NOT NULL, accessed_at REAL NOT NULL, '
+                           'PRIMARY KEY (namespace, key))')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_cache_items_accessed '
+                           'ON cache_items (namespace, accessed_at)')
+        # bumped by every purge, the processes sharing this file drop their memory items when it is changed
+        self._conn.execute('CREATE TABLE IF NOT EXISTS cache_generations ('
+                           'namespace TEXT PRIMARY KEY, generation INTEGER NOT NULL)')
+
+    def _is_expired(self, created_at: float) -> bool:
+        return self.ttl is not None and created_at + self.ttl < time.time()
+
+    def _memory_put(self, key: str, created_at: float, value: Any):
+        self._memory[key] = (created_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def _check_generation(self, force: bool = False):
+        current_time = time.monotonic()
+        if not force and self._generation_checked_at is not None and \
+                current_time - self._generation_checked_at < self.generation_check_interval:
+            return
+        self._generation_checked_at = current_time
+        row = self._conn.execute('SELECT generation FROM cache_generations WHERE namespace = ?',
+                                 (self.name,)).fetchone()
+        generation = row[0] if row else 0
+        if generation != self._generation:
+            self._memory.clear()
+            self._generation = generation
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            self._check_generation()
+            if key in self._memory:
+                created_at, value = self._memory[key]
+                if not self._is_expired(created_at):
+                    self._memory.move_to_end(key)
+                    self._hits += 1
+                    return value
+                else:
+                    del self._memory[key]
+
+            row = self._conn.execute('SELECT value, created_at FROM cache_items WHERE namespace = ? AND key = ?',
+                                     (self.name, key)).fetchone()
+            if row is not None:
+                value_text, created_at = row
+                if not self._is_expired(created_at):
+                    self._conn.execute('UPDATE cache_items SET accessed_at = ? WHERE namespace = ? AND key = ?',
+                                       (time.time(), self.name, key))
+                    value = json.loads(value_text)
+                    self._memory_put(key, created_at, value)
+                    self._hits += 1
+                    self._disk_hits += 1
+                    return value
+                else:
+                    self._conn.execute('DELETE FROM cache_items WHERE namespace = ? AND key = ?', (self.name, key))
+
+            self._misses += 1
+            return default
+
+    def set(self, key: str, value: Any):
+        current_time = time.time()
+        value_text = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            self._check_generation()
+            self._memory_put(key, current_time, value)
+            self._conn.execute('INSERT OR REPLACE INTO cache_items (namespace, key, value, created_at, accessed_at) '
+                               'VALUES (?, ?, ?, ?, ?)', (self.name, key, value_text, current_time, current_time))
+            self._evict()
+
+    def _evict(self):
+        if self.ttl is not None:
+            self._conn.execute('DELETE FROM cache_items WHERE namespace = ? AND created_at < ?',
+                               (self.name, time.time() - self.ttl))
+        count, = self._conn.execute('SELECT COUNT(*) FROM cache_items WHERE namespace = ?', (self.name,)).fetchone()
+        if count > self.max_disk_items:
+            logging.info(f'Evicting {count - self.max_disk_items} item(s) from cache {self.name!r} ...')
+            self._conn.execute('DELETE FROM cache_items WHERE namespace = ? AND key IN ('
+                               'SELECT key FROM cache_items WHERE namespace = ? ORDER BY accessed_at LIMIT ?)',
+                               (self.name, self.name, count - self.max_disk_items))
+
+    def get_or_create(self, key: str, fn):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = fn()
+            self.set(key, value)
+        return value
+
+    def purge(self, prefix: Optional[str] = None) -> int:
+        with self._lock:
+            if prefix is None:
+                cursor = self._conn.execute('DELETE FROM cache_items WHERE namespace = ?', (self.name,))
+            else:
+                cursor = self._conn.execute('DELETE FROM cache_items WHERE namespace = ? AND substr(key, 1, ?) = ?',
+                                            (self.name, len(prefix), prefix))
+            self._conn.execute('INSERT INTO cache_generations (namespace, generation) VALUES (?, 1) '
+                               'ON CONFLICT (namespace) DO UPDATE SET generation = generation + 1', (self.name,))
+            self._check_generation(force=True)
+            return cursor.rowcount
+
+    def list_items(self, prefix: Optional[str] = None, limit: int = 20) -> List[Tuple[str, float, int]]:
+        with self._lock:
+            return self._conn.execute(
+                'SELECT key, created_at, length(value) FROM cache_items '
+                'WHERE namespace = ? AND substr(key, 1, ?) = ? ORDER BY accessed_at DESC LIMIT ?',
+                (self.name, len(prefix or ''), prefix or '', limit)
+            ).fetchall()
+
+    def stats(self) -> dict:
+        with self._lock:
+            disk_items, disk_size = self._conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(length(value)), 0) FROM cache_items WHERE namespace = ?',
+                (self.name,)
+            ).fetchone()
+            return {
+                'memory_items': len(self._memory),
+                'disk_items': disk_items,
+                'disk_size': disk_size,
+                'hits': self._hits,
+                'disk_hits': self._disk_hits,
+                'misses': self._misses,
+            }
+
+
+def get_cache_dir() -> str:
+    return os.environ.get('MAID_CACHE_DIR') or os.path.join(os.path.expanduser('~'), '.cache', 'maid_assistant')
+
+
+def list_cache_names() -> List[str]:
+    return list(_DEFAULT_CACHE_SETTINGS.keys())
+
+
+@lru_cache()
+def get_cache(name: str) -> TwoLevelCache:
+    default_ttl, default_memory_items, default_disk_items = _DEFAULT_CACHE_SETTINGS.get(name, (None, 256, 10000))
+    ttl = get_float_env(f'MAID_CACHE_{name.upper()}_TTL', default_ttl)
+    return TwoLevelCache(
+        name=name,
+        db_file=os.path.join(get_cache_dir(), 'cache.sqlite'),
+        ttl=ttl if ttl is None or ttl > 0 else None,
+        max_memory_items=get_int_env(f'MAID_CACHE_{name.upper()}_MEMORY_ITEMS', default_memory_items),
+        max_disk_items=get_int_env(f'MAID_CACHE_{name.upper()}_DISK_ITEMS', default_disk_items),
+    )
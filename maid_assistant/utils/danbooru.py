@@ -1,11 +1,33 @@
+import os
 from functools import lru_cache
 
 import httpx
-from waifuc.source import DanbooruSource
+
+from .env import get_int_env, get_float_env
+from .http import HttpClient
+
+
+def get_danbooru_base_url() -> str:
+    # can be pointed to a mirror or a local mock server
+    return (os.environ.get('DANBOORU_BASE_URL') or 'https://danbooru.donmai.us').rstrip('/')
 
 
 @lru_cache()
 def get_danbooru_session() -> httpx.Client:
+    # waifuc is slow to import, only the session headers are needed from it
+    from waifuc.source import DanbooruSource
     source = DanbooruSource(['1girl'])
     source._prune_session()
     return source.session
+
+
+@lru_cache()
+def get_danbooru_client() -> HttpClient:
+    return HttpClient(
+        headers=dict(get_danbooru_session().headers),
+        rate=get_float_env('MAID_DANBOORU_RATE', 5.0),
+        burst=get_int_env('MAID_DANBOORU_BURST', 10),
+        max_connections=get_int_env('MAID_DANBOORU_CONNECTIONS', 16),
+        max_keepalive=get_int_env('MAID_DANBOORU_KEEPALIVE', 8),
+        max_retries=get_int_env('MAID_DANBOORU_MAX_RETRIES', 4),
+    )
@@ -0,0 +1,83 @@
+import io
+import threading
+from collections import OrderedDict
+from typing import Union, Optional, Hashable, Dict, Set, Tuple
+
+import numpy as np
+from PIL import Image
+from imgutils.data import load_image
+
+_HASH_SIZE = 8
+
+
+def image_dhash(image: Union[Image.Image, bytes], hash_size: int = _HASH_SIZE) -> int:
+    if isinstance(image, bytes):
+        image = Image.open(io.BytesIO(image))
+    image = load_image(image, mode='RGB', force_background='white')
+    # shrink with the cheap reducer first, the hash only needs a tiny grayscale thumbnail
+    thumbnail = image.copy()
+    thumbnail.thumbnail((hash_size * 8, hash_size * 8), reducing_gap=2.0)
+    pixels = np.asarray(thumbnail.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR), dtype=np.int16)
+    value = 0
+    for bit in (pixels[:, 1:] > pixels[:, :-1]).flatten():
+        value = (value << 1) | int(bit)
+    return value
+
+
+def _hamming_distance(x: int, y: int) -> int:
+    return bin(x ^ y).count('1')
+
+
+class ImageHashIndex:
+    def __init__(self, max_size: int = 1024, threshold: int = 6, bits: int = _HASH_SIZE * _HASH_SIZE):
+        # split the hash into threshold + 1 bands, so any near duplicate shares at least one exact band
+        self.max_size = max_size
+        self.threshold = threshold
+        self.bits = bits
+        self._n_bands = threshold + 1
+        self._band_bits = -(-bits // self._n_bands)
+        self._items: OrderedDict = OrderedDict()
+        self._index: Dict[Tuple[int, int], Set[int]] = {}
+        self._lock = threading.Lock()
+        self.skipped = 0
+
+    def _bands(self, value: int):
+        mask = (1 << self._band_bits) - 1
+        for i in range(self._n_bands):
+            yield i, (value >> (i * self._band_bits)) & mask
+
+    def _find(self, value: int) -> Optional[Hashable]:
+        candidates = set()
+        for band in self._bands(value):
+            candidates.update(self._index.get(band, ()))
+        for candidate in candidates:
+            if _hamming_distance(candidate, value) <= self.threshold:
+                return self._items[candidate]
+        return None
+
+    def _remove(self, value: int):
+        del self._items[value]
+        for band in self._bands(value):
+            values = self._index.get(band)
+            if values is not None:
+                values.discard(value)
+                if not values:
+                    del self._index[band]
+
+    def check_and_add(self, value: int, key: Hashable) -> Optional[Hashable]:
+        with self._lock:
+            exist_key = self._find(value)
+            if exist_key is not None:
+                self.skipped += 1
+                return exist_key
+
+            self._items[value] = key
+            for band in self._bands(value):
+                self._index.setdefault(band, set()).add(value)
+            while len(self._items) > self.max_size:
+                self._remove(next(iter(self._items)))
+            return None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
@@ -0,0 +1,12 @@
+import os
+from typing import Optional
+
+
+def get_int_env(name: str, default: Optional[int]) -> Optional[int]:
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+def get_float_env(name: str, default: Optional[float]) -> Optional[float]:
+    value = os.environ.get(name)
+    return float(value) if value else default
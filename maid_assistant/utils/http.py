@@ -0,0 +1,184 @@
+import logging
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional, Dict
+from urllib.parse import urlsplit
+
+import httpx
+
+from .metrics import get_metrics
+
+try:
+    import h2
+except (ImportError, ModuleNotFoundError):  # pragma: no cover
+    h2 = None
+
+_RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._blocked_until = 0.0
+
+    def reserve(self) -> float:
+        # take one token now, and return how long to wait before it can be used
+        with self._lock:
+            current_time = time.monotonic()
+            self._tokens = min(self._tokens + (current_time - self._updated_at) * self.rate, self.burst)
+            self._updated_at = current_time
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            return max(wait, self._blocked_until - current_time, 0.0)
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def block(self, seconds: float):
+        # all the requests to this host wait, e.g. when Retry-After is given
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+
+class RetryBudget:
+    def __init__(self, ratio: float = 0.2, min_tokens: float = 10.0):
+        # retries are allowed for about `ratio` of the requests, so a failing host will not get cascading retries
+        self.ratio = ratio
+        self.max_tokens = min_tokens
+        self._lock = threading.Lock()
+        self._tokens = min_tokens
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self._tokens + self.ratio, self.max_tokens)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            else:
+                return False
+
+
+_HOST_LIMITERS: Dict[str, TokenBucket] = {}
+_HOST_LIMITERS_LOCK = threading.Lock()
+
+
+def get_host_limiter(host: str, rate: float = 5.0, burst: int = 10) -> TokenBucket:
+    # shared by all the clients, so the total request rate to one host is bounded
+    with _HOST_LIMITERS_LOCK:
+        if host not in _HOST_LIMITERS:
+            _HOST_LIMITERS[host] = TokenBucket(rate=rate, burst=burst)
+        return _HOST_LIMITERS[host]
+
+
+def _get_retry_after(resp: httpx.Response) -> Optional[float]:
+    value = resp.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class HttpClient:
+    def __init__(self, headers: Optional[dict] = None, rate: float = 5.0, burst: int = 10,
+                 max_connections: int = 16, max_keepalive: int = 8, timeout: float = 15.0, max_retries: int = 4,
+                 backoff: float = 0.5, max_backoff: float = 10.0, max_retry_after: float = 60.0,
+                 retry_budget: Optional[RetryBudget] = None):
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_retry_after = max_retry_after
+        self.retry_budget = retry_budget or RetryBudget()
+        self.client = httpx.Client(
+            headers=headers,
+            http2=h2 is not None,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive),
+            timeout=timeout,
+            follow_redirects=True,
+        )
+
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._retries = 0
+        self._throttled = 0
+
+    def _sleep_before_retry(self, attempt: int, limiter: TokenBucket, retry_after: Optional[float]):
+        if retry_after is not None:
+            delay = min(retry_after, self.max_retry_after)
+            limiter.block(delay)
+        else:
+            # full jitter, so the retries from different threads will not hit the host at the same time
+            delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        time.sleep(delay)
+
+    def request(self, method: str, url: str, raise_for_status: bool = True, **kwargs) -> httpx.Response:
+        host = urlsplit(url).hostname or ''
+        limiter = get_host_limiter(host, rate=self.rate, burst=self.burst)
+        metrics = get_metrics()
+        self.retry_budget.deposit()
+        attempt = 0
+        while True:
+            limiter.acquire()
+            with self._lock:
+                self._requests += 1
+
+            start_time = time.perf_counter()
+            try:
+                resp = self.client.request(method, url, **kwargs)
+            except (httpx.TransportError, httpx.TimeoutException) as err:
+                metrics.observe('maid_http_request_seconds', time.perf_counter() - start_time,
+                                host=host, status='error')
+                if attempt >= self.max_retries or not self.retry_budget.withdraw():
+                    raise
+                logging.warning(f'Request {method} {url!r} failed, retrying (#{attempt + 1}) - {err!r}')
+                self._sleep_before_retry(attempt, limiter, None)
+            else:
+                metrics.observe('maid_http_request_seconds', time.perf_counter() - start_time,
+                                host=host, status=resp.status_code)
+                if resp.status_code not in _RETRY_STATUS_CODES or attempt >= self.max_retries or \
+                        not self.retry_budget.withdraw():
+                    if raise_for_status:
+                        resp.raise_for_status()
+                    return resp
+
+                retry_after = _get_retry_after(resp)
+                if resp.status_code == 429:
+                    with self._lock:
+                        self._throttled += 1
+                logging.warning(f'Request {method} {url!r} got status {resp.status_code}, retrying (#{attempt + 1}) '
+                                f'{f"after {retry_after:.1f}s " if retry_after is not None else ""}...')
+                self._sleep_before_retry(attempt, limiter, retry_after)
+
+            attempt += 1
+            metrics.inc('maid_http_retries_total', host=host)
+            with self._lock:
+                self._retries += 1
+
+    def get(self, url: str, **kwargs) -> httpx.Response:
+        return self.request('GET', url, **kwargs)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'requests': self._requests,
+                'retries': self._retries,
+                'throttled': self._throttled,
+            }
@@ -0,0 +1,34 @@
+import io
+import logging
+import math
+from typing import List, Tuple
+
+from PIL import Image
+
+from .metrics import get_metrics
+
+
+def _downscale_image(data: bytes, scale: float, quality: int = 85) -> bytes:
+    image = Image.open(io.BytesIO(data))
+    width, height = image.size
+    image.thumbnail((max(int(width * scale), 1), max(int(height * scale), 1)))
+    with io.BytesIO() as bf:
+        image.save(bf, format='webp', quality=quality)
+        return bf.getvalue()
+
+
+def fit_images_to_size(images: List[Tuple[str, bytes]], max_total_size: int, max_rounds: int = 3) \
+        -> List[Tuple[str, bytes]]:
+    images = list(images)
+    for _ in range(max_rounds):
+        total_size = sum(len(data) for _, data in images)
+        if total_size <= max_total_size:
+            break
+
+        # image bytes shrink roughly with the pixel count, so scale the sides by sqrt of the ratio
+        scale = math.sqrt(max_total_size / total_size) * 0.9
+        logging.info(f'Images are too large ({total_size} bytes in total), downscaling with {scale:.3f} ...')
+        with get_metrics().timer('maid_image_downscale_seconds'):
+            images = [(name, _downscale_image(data, scale)) for name, data in images]
+
+    return images
@@ -0,0 +1,351 @@
+import json
+import logging
+import os
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from functools import lru_cache
+from typing import Callable, Dict, Optional, List, Any
+
+from .cache import get_cache_dir
+from .env import get_int_env, get_float_env
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+JOB_CANCELLED = 'cancelled'
+
+_ACTIVE_STATUSES = (JOB_QUEUED, JOB_RUNNING)
+
+# name -> (workers, running per user, running per guild, pending per user)
+_DEFAULT_JOB_QUEUE_SETTINGS = {
+    'download': (2, 1, 2, 3),
+}
+
+
+class JobCancelledError(Exception):
+    pass
+
+
+class JobQuotaError(Exception):
+    def __init__(self, queue_name: str, limit: int):
+        Exception.__init__(self, f'Too many jobs in queue {queue_name!r}, at most {limit} pending job(s) per user.')
+        self.queue_name = queue_name
+        self.limit = limit
+
+
+class JobContext:
+    def __init__(self, queue: 'JobQueue', job_id: int, payload: dict, output_dir: str):
+        self.queue = queue
+        self.job_id = job_id
+        self.payload = payload
+        self.output_dir = output_dir
+
+    @property
+    def cancelled(self) -> bool:
+        return self.queue.is_cancel_requested(self.job_id)
+
+    def report(self, **progress):
+        # called by the job from time to time, which is also where the cancellation happens
+        self.queue.set_progress(self.job_id, progress)
+        if self.cancelled:
+            raise JobCancelledError(f'Job #{self.job_id} cancelled.')
+
+
+class JobQueue:
+    def __init__(self, name: str, db_file: str, output_dir: str, max_workers: int = 2,
+                 max_running_per_user: int = 1, max_running_per_guild: int = 2, max_pending_per_user: int = 3,
+                 poll_interval: float = 5.0, heartbeat_interval: float = 5.0, stale_timeout: float = 30.0):
+        self.name = name
+        self.db_file = db_file
+        self.output_dir = output_dir
+        self.max_workers = max_workers
+        self.max_running_per_user = max_running_per_user
+        self.max_running_per_guild = max_running_per_guild
+        self.max_pending_per_user = max_pending_per_user
+        # the queue may be shared by several processes, the jobs submitted by others are found by polling
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.stale_timeout = stale_timeout
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+        self._handlers: Dict[str, Callable[[JobContext], Any]] = {}
+        self._condition = threading.Condition(threading.RLock())
+        self._threads: List[threading.Thread] = []
+
+        if os.path.dirname(db_file):
+            os.makedirs(os.path.dirname(db_file), exist_ok=True)
+        self._conn = sqlite3.connect(db_file, check_same_thread=False, isolation_level=None, timeout=30.0)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                           'id INTEGER PRIMARY KEY AUTOINCREMENT, queue TEXT NOT NULL, kind TEXT NOT NULL, '
+                           'payload TEXT NOT NULL, meta TEXT NOT NULL, user_id INTEGER, guild_id INTEGER, '
+                           'status TEXT NOT NULL, progress TEXT NOT NULL, result TEXT, error TEXT, '
+                           'delivered INTEGER NOT NULL DEFAULT 0, created_at REAL NOT NULL, '
+                           'started_at REAL, finished_at REAL, owner TEXT, heartbeat_at REAL, '
+                           'cancel_requested INTEGER NOT NULL DEFAULT 0)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (queue, status, id)')
+        self._migrate()
+
+    def _migrate(self):
+        # databases created by the older versions
+        columns = {row[1] for row in self._conn.execute('PRAGMA table_info(jobs)').fetchall()}
+        for column, definition in [('owner', 'TEXT'), ('heartbeat_at', 'REAL'),
+                                   ('cancel_requested', 'INTEGER NOT NULL DEFAULT 0')]:
+            if column not in columns:
+                try:
+                    self._conn.execute(f'ALTER TABLE jobs ADD COLUMN {column} {definition}')
+                except sqlite3.OperationalError as err:
+                    # added by another process at the same time
+                    if 'duplicate column' not in str(err):
+                        raise
+
+    def register(self, kind: str, fn: Callable[[JobContext], Any]):
+        self._handlers[kind] = fn
+
+    def start(self):
+        with self._condition:
+            # with no workers, this process only submits and watches the jobs
+            if self._threads or self.max_workers <= 0:
+                return
+            self._requeue_stale()
+            for i in range(self.max_workers):
+                thread = threading.Thread(target=self._worker, name=f'maid_job_{self.name}_{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            thread = threading.Thread(target=self._heartbeat, name=f'maid_job_{self.name}_heartbeat', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _requeue_stale(self):
+        # jobs of the processes stopped or crashed, which have not been alive for a while, are run again
+        cursor = self._conn.execute(
+            'UPDATE jobs SET status = ?, started_at = NULL, owner = NULL '
+            'WHERE queue = ? AND status = ? AND (heartbeat_at IS NULL OR heartbeat_at < ?)',
+            (JOB_QUEUED, self.name, JOB_RUNNING, time.time() - self.stale_timeout)
+        )
+        if cursor.rowcount:
+            logging.info(f'{cursor.rowcount} interrupted job(s) requeued in {self.name!r}.')
+            self._condition.notify_all()
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(self.heartbeat_interval)
+            with self._condition:
+                self._conn.execute('UPDATE jobs SET heartbeat_at = ? WHERE queue = ? AND status = ? AND owner = ?',
+                                   (time.time(), self.name, JOB_RUNNING, self.owner))
+                self._requeue_stale()
+
+    @classmethod
+    def _row_to_job(cls, row) -> dict:
+        (id_, _, kind, payload, meta, user_id, guild_id, status, progress, result, error, delivered,
+         created_at, started_at, finished_at, owner, _, _) = row
+        return {
+            'id': id_,
+            'kind': kind,
+            'payload': json.loads(payload),
+            'meta': json.loads(meta),
+            'user_id': user_id,
+            'guild_id': guild_id,
+            'status': status,
+            'progress': json.loads(progress),
+            'result': json.loads(result) if result is not None else None,
+            'error': error,
+            'delivered': bool(delivered),
+            'created_at': created_at,
+            'started_at': started_at,
+            'finished_at': finished_at,
+            'owner': owner,
+        }
+
+    def submit(self, kind: str, payload: dict, user_id: Optional[int] = None, guild_id: Optional[int] = None,
+               meta: Optional[dict] = None) -> int:
+        if kind not in self._handlers:
+            raise KeyError(f'Unknown job kind {kind!r} for queue {self.name!r}.')
+        with self._condition:
+            if user_id is not None:
+                pending, = self._conn.execute(
+                    'SELECT COUNT(*) FROM jobs WHERE queue = ? AND user_id = ? AND status IN (?, ?)',
+                    (self.name, user_id, *_ACTIVE_STATUSES)
+                ).fetchone()
+                if pending >= self.max_pending_per_user:
+                    raise JobQuotaError(self.name, self.max_pending_per_user)
+
+            cursor = self._conn.execute(
+                'INSERT INTO jobs (queue, kind, payload, meta, user_id, guild_id, status, progress, created_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (self.name, kind, json.dumps(payload), json.dumps(meta or {}), user_id, guild_id,
+                 JOB_QUEUED, '{}', time.time())
+            )
+            self._condition.notify_all()
+            logging.info(f'Job #{cursor.lastrowid} ({kind}) submitted to {self.name!r}.')
+            return cursor.lastrowid
+
+    def update_meta(self, job_id: int, **meta):
+        with self._condition:
+            job = self.get(job_id)
+            if job is not None:
+                self._conn.execute('UPDATE jobs SET meta = ? WHERE id = ?',
+                                   (json.dumps({**job['meta'], **meta}), job_id))
+
+    def get(self, job_id: int) -> Optional[dict]:
+        with self._condition:
+            row = self._conn.execute('SELECT * FROM jobs WHERE id = ? AND queue = ?', (job_id, self.name)).fetchone()
+        return self._row_to_job(row) if row else None
+
+    def list_jobs(self, statuses=None, user_id: Optional[int] = None, undelivered: bool = False,
+                  limit: int = 20) -> List[dict]:
+        conditions, params = ['queue = ?'], [self.name]
+        if statuses:
+            conditions.append(f'status IN ({", ".join("?" * len(statuses))})')
+            params.extend(statuses)
+        if user_id is not None:
+            conditions.append('user_id = ?')
+            params.append(user_id)
+        if undelivered:
+            conditions.append('delivered = 0')
+        with self._condition:
+            rows = self._conn.execute(f'SELECT * FROM jobs WHERE {" AND ".join(conditions)} ORDER BY id DESC LIMIT ?',
+                                      (*params, limit)).fetchall()
+        return [self._row_to_job(row) for row in rows]
+
+    def position(self, job_id: int) -> int:
+        with self._condition:
+            count, = self._conn.execute('SELECT COUNT(*) FROM jobs WHERE queue = ? AND status = ? AND id <= ?',
+                                        (self.name, JOB_QUEUED, job_id)).fetchone()
+        return count
+
+    def set_progress(self, job_id: int, progress: dict):
+        with self._condition:
+            self._conn.execute('UPDATE jobs SET progress = ?, heartbeat_at = ? WHERE id = ?',
+                               (json.dumps(progress), time.time(), job_id))
+
+    def is_cancel_requested(self, job_id: int) -> bool:
+        # the job may be cancelled in another process, so it is checked in database
+        with self._condition:
+            row = self._conn.execute('SELECT cancel_requested FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return bool(row and row[0])
+
+    def cancel(self, job_id: int) -> bool:
+        with self._condition:
+            cursor = self._conn.execute('UPDATE jobs SET status = ?, finished_at = ? WHERE id = ? AND queue = ? '
+                                        'AND status = ?', (JOB_CANCELLED, time.time(), job_id, self.name, JOB_QUEUED))
+            if not cursor.rowcount:
+                # running job stops at its next progress report
+                cursor = self._conn.execute('UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND queue = ? '
+                                            'AND status = ?', (job_id, self.name, JOB_RUNNING))
+                if not cursor.rowcount:
+                    return False
+            logging.info(f'Job #{job_id} cancellation requested.')
+            return True
+
+    def get_output_dir(self, job_id: int) -> str:
+        return os.path.join(self.output_dir, str(job_id))
+
+    def mark_delivered(self, job_id: int):
+        # result files are no longer needed once they are sent
+        with self._condition:
+            self._conn.execute('UPDATE jobs SET delivered = 1 WHERE id = ?', (job_id,))
+        shutil.rmtree(self.get_output_dir(job_id), ignore_errors=True)
+
+    def _claim(self) -> Optional[dict]:
+        # other processes may claim at the same time, the write lock of database is taken before reading
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            job = self._claim_in_transaction()
+        except BaseException:
+            self._conn.execute('ROLLBACK')
+            raise
+        else:
+            self._conn.execute('COMMIT')
+            return job
+
+    def _claim_in_transaction(self) -> Optional[dict]:
+        running_users, running_guilds = {}, {}
+        for user_id, guild_id in self._conn.execute('SELECT user_id, guild_id FROM jobs WHERE queue = ? AND status = ?',
+                                                    (self.name, JOB_RUNNING)).fetchall():
+            running_users[user_id] = running_users.get(user_id, 0) + 1
+            running_guilds[guild_id] = running_guilds.get(guild_id, 0) + 1
+
+        for row in self._conn.execute('SELECT * FROM jobs WHERE queue = ? AND status = ? ORDER BY id',
+                                      (self.name, JOB_QUEUED)).fetchall():
+            job = self._row_to_job(row)
+            # jobs over quota stay in queue, so the others are not blocked by one busy user or guild
+            if job['user_id'] is not None and running_users.get(job['user_id'], 0) >= self.max_running_per_user:
+                continue
+            if job['guild_id'] is not None and running_guilds.get(job['guild_id'], 0) >= self.max_running_per_guild:
+                continue
+
+            current_time = time.time()
+            self._conn.execute('UPDATE jobs SET status = ?, started_at = ?, owner = ?, heartbeat_at = ? WHERE id = ?',
+                               (JOB_RUNNING, current_time, self.owner, current_time, job['id']))
+            return job
+
+        return None
+
+    def _finish(self, job_id: int, status: str, result=None, error: Optional[str] = None):
+        with self._condition:
+            cursor = self._conn.execute(
+                'UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE id = ? AND owner = ?',
+                (status, json.dumps(result) if result is not None else None, error, time.time(), job_id, self.owner)
+            )
+            if not cursor.rowcount:
+                logging.warning(f'Job #{job_id} has been taken over by others, the result is dropped.')
+            self._condition.notify_all()
+
+    def _worker(self):
+        while True:
+            with self._condition:
+                try:
+                    job = self._claim()
+                except sqlite3.OperationalError as err:
+                    # database locked by the other processes for too long
+                    logging.warning(f'Unable to claim job from {self.name!r} - {err!r}')
+                    job = None
+                if job is None:
+                    self._condition.wait(timeout=self.poll_interval)
+                    continue
+
+            logging.info(f'Job #{job["id"]} ({job["kind"]}) started in {self.name!r}.')
+            output_dir = self.get_output_dir(job['id'])
+            os.makedirs(output_dir, exist_ok=True)
+            try:
+                result = self._handlers[job['kind']](JobContext(self, job['id'], job['payload'], output_dir))
+            except JobCancelledError:
+                logging.info(f'Job #{job["id"]} cancelled.')
+                shutil.rmtree(output_dir, ignore_errors=True)
+                self._finish(job['id'], JOB_CANCELLED)
+            except Exception as err:
+                logging.exception(f'Job #{job["id"]} failed - {err!r}')
+                shutil.rmtree(output_dir, ignore_errors=True)
+                self._finish(job['id'], JOB_FAILED, error=repr(err))
+            else:
+                logging.info(f'Job #{job["id"]} completed.')
+                self._finish(job['id'], JOB_DONE, result=result)
+
+    def stats(self) -> dict:
+        with self._condition:
+            counts = dict(self._conn.execute('SELECT status, COUNT(*) FROM jobs WHERE queue = ? GROUP BY status',
+                                             (self.name,)).fetchall())
+        return {status: counts.get(status, 0)
+                for status in (JOB_QUEUED, JOB_RUNNING, JOB_DONE, JOB_FAILED, JOB_CANCELLED)}
+
+
+@lru_cache()
+def get_job_queue(name: str) -> JobQueue:
+    default_workers, default_user_running, default_guild_running, default_user_pending = \
+        _DEFAULT_JOB_QUEUE_SETTINGS.get(name, (1, 1, 1, 3))
+    return JobQueue(
+        name=name,
+        db_file=os.path.join(get_cache_dir(), 'jobs.sqlite'),
+        output_dir=os.path.join(get_cache_dir(), 'jobs', name),
+        max_workers=get_int_env(f'MAID_{name.upper()}_JOB_WORKERS', default_workers),
+        max_running_per_user=get_int_env(f'MAID_{name.upper()}_JOB_USER_RUNNING', default_user_running),
+        max_running_per_guild=get_int_env(f'MAID_{name.upper()}_JOB_GUILD_RUNNING', default_guild_running),
+        max_pending_per_user=get_int_env(f'MAID_{name.upper()}_JOB_USER_PENDING', default_user_pending),
+        poll_interval=get_float_env('MAID_JOB_POLL_INTERVAL', 5.0),
+    )
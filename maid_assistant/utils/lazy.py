@@ -0,0 +1,74 @@
+import logging
+import threading
+import time
+from importlib import import_module
+from typing import Dict, Optional, Iterable
+
+from .metrics import get_metrics
+
+
+class LazyModule:
+    def __init__(self, name: str):
+        self.name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._module is not None
+
+    def load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    start_time = time.perf_counter()
+                    module = import_module(self.name)
+                    duration = time.perf_counter() - start_time
+                    get_metrics().observe('maid_import_seconds', duration, module=self.name)
+                    logging.info(f'Module {self.name!r} loaded in {duration:.3f}s.')
+                    self._module = module
+        return self._module
+
+    def __getattr__(self, item):
+        # only called for the attributes not found on the proxy itself
+        return getattr(self.load(), item)
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {self.name!r}, loaded: {self.loaded}>'
+
+
+_LAZY_MODULES: Dict[str, LazyModule] = {}
+_LAZY_MODULES_LOCK = threading.Lock()
+
+
+def lazy_import(name: str) -> LazyModule:
+    with _LAZY_MODULES_LOCK:
+        if name not in _LAZY_MODULES:
+            _LAZY_MODULES[name] = LazyModule(name)
+        return _LAZY_MODULES[name]
+
+
+def prewarm_modules(names: Optional[Iterable[str]] = None) -> Dict[str, float]:
+    # load the lazy modules ahead of their first use, the failed ones are left to fail again when used
+    if names is None:
+        with _LAZY_MODULES_LOCK:
+            modules = list(_LAZY_MODULES.values())
+    else:
+        modules = [lazy_import(name) for name in names]
+    durations = {}
+    for module in modules:
+        if module.loaded:
+            continue
+        start_time = time.perf_counter()
+        try:
+            module.load()
+        except Exception as err:
+            logging.error(f'Failed to prewarm module {module.name!r} - {err!r}')
+        else:
+            durations[module.name] = time.perf_counter() - start_time
+    return durations
+
+
+def list_lazy_modules() -> Dict[str, bool]:
+    with _LAZY_MODULES_LOCK:
+        return {name: module.loaded for name, module in _LAZY_MODULES.items()}
@@ -1,5 +1,7 @@
+import json
 import os
 from functools import lru_cache
+from typing import Optional
 
 from openai import OpenAI
 
@@ -25,3 +27,18 @@ def get_openai_client():
 @lru_cache()
 def get_llm_default_model():
     return os.environ['LLM_DEFAULT_MODEL']
+
+
+_DEFAULT_INPUT_TOKENS = 3000
+
+
+@lru_cache()
+def _get_llm_input_token_budgets():
+    # e.g. {"default": 3000, "gpt-4o-mini": 6000}
+    return json.loads(os.environ.get('LLM_INPUT_TOKENS') or '{}')
+
+
+def get_llm_input_token_budget(model_name: Optional[str] = None) -> int:
+    budgets = _get_llm_input_token_budgets()
+    model_name = model_name or get_llm_default_model()
+    return int(budgets.get(model_name, budgets.get('default', _DEFAULT_INPUT_TOKENS)))
@@ -0,0 +1,133 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+from functools import lru_cache
+from typing import Optional
+
+from huggingface_hub import HfFileSystem, get_hf_file_metadata, hf_hub_url
+
+from .cache import get_cache_dir
+from .env import get_float_env
+
+_CHUNK_SIZE = 1024 ** 2
+
+
+def _stream_max_int(f) -> Optional[int]:
+    # scan the json integer list chunk by chunk, instead of loading millions of integers at once
+    max_value, tail = None, b''
+    while True:
+        chunk = f.read(_CHUNK_SIZE)
+        data = tail + (chunk or b'')
+        if chunk:
+            # the last number may be split by the chunk boundary
+            match = re.search(rb'\d+$', data)
+            data, tail = (data[:match.start()], data[match.start():]) if match else (data, b'')
+        else:
+            tail = b''
+
+        numbers = re.findall(rb'\d+', data)
+        if numbers:
+            chunk_max = max(map(int, numbers))
+            max_value = chunk_max if max_value is None else max(max_value, chunk_max)
+        if not chunk:
+            break
+
+    return max_value
+
+
+class MaxIdService:
+    def __init__(self, repo_id: str, filename: str = 'exist_ids.json', ttl: float = 3600.0,
+                 cache_file: Optional[str] = None):
+        self.repo_id = repo_id
+        self.filename = filename
+        self.ttl = ttl
+        self.cache_file = cache_file
+
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._max_id: Optional[int] = None
+        self._etag: Optional[str] = None
+        self._checked_at: float = 0.0
+        self._refreshing = False
+        self._load()
+
+    def _load(self):
+        if self.cache_file and os.path.exists(self.cache_file):
+            try:
+                with open(self.cache_file, 'r') as f:
+                    data = json.load(f)
+                self._max_id, self._etag, self._checked_at = data['max_id'], data['etag'], data['checked_at']
+            except (OSError, ValueError, KeyError) as err:
+                logging.warning(f'Unable to load max id cache {self.cache_file!r} - {err!r}')
+
+    def _save(self):
+        if self.cache_file:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            tmp_file = f'{self.cache_file}.{os.getpid()}.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump({'max_id': self._max_id, 'etag': self._etag, 'checked_at': self._checked_at}, f)
+            os.replace(tmp_file, self.cache_file)
+
+    def refresh(self):
+        with self._refresh_lock:
+            token = os.environ.get('HF_TOKEN')
+            metadata = get_hf_file_metadata(
+                hf_hub_url(self.repo_id, self.filename, repo_type='dataset'),
+                token=token,
+            )
+            etag = metadata.etag or metadata.commit_hash
+            if self._max_id is not None and etag and etag == self._etag:
+                logging.info(f'Max id of {self.repo_id!r} not changed, revision: {etag!r}.')
+                max_id = self._max_id
+            else:
+                logging.info(f'Scanning max id of {self.repo_id!r}, revision: {etag!r} ...')
+                hf_fs = HfFileSystem(token=token)
+                with hf_fs.open(f'datasets/{self.repo_id}/{self.filename}', 'rb') as f:
+                    max_id = _stream_max_int(f)
+                logging.info(f'Max id of {self.repo_id!r} is {max_id!r}.')
+
+            with self._lock:
+                self._max_id, self._etag, self._checked_at = max_id, etag, time.time()
+                self._save()
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def _refresh():
+            try:
+                self.refresh()
+            except Exception as err:
+                logging.exception(f'Failed to refresh max id of {self.repo_id!r} - {err!r}')
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+        threading.Thread(target=_refresh, name='maid_maxid_refresh', daemon=True).start()
+
+    def get(self) -> int:
+        with self._lock:
+            max_id, checked_at = self._max_id, self._checked_at
+        if max_id is None:
+            self.refresh()
+            with self._lock:
+                return self._max_id
+
+        if checked_at + self.ttl < time.time():
+            self._refresh_in_background()
+        return max_id
+
+
+@lru_cache()
+def get_max_id_service(repo_id: str, filename: str = 'exist_ids.json') -> MaxIdService:
+    return MaxIdService(
+        repo_id=repo_id,
+        filename=filename,
+        ttl=get_float_env('MAID_MAXID_TTL', 3600.0),
+        cache_file=os.path.join(get_cache_dir(), 'maxid', f'{repo_id.replace("/", "__")}__{filename}.json'),
+    )
@@ -0,0 +1,174 @@
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import lru_cache
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, Tuple, Callable, Iterable, List, Optional
+
+_DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+_Labels = Tuple[Tuple[str, str], ...]
+
+
+def _make_labels(labels: dict) -> _Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: _Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    items = [*labels, extra] if extra else list(labels)
+    if not items:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in items) + '}'
+
+
+class Histogram:
+    def __init__(self, buckets=_DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        # estimated with linear interpolation inside the bucket, just like prometheus does
+        if not self.count:
+            return 0.0
+        rank, cumulative = q * self.count, 0
+        for i, count in enumerate(self.counts):
+            if cumulative + count >= rank and count:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, _Labels], float] = {}
+        self._histograms: Dict[Tuple[str, _Labels], Histogram] = {}
+        self._collectors: List[Callable[[], Iterable[Tuple[str, dict, float]]]] = []
+
+    def inc(self, name: str, value: float = 1.0, **labels):
+        key = (name, _make_labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, _make_labels(labels))
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram()
+            self._histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start_time, **labels)
+
+    def register_collector(self, fn: Callable[[], Iterable[Tuple[str, dict, float]]]):
+        # collectors give (name, labels, value) gauges when rendering, e.g. cache sizes
+        with self._lock:
+            self._collectors.append(fn)
+
+    def _collect_gauges(self) -> List[Tuple[str, _Labels, float]]:
+        with self._lock:
+            collectors = list(self._collectors)
+        gauges = []
+        for fn in collectors:
+            try:
+                gauges.extend((name, _make_labels(labels), value) for name, labels, value in fn())
+            except Exception as err:
+                logging.warning(f'Metrics collector {fn!r} failed - {err!r}')
+        return gauges
+
+    def render(self) -> str:
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (h.buckets, list(h.counts), h.sum, h.count))
+                                for key, h in self._histograms.items())
+
+        lines, typed = [], set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f'# TYPE {name} counter')
+                typed.add(name)
+            lines.append(f'{name}{_format_labels(labels)} {value:g}')
+        for (name, labels), (buckets, counts, sum_, count) in histograms:
+            if name not in typed:
+                lines.append(f'# TYPE {name} histogram')
+                typed.add(name)
+            cumulative = 0
+            for bucket, bucket_count in zip([*map(str, buckets), '+Inf'], counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{_format_labels(labels, ("le", bucket))} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {sum_:g}')
+            lines.append(f'{name}_count{_format_labels(labels)} {count}')
+        for name, labels, value in sorted(self._collect_gauges()):
+            if name not in typed:
+                lines.append(f'# TYPE {name} gauge')
+                typed.add(name)
+            lines.append(f'{name}{_format_labels(labels)} {value:g}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self, prefix: Optional[str] = None) -> List[str]:
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (h.count, h.sum, h.quantile(0.5), h.quantile(0.95)))
+                                for key, h in self._histograms.items())
+
+        lines = []
+        for (name, labels), (count, sum_, p50, p95) in histograms:
+            if prefix is None or name.startswith(prefix):
+                lines.append(f'`{name}{_format_labels(labels)}` count: {count}, avg: {sum_ / count:.3f}s, '
+                             f'p50: {p50:.3f}s, p95: {p95:.3f}s')
+        for (name, labels), value in counters:
+            if prefix is None or name.startswith(prefix):
+                lines.append(f'`{name}{_format_labels(labels)}` {value:g}')
+        return lines
+
+
+@lru_cache()
+def get_metrics() -> MetricsRegistry:
+    return MetricsRegistry()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in {'/metrics', '/'}:
+            self.send_error(404)
+            return
+        data = get_metrics().render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@lru_cache()
+def start_metrics_server() -> Optional[ThreadingHTTPServer]:
+    port = os.environ.get('MAID_METRICS_PORT')
+    if not port:
+        return None
+
+    host = os.environ.get('MAID_METRICS_HOST') or '127.0.0.1'
+    server = ThreadingHTTPServer((host, int(port)), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='maid_metrics', daemon=True).start()
+    logging.info(f'Metrics served on http://{host}:{server.server_address[1]}/metrics')
+    return server
@@ -0,0 +1,205 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Optional, Tuple, Callable, Iterable, Any
+
+from hbutils.string import plural_word
+from hbutils.system import TemporaryDirectory
+
+from .cache import get_cache_dir
+from .env import get_int_env, get_float_env
+
+try:
+    import fcntl
+except (ImportError, ModuleNotFoundError):  # pragma: no cover
+    fcntl = None
+
+# the packs being moved in by the other processes are not orphans
+_ORPHAN_GRACE = 3600.0
+
+
+def make_pack_key(site: str, tags: Iterable[str], ratings: Iterable[str], max_id: Optional[int],
+                  max_count: Optional[int], max_total_size: int) -> str:
+    # the same images are packed for the same query on the same snapshot, so the key addresses the content
+    text = json.dumps({
+        'site': site,
+        'tags': sorted({tag.strip().lower() for tag in tags}),
+        'ratings': sorted(set(ratings)),
+        'max_id': max_id,
+        'max_count': max_count,
+        'max_total_size': max_total_size,
+    }, sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class PackCache:
+    def __init__(self, directory: str, db_file: str, max_size: int = 2 * 1024 ** 3, ttl: Optional[float] = None):
+        self.directory = directory
+        self.db_file = db_file
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._lock = threading.RLock()
+        self._key_locks = {}
+        self._hits = 0
+        self._misses = 0
+
+        os.makedirs(os.path.join(directory, '.locks'), exist_ok=True)
+        if os.path.dirname(db_file):
+            os.makedirs(os.path.dirname(db_file), exist_ok=True)
+        self._conn = sqlite3.connect(db_file, check_same_thread=False, isolation_level=None, timeout=30.0)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS pack_items ('
+                           'key TEXT PRIMARY KEY, filename TEXT NOT NULL, size INTEGER NOT NULL, '
+                           'meta TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_pack_items_accessed ON pack_items (accessed_at)')
+        self._remove_orphans()
+
+    def _get_item_dir(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def _remove_orphans(self):
+        # packs written by an interrupted process are not recorded
+        keys = {key for key, in self._conn.execute('SELECT key FROM pack_items').fetchall()}
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name not in keys and not name.startswith('.') and os.path.getmtime(path) + _ORPHAN_GRACE < time.time():
+                shutil.rmtree(path, ignore_errors=True)
+
+        lock_dir = os.path.join(self.directory, '.locks')
+        for name in os.listdir(lock_dir):
+            path = os.path.join(lock_dir, name)
+            if os.path.getmtime(path) + 24 * 3600 < time.time():
+                os.remove(path)
+
+    def _delete(self, key: str):
+        self._conn.execute('DELETE FROM pack_items WHERE key = ?', (key,))
+        shutil.rmtree(self._get_item_dir(key), ignore_errors=True)
+
+    def get(self, key: str) -> Optional[Tuple[str, Any]]:
+        with self._lock:
+            row = self._conn.execute('SELECT filename, meta, created_at FROM pack_items WHERE key = ?',
+                                     (key,)).fetchone()
+            if row is not None:
+                filename, meta, created_at = row
+                package_file = os.path.join(self._get_item_dir(key), filename)
+                if (self.ttl is None or created_at + self.ttl >= time.time()) and os.path.exists(package_file):
+                    self._conn.execute('UPDATE pack_items SET accessed_at = ? WHERE key = ?', (time.time(), key))
+                    self._hits += 1
+                    return package_file, json.loads(meta)
+                else:
+                    self._delete(key)
+
+            self._misses += 1
+            return None
+
+    def put(self, key: str, package_file: str, meta: Any) -> str:
+        filename = os.path.basename(package_file)
+        item_dir = self._get_item_dir(key)
+        with self._lock:
+            self._delete(key)
+            os.makedirs(item_dir, exist_ok=True)
+            dst_file = os.path.join(item_dir, filename)
+            shutil.move(package_file, dst_file)
+            current_time = time.time()
+            self._conn.execute('INSERT INTO pack_items (key, filename, size, meta, created_at, accessed_at) '
+                               'VALUES (?, ?, ?, ?, ?, ?)',
+                               (key, filename, os.path.getsize(dst_file), json.dumps(meta), current_time, current_time))
+            self._evict(keep_key=key)
+            return dst_file
+
+    def _evict(self, keep_key: Optional[str] = None):
+        if self.ttl is not None:
+            for key, in self._conn.execute('SELECT key FROM pack_items WHERE created_at < ?',
+                                           (time.time() - self.ttl,)).fetchall():
+                self._delete(key)
+
+        total_size, = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM pack_items').fetchone()
+        if total_size > self.max_size:
+            evicted = 0
+            for key, size in self._conn.execute('SELECT key, size FROM pack_items ORDER BY accessed_at').fetchall():
+                if total_size <= self.max_size:
+                    break
+                if key != keep_key:
+                    self._delete(key)
+                    total_size -= size
+                    evicted += 1
+            logging.info(f'{plural_word(evicted, "pack")} evicted from pack cache, total size: {total_size}.')
+
+    def _get_key_lock(self, key: str) -> threading.Lock:
+        with self._lock:
+            if key not in self._key_locks:
+                self._key_locks[key] = [threading.Lock(), 0]
+            self._key_locks[key][1] += 1
+            return self._key_locks[key][0]
+
+    def _release_key_lock(self, key: str):
+        with self._lock:
+            self._key_locks[key][1] -= 1
+            if not self._key_locks[key][1]:
+                del self._key_locks[key]
+
+    @contextmanager
+    def _file_lock(self, key: str):
+        # the same for the identical requests in the other processes
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.directory, '.locks', f'{key}.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def get_or_create(self, key: str, fn_build: Callable[[str], Tuple[str, Any]]) -> Tuple[str, Any]:
+        # identical requests wait for the one building the pack, then share it
+        lock = self._get_key_lock(key)
+        try:
+            with lock, self._file_lock(key):
+                hit = self.get(key)
+                if hit is not None:
+                    logging.info(f'Pack {key!r} found in cache.')
+                    return hit
+
+                with TemporaryDirectory() as td:
+                    package_file, meta = fn_build(td)
+                    return self.put(key, package_file, meta), meta
+        finally:
+            self._release_key_lock(key)
+
+    def purge(self) -> int:
+        with self._lock:
+            keys = [key for key, in self._conn.execute('SELECT key FROM pack_items').fetchall()]
+            for key in keys:
+                self._delete(key)
+            return len(keys)
+
+    def stats(self) -> dict:
+        with self._lock:
+            items, total_size = self._conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM pack_items').fetchone()
+            return {
+                'items': items,
+                'disk_size': total_size,
+                'max_size': self.max_size,
+                'hits': self._hits,
+                'misses': self._misses,
+            }
+
+
+@lru_cache()
+def get_pack_cache() -> PackCache:
+    ttl = get_float_env('MAID_PACK_CACHE_TTL', 24 * 3600.0)
+    return PackCache(
+        directory=os.path.join(get_cache_dir(), 'packs'),
+        db_file=os.path.join(get_cache_dir(), 'cache.sqlite'),
+        max_size=get_int_env('MAID_PACK_CACHE_SIZE', 2 * 1024 ** 3),
+        ttl=ttl if ttl > 0 else None,
+    )
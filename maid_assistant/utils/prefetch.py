@@ -0,0 +1,86 @@
+import logging
+from queue import Queue, Full, Empty
+from threading import Thread, Event, Semaphore
+from typing import Iterable, Iterator, Any
+
+_ITEM = 'item'
+_END = 'end'
+
+
+class PrefetchIterator(Iterator[Any]):
+    def __init__(self, iterable: Iterable, lookahead: int = 400, name: str = 'prefetch'):
+        self.name = name
+        self._queue = Queue(maxsize=lookahead)
+        self._stopped = Event()
+        self._thread = Thread(target=self._produce, args=(iter(iterable),), name=f'maid_{name}', daemon=True)
+        self._thread.start()
+
+    def _put(self, item) -> bool:
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, block=True, timeout=0.5)
+            except Full:
+                continue
+            else:
+                return True
+        return False
+
+    def _produce(self, iterator):
+        try:
+            for item in iterator:
+                if not self._put((_ITEM, item)):
+                    break
+        except Exception as err:
+            logging.exception(f'Error occurred when prefetching items for {self.name!r} - {err!r}')
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+            self._put((_END, None))
+
+    def __next__(self):
+        while not self._stopped.is_set():
+            try:
+                kind, value = self._queue.get(block=True, timeout=0.5)
+            except Empty:
+                continue
+
+            if kind == _END:
+                self._stopped.set()
+                break
+            else:
+                return value
+
+        raise StopIteration
+
+    def close(self):
+        self._stopped.set()
+
+    @property
+    def closed(self) -> bool:
+        return self._stopped.is_set()
+
+
+class BoundedIterator(Iterator[Any]):
+    def __init__(self, iterable: Iterable, limit: int):
+        self._iterator = iter(iterable)
+        self._semaphore = Semaphore(limit)
+        self._stopped = Event()
+
+    def __next__(self):
+        # blocked when `limit` items are given out but not released yet
+        while not self._semaphore.acquire(timeout=0.5):
+            if self._stopped.is_set():
+                raise StopIteration
+        if self._stopped.is_set():
+            raise StopIteration
+        return next(self._iterator)
+
+    def release(self, *_):
+        self._semaphore.release()
+
+    def close(self):
+        self._stopped.set()
+
+    @property
+    def closed(self) -> bool:
+        return self._stopped.is_set()
@@ -0,0 +1,57 @@
+import asyncio
+import logging
+from functools import lru_cache
+from typing import Awaitable, Callable, Dict, Hashable, List
+
+
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        self._flights: Dict[Hashable, asyncio.Future] = {}
+        self.calls = 0
+        self.merged = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable]):
+        self.calls += 1
+        if key in self._flights:
+            self.merged += 1
+            logging.info(f'Request {key!r} merged into the in-flight one of {self.name!r}.')
+            return await asyncio.shield(self._flights[key])
+
+        future = asyncio.get_running_loop().create_future()
+        self._flights[key] = future
+        try:
+            result = await fn()
+        except BaseException as err:
+            if isinstance(err, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(err)
+                # the waiters will get this error, so do not warn when there is none
+                future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._flights[key]
+
+    def stats(self) -> dict:
+        return {
+            'calls': self.calls,
+            'merged': self.merged,
+            'in_flight': len(self._flights),
+        }
+
+
+_SINGLE_FLIGHT_NAMES: List[str] = []
+
+
+def list_single_flight_names() -> List[str]:
+    return list(_SINGLE_FLIGHT_NAMES)
+
+
+@lru_cache()
+def get_single_flight(name: str) -> SingleFlight:
+    _SINGLE_FLIGHT_NAMES.append(name)
+    return SingleFlight(name)
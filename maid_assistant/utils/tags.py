@@ -0,0 +1,212 @@
+import heapq
+import logging
+import re
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from functools import lru_cache
+from typing import Iterable, Tuple, List, Optional, Dict, Callable
+
+import numpy as np
+from hbutils.string import plural_word
+
+from .env import get_int_env, get_float_env
+from .wiki import get_wiki_index, normalize_wiki_title
+
+_SHORT_PREFIX_LENGTH = 2
+_PREFIX_END = '\U0010ffff'
+_MAX_FUZZY_KEY_LENGTH = 40
+
+
+def _squash(name: str) -> str:
+    # surtr_arknights -> surtrarknights <- surtr_(arknights)
+    return re.sub(r'[\W_]+', '', name.lower())
+
+
+def _deletes(key: str) -> List[str]:
+    return [key, *(key[:i] + key[i + 1:] for i in range(len(key)))]
+
+
+def _bounded_distance(a: str, b: str, max_distance: int) -> int:
+    # levenshtein distance, gives up with max_distance + 1 when it is already too far
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, start=1):
+        current = [i]
+        for j, cb in enumerate(b, start=1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return previous[-1]
+
+
+class TagResolver:
+    def __init__(self, entries: Iterable[Tuple[str, str, int]], max_distance: int = 2,
+                 fn_lookup: Optional[Callable[[List[str]], Dict[str, int]]] = None, min_similarity: float = 0.85):
+        self.max_distance = max_distance
+        # fuzzy matches less similar than this are only suggested, never used to correct the tags
+        self.min_similarity = min_similarity
+        # for the rare tags not loaded into memory
+        self.fn_lookup = fn_lookup
+
+        tag_ids: Dict[str, int] = {}
+        self._tags: List[str] = []
+        self._counts = array('q')
+        keys, squashed_keys = [], []
+        for name, tag, post_count in entries:
+            if tag not in tag_ids:
+                tag_ids[tag] = len(self._tags)
+                self._tags.append(tag)
+                self._counts.append(post_count or 0)
+            tag_id = tag_ids[tag]
+            key = normalize_wiki_title(name)
+            if key:
+                keys.append((key, tag_id))
+            squashed_key = _squash(name)
+            if squashed_key:
+                squashed_keys.append((squashed_key, tag_id))
+
+        # sorted arrays instead of a trie, prefix ranges are found by binary search
+        keys.sort()
+        squashed_keys.sort()
+        self._keys = [key for key, _ in keys]
+        self._key_tags = array('l', (tag_id for _, tag_id in keys))
+        self._squashed_keys = [key for key, _ in squashed_keys]
+        self._squashed_key_tags = array('l', (tag_id for _, tag_id in squashed_keys))
+
+        # symmetric deletion index, keys with one character deleted on both sides meet each other,
+        # which covers insertions, deletions, substitutions and transpositions
+        delete_hashes, delete_keys = array('q'), array('l')
+        for i, key in enumerate(self._squashed_keys):
+            if len(key) <= _MAX_FUZZY_KEY_LENGTH and (i == 0 or key != self._squashed_keys[i - 1]):
+                variant_hashes = {hash(variant) for variant in _deletes(key)}
+                delete_hashes.extend(variant_hashes)
+                delete_keys.extend([i] * len(variant_hashes))
+        delete_hashes = np.frombuffer(delete_hashes, dtype=np.int64)
+        order = np.argsort(delete_hashes, kind='stable')
+        self._delete_hashes = delete_hashes[order]
+        self._delete_keys = np.frombuffer(delete_keys, dtype=np.dtype(f'i{delete_keys.itemsize}'))[order]
+
+        self._short_prefix_cache: Dict[Tuple[str, int], List[Tuple[str, int]]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._tags)
+
+    def _range(self, keys: List[str], prefix: str) -> Tuple[int, int]:
+        return bisect_left(keys, prefix), bisect_left(keys, prefix + _PREFIX_END)
+
+    def _top_tags(self, tag_ids: Iterable[int], limit: int) -> List[Tuple[str, int]]:
+        tag_ids = heapq.nlargest(limit, set(tag_ids), key=lambda x: self._counts[x])
+        return [(self._tags[tag_id], self._counts[tag_id]) for tag_id in tag_ids]
+
+    def _exact(self, keys: List[str], key_tags: array, key: str) -> Optional[str]:
+        lo, hi = self._range(keys, key)
+        tag_ids = [key_tags[i] for i in range(lo, hi) if keys[i] == key]
+        return self._top_tags(tag_ids, 1)[0][0] if tag_ids else None
+
+    def complete(self, prefix: str, limit: int = 25) -> List[Tuple[str, int]]:
+        prefix = normalize_wiki_title(prefix)
+        cache_key = (prefix, limit)
+        if len(prefix) <= _SHORT_PREFIX_LENGTH:
+            # short prefixes cover huge ranges, so the results are kept
+            with self._lock:
+                if cache_key in self._short_prefix_cache:
+                    return self._short_prefix_cache[cache_key]
+
+        lo, hi = self._range(self._keys, prefix)
+        retval = self._top_tags(self._key_tags[lo:hi], limit)
+        if len(prefix) <= _SHORT_PREFIX_LENGTH:
+            with self._lock:
+                self._short_prefix_cache[cache_key] = retval
+        return retval
+
+    def _fuzzy(self, key: str, limit: int, max_distance: Optional[int] = None) -> List[Tuple[int, int]]:
+        # (tag id, distance) of the closest tags
+        if not key:
+            return []
+        if max_distance is None:
+            max_distance = min(self.max_distance, max(len(key) // 4, 1))
+
+        query_hashes = np.array([hash(variant) for variant in set(_deletes(key))], dtype=np.int64)
+        lefts = np.searchsorted(self._delete_hashes, query_hashes, side='left')
+        rights = np.searchsorted(self._delete_hashes, query_hashes, side='right')
+        candidates = {int(i) for lo, hi in zip(lefts, rights) for i in self._delete_keys[lo:hi]}
+
+        scores: Dict[int, Tuple[int, int]] = {}
+        for i in candidates:
+            distance = _bounded_distance(key, self._squashed_keys[i], max_distance)
+            if distance <= max_distance:
+                # the same squashed key may be shared by several tags
+                for j in range(i, len(self._squashed_keys)):
+                    if self._squashed_keys[j] != self._squashed_keys[i]:
+                        break
+                    tag_id = self._squashed_key_tags[j]
+                    score = (distance, -self._counts[tag_id])
+                    scores[tag_id] = min(scores.get(tag_id, score), score)
+
+        tag_ids = heapq.nsmallest(limit, scores, key=lambda x: scores[x])
+        return [(tag_id, scores[tag_id][0]) for tag_id in tag_ids]
+
+    def suggest(self, name: str, limit: int = 5, max_distance: Optional[int] = None) -> List[Tuple[str, int]]:
+        return [(self._tags[tag_id], self._counts[tag_id])
+                for tag_id, _ in self._fuzzy(_squash(name), limit, max_distance)]
+
+    def resolve(self, name: str, fuzzy: bool = True) -> Optional[str]:
+        key = normalize_wiki_title(name)
+        tag = self._exact(self._keys, self._key_tags, key)
+        if tag is None:
+            tag = self._exact(self._squashed_keys, self._squashed_key_tags, _squash(name))
+        if tag is None and self.fn_lookup is not None and key and self.fn_lookup([key]):
+            tag = key
+        if tag is None and fuzzy:
+            squashed_key = _squash(name)
+            matches = self._fuzzy(squashed_key, limit=1)
+            if matches and 1.0 - matches[0][1] / len(squashed_key) >= self.min_similarity:
+                tag = self._tags[matches[0][0]]
+        return tag
+
+    def resolve_query(self, tags: List[str], fuzzy: bool = True) \
+            -> Tuple[List[str], Dict[str, str], Dict[str, List[str]]]:
+        retval, corrections, unknown = [], {}, {}
+        for tag in tags:
+            prefix, name = re.fullmatch(r'([-~]?)(.*)', tag).groups()
+            if not name or '*' in name or \
+                    (re.match(r'^[a-z_]+:', name, re.IGNORECASE) and self.resolve(name, fuzzy=False) is None):
+                # wildcards and metatags (e.g. rating:g, order:score) are kept as they are
+                retval.append(tag)
+                continue
+
+            resolved = self.resolve(name, fuzzy=fuzzy)
+            if resolved is None:
+                unknown[tag] = [suggestion for suggestion, _ in self.suggest(name)]
+                retval.append(tag)
+            else:
+                if resolved != name:
+                    corrections[tag] = f'{prefix}{resolved}'
+                retval.append(f'{prefix}{resolved}')
+
+        return retval, corrections, unknown
+
+
+@lru_cache(maxsize=1)
+def _load_tag_resolver(revision: int) -> TagResolver:
+    start_time = time.time()
+    wiki_index = get_wiki_index()
+    resolver = TagResolver(
+        wiki_index.iter_resolver_entries(min_post_count=get_int_env('MAID_TAG_RESOLVER_MIN_POSTS', 20)),
+        max_distance=get_int_env('MAID_TAG_RESOLVER_MAX_DISTANCE', 2),
+        fn_lookup=wiki_index.get_post_counts,
+        min_similarity=get_float_env('MAID_TAG_RESOLVER_MIN_SIMILARITY', 0.85),
+    )
+    logging.info(f'Tag resolver loaded with {plural_word(len(resolver), "tag")} '
+                 f'in {time.time() - start_time:.2f}s, index revision: {revision!r}.')
+    return resolver
+
+
+def get_tag_resolver() -> TagResolver:
+    # rebuilt when the index is updated or ingested, including by the other processes
+    return _load_tag_resolver(get_wiki_index().revision)
@@ -0,0 +1,57 @@
+import logging
+import re
+from functools import lru_cache
+from typing import Optional
+
+try:
+    import tiktoken
+except (ImportError, ModuleNotFoundError):  # pragma: no cover
+    tiktoken = None
+
+_CJK_PATTERN = re.compile(r'[぀-ヿ㐀-䶿一-鿿가-힯]')
+
+
+@lru_cache()
+def _get_encoding(model_name: Optional[str] = None):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model_name) if model_name else tiktoken.get_encoding('cl100k_base')
+    except KeyError:
+        return tiktoken.get_encoding('cl100k_base')
+    except Exception as err:
+        logging.warning(f'Unable to load tiktoken encoding, use estimation instead - {err!r}')
+        return None
+
+
+def _estimate_tokens(text: str) -> int:
+    # when tiktoken is not installed, about 1 token per cjk character and 4 other characters
+    cjk_count = len(_CJK_PATTERN.findall(text))
+    return cjk_count + (len(text) - cjk_count + 3) // 4
+
+
+def count_tokens(text: str, model_name: Optional[str] = None) -> int:
+    encoding = _get_encoding(model_name)
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    else:
+        return _estimate_tokens(text)
+
+
+def truncate_tokens(text: str, max_tokens: int, model_name: Optional[str] = None, suffix: str = ' ...') -> str:
+    if count_tokens(text, model_name) <= max_tokens:
+        return text
+
+    encoding = _get_encoding(model_name)
+    if encoding is not None:
+        truncated = encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+    else:
+        truncated = text
+        while truncated and _estimate_tokens(truncated) > max_tokens:
+            truncated = truncated[:int(len(truncated) * max_tokens / _estimate_tokens(truncated))]
+
+    # cut at the last line or sentence ending, when it does not lose too much
+    cut = max(truncated.rfind('\n'), truncated.rfind('. '), truncated.rfind('。'))
+    if cut >= len(truncated) * 0.8:
+        truncated = truncated[:cut + 1]
+    return truncated.rstrip() + suffix
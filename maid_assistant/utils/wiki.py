@@ -0,0 +1,388 @@
+import gzip
+import itertools
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Optional, List, Dict, Iterator, Tuple
+
+from hbutils.string import plural_word
+
+from .cache import get_cache_dir
+from .danbooru import get_danbooru_client, get_danbooru_base_url
+
+_INGEST_BATCH_SIZE = 2000
+_API_PAGE_SIZE = 200
+
+
+def normalize_wiki_title(title: str) -> str:
+    return re.sub(r'_+', '_', re.sub(r'\s+', '_', title.strip().lower())).strip('_')
+
+
+def _to_names(value) -> List[str]:
+    if not value:
+        return []
+    elif isinstance(value, str):
+        # some dumps keep other names as space separated text
+        return [name for name in value.split() if name]
+    else:
+        return [str(name) for name in value if name]
+
+
+def _iter_dump_records(dump_file: str) -> Iterator[dict]:
+    if dump_file.endswith('.parquet'):
+        try:
+            import pandas as pd
+        except (ImportError, ModuleNotFoundError):  # pragma: no cover
+            raise EnvironmentError('Parquet dump requires pandas and pyarrow, '
+                                   'please install them with `pip install pandas pyarrow`.')
+
+        for record in pd.read_parquet(dump_file).to_dict(orient='records'):
+            yield {key: (value.tolist() if hasattr(value, 'tolist') else value) for key, value in record.items()}
+
+    else:
+        opener = gzip.open if dump_file.endswith('.gz') else open
+        with opener(dump_file, 'rt', encoding='utf-8') as f:
+            first_char = f.read(1)
+            f.seek(0)
+            if first_char == '[':
+                yield from json.load(f)
+            else:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+
+
+class WikiIndex:
+    def __init__(self, db_file: str):
+        self.db_file = db_file
+        self._lock = threading.RLock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _get_conn(self, create: bool = False) -> Optional[sqlite3.Connection]:
+        with self._lock:
+            if self._conn is None and (create or os.path.exists(self.db_file)):
+                if os.path.dirname(self.db_file):
+                    os.makedirs(os.path.dirname(self.db_file), exist_ok=True)
+                conn = sqlite3.connect(self.db_file, check_same_thread=False, isolation_level=None, timeout=30.0)
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute('CREATE TABLE IF NOT EXISTS wiki_pages ('
+                             'title TEXT PRIMARY KEY, id INTEGER, body TEXT NOT NULL, other_names TEXT NOT NULL, '
+                             'is_deleted INTEGER NOT NULL DEFAULT 0, updated_at TEXT)')
+                conn.execute('CREATE TABLE IF NOT EXISTS wiki_other_names ('
+                             'name TEXT NOT NULL, title TEXT NOT NULL, PRIMARY KEY (name, title))')
+                conn.execute('CREATE INDEX IF NOT EXISTS idx_wiki_other_names_title ON wiki_other_names (title)')
+                conn.execute('CREATE TABLE IF NOT EXISTS tags ('
+                             'name TEXT PRIMARY KEY, id INTEGER, post_count INTEGER NOT NULL DEFAULT 0, '
+                             'category INTEGER, is_deprecated INTEGER NOT NULL DEFAULT 0, updated_at TEXT)')
+                conn.execute('CREATE TABLE IF NOT EXISTS tag_aliases ('
+                             'antecedent_name TEXT PRIMARY KEY, consequent_name TEXT NOT NULL, '
+                             'status TEXT NOT NULL, updated_at TEXT)')
+                conn.execute('CREATE TABLE IF NOT EXISTS index_meta (key TEXT PRIMARY KEY, value TEXT)')
+                self._conn = conn
+            return self._conn
+
+    @property
+    def available(self) -> bool:
+        return self._get_conn() is not None
+
+    @classmethod
+    def _row_to_wiki(cls, row) -> dict:
+        title, id_, body, other_names, is_deleted, updated_at = row
+        return {
+            'id': id_,
+            'title': title,
+            'body': body,
+            'other_names': json.loads(other_names),
+            'is_deleted': bool(is_deleted),
+            'updated_at': updated_at,
+        }
+
+    def get_wiki(self, title: str) -> Optional[dict]:
+        return self.get_wikis([title]).get(normalize_wiki_title(title))
+
+    def get_wikis(self, titles: List[str]) -> Dict[str, dict]:
+        conn = self._get_conn()
+        titles = list(dict.fromkeys(normalize_wiki_title(title) for title in titles))
+        if conn is None or not titles:
+            return {}
+
+        retval = {}
+        with self._lock:
+            for i in range(0, len(titles), 500):
+                chunk = titles[i:i + 500]
+                for row in conn.execute(
+                        f'SELECT title, id, body, other_names, is_deleted, updated_at FROM wiki_pages '
+                        f'WHERE title IN ({", ".join("?" * len(chunk))}) AND is_deleted = 0', chunk).fetchall():
+                    retval[row[0]] = self._row_to_wiki(row)
+        return retval
+
+    def find_wiki_by_other_name(self, name: str) -> Optional[dict]:
+        conn = self._get_conn()
+        if conn is None:
+            return None
+        with self._lock:
+            row = conn.execute(
+                'SELECT p.title, p.id, p.body, p.other_names, p.is_deleted, p.updated_at '
+                'FROM wiki_other_names n JOIN wiki_pages p ON p.title = n.title '
+                'WHERE n.name = ? AND p.is_deleted = 0 ORDER BY p.updated_at DESC LIMIT 1',
+                (normalize_wiki_title(name),)
+            ).fetchone()
+        return self._row_to_wiki(row) if row else None
+
+    def get_post_counts(self, names: List[str]) -> Dict[str, int]:
+        conn = self._get_conn()
+        names = list(dict.fromkeys(names))
+        if conn is None or not names:
+            return {}
+
+        retval = {}
+        with self._lock:
+            for i in range(0, len(names), 500):
+                chunk = names[i:i + 500]
+                retval.update(conn.execute(
+                    f'SELECT name, post_count FROM tags WHERE name IN ({", ".join("?" * len(chunk))})',
+                    chunk
+                ).fetchall())
+        return retval
+
+    def _upsert_wikis(self, conn: sqlite3.Connection, records: List[dict]) -> int:
+        rows = []
+        for record in records:
+            title = normalize_wiki_title(record.get('title') or '')
+            if title:
+                rows.append((
+                    title, record.get('id'), record.get('body') or '',
+                    json.dumps(_to_names(record.get('other_names')), ensure_ascii=False),
+                    int(bool(record.get('is_deleted'))), record.get('updated_at'),
+                ))
+
+        # older records never overwrite newer ones, so dumps and api updates can be applied in any order
+        cursor = conn.executemany(
+            'INSERT INTO wiki_pages (title, id, body, other_names, is_deleted, updated_at) VALUES (?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (title) DO UPDATE SET id = excluded.id, body = excluded.body, '
+            'other_names = excluded.other_names, is_deleted = excluded.is_deleted, updated_at = excluded.updated_at '
+            'WHERE wiki_pages.updated_at IS NULL OR excluded.updated_at >= wiki_pages.updated_at',
+            rows
+        )
+        titles = [row[0] for row in rows]
+        conn.executemany('DELETE FROM wiki_other_names WHERE title = ?', [(title,) for title in titles])
+        conn.executemany(
+            'INSERT OR IGNORE INTO wiki_other_names (name, title) '
+            "SELECT lower(replace(trim(value), ' ', '_')), title "
+            'FROM wiki_pages, json_each(wiki_pages.other_names) WHERE title = ?',
+            [(title,) for title in titles]
+        )
+        return cursor.rowcount
+
+    def _upsert_tags(self, conn: sqlite3.Connection, records: List[dict]) -> int:
+        rows = [
+            (record['name'], record.get('id'), record.get('post_count') or 0, record.get('category'),
+             int(bool(record.get('is_deprecated'))), record.get('updated_at'))
+            for record in records if record.get('name')
+        ]
+        cursor = conn.executemany(
+            'INSERT INTO tags (name, id, post_count, category, is_deprecated, updated_at) VALUES (?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (name) DO UPDATE SET id = excluded.id, post_count = excluded.post_count, '
+            'category = excluded.category, is_deprecated = excluded.is_deprecated, updated_at = excluded.updated_at '
+            'WHERE tags.updated_at IS NULL OR excluded.updated_at >= tags.updated_at',
+            rows
+        )
+        return cursor.rowcount
+
+    def _upsert_tag_aliases(self, conn: sqlite3.Connection, records: List[dict]) -> int:
+        rows = [
+            (record['antecedent_name'], record['consequent_name'], record.get('status') or 'active',
+             record.get('updated_at'))
+            for record in records if record.get('antecedent_name') and record.get('consequent_name')
+        ]
+        cursor = conn.executemany(
+            'INSERT INTO tag_aliases (antecedent_name, consequent_name, status, updated_at) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT (antecedent_name) DO UPDATE SET consequent_name = excluded.consequent_name, '
+            'status = excluded.status, updated_at = excluded.updated_at '
+            'WHERE tag_aliases.updated_at IS NULL OR excluded.updated_at >= tag_aliases.updated_at',
+            rows
+        )
+        return cursor.rowcount
+
+    @classmethod
+    def _split_records(cls, records: List[dict]) -> Dict[str, List[dict]]:
+        return {
+            'wiki_pages': [record for record in records if 'title' in record and 'body' in record],
+            'tags': [record for record in records if 'name' in record and 'post_count' in record],
+            'tag_aliases': [record for record in records
+                            if 'antecedent_name' in record and 'consequent_name' in record],
+        }
+
+    def _apply(self, records: List[dict]) -> Dict[str, int]:
+        tables = self._split_records(records)
+        conn = self._get_conn(create=True)
+        with self._lock:
+            conn.execute('BEGIN')
+            try:
+                retval = {
+                    'wiki_pages': self._upsert_wikis(conn, tables['wiki_pages']) if tables['wiki_pages'] else 0,
+                    'tags': self._upsert_tags(conn, tables['tags']) if tables['tags'] else 0,
+                    'tag_aliases': self._upsert_tag_aliases(conn, tables['tag_aliases'])
+                    if tables['tag_aliases'] else 0,
+                }
+                # the tag resolvers built from the older revisions are rebuilt
+                conn.execute("INSERT INTO index_meta (key, value) VALUES ('revision', '1') "
+                             'ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + 1')
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        return retval
+
+    def ingest(self, dump_file: str) -> Dict[str, int]:
+        logging.info(f'Ingesting dump file {dump_file!r} into wiki index {self.db_file!r} ...')
+        retval, batch = {'wiki_pages': 0, 'tags': 0, 'tag_aliases': 0}, []
+        latest = {}
+        for record in itertools.chain(_iter_dump_records(dump_file), [None]):
+            if record is not None:
+                batch.append(record)
+            if batch and (record is None or len(batch) >= _INGEST_BATCH_SIZE):
+                for table, records in self._split_records(batch).items():
+                    latest[table] = max([latest.get(table) or '', *(r.get('updated_at') or '' for r in records)])
+                for key, count in self._apply(batch).items():
+                    retval[key] += count
+                batch = []
+
+        # the dump is a full snapshot, so the api updates can start from its newest records
+        for table, value in latest.items():
+            if value and value > (self._get_meta(f'{table}_updated_at') or ''):
+                self._set_meta(f'{table}_updated_at', value)
+
+        logging.info(f'{plural_word(retval["wiki_pages"], "wiki page")}, {plural_word(retval["tags"], "tag")} and '
+                     f'{plural_word(retval["tag_aliases"], "tag alias")} ingested from {dump_file!r}.')
+        return retval
+
+    def iter_resolver_entries(self, min_post_count: int = 1) -> Iterator[Tuple[str, str, int]]:
+        # (lookup name, tag name, post count), lookup names are tag names, aliases and other names of wiki pages
+        conn = self._get_conn()
+        if conn is None:
+            return
+        with self._lock:
+            rows = conn.execute(
+                'SELECT name, name, post_count FROM tags WHERE post_count >= ? AND is_deprecated = 0 '
+                'UNION ALL '
+                'SELECT a.antecedent_name, t.name, t.post_count FROM tag_aliases a '
+                "JOIN tags t ON t.name = a.consequent_name WHERE a.status = 'active' AND t.post_count >= ? "
+                'UNION ALL '
+                'SELECT n.name, t.name, t.post_count FROM wiki_other_names n '
+                'JOIN tags t ON t.name = n.title WHERE t.post_count >= ?',
+                (min_post_count, min_post_count, min_post_count)
+            ).fetchall()
+        yield from rows
+
+    def _get_meta(self, key: str) -> Optional[str]:
+        conn = self._get_conn()
+        if conn is None:
+            return None
+        with self._lock:
+            row = conn.execute('SELECT value FROM index_meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key: str, value: str):
+        conn = self._get_conn(create=True)
+        with self._lock:
+            conn.execute('INSERT OR REPLACE INTO index_meta (key, value) VALUES (?, ?)', (key, value))
+
+    @property
+    def revision(self) -> int:
+        return int(self._get_meta('revision') or 0)
+
+    def _del_meta(self, key: str):
+        conn = self._get_conn(create=True)
+        with self._lock:
+            conn.execute('DELETE FROM index_meta WHERE key = ?', (key,))
+
+    def _get_last_updated_at(self, table: str) -> Optional[str]:
+        # the watermark is only advanced when fully caught up, an empty one means nothing is updated yet,
+        # the newest record is only used for the index ingested before the watermark is kept
+        value = self._get_meta(f'{table}_updated_at')
+        if value is None and self.available:
+            with self._lock:
+                value, = self._conn.execute(f'SELECT MAX(updated_at) FROM {table}').fetchone()
+        return value or None
+
+    def _update_table_from_danbooru(self, table: str, endpoint: str, max_pages: int) -> int:
+        # records updated since the watermark are walked in ascending id order, the progress is saved after
+        # every page, so the runs stopped by the page limit are continued by the next ones
+        client = get_danbooru_client()
+        since = self._get_last_updated_at(table)
+        if self._get_meta(f'{table}_updated_at') is None:
+            # kept for the walk, or the records fetched by this run will be taken as the watermark
+            self._set_meta(f'{table}_updated_at', since or '')
+        cursor = int(self._get_meta(f'{table}_cursor') or 0)
+        # the records passed by the cursor may be updated again before it is done, so the next watermark is
+        # when this walk is started, with some tolerance for the clock of danbooru
+        started_at = self._get_meta(f'{table}_started_at') or \
+                     (datetime.now(timezone.utc) - timedelta(minutes=10)).isoformat(timespec='milliseconds')
+        params = {'limit': str(_API_PAGE_SIZE)}
+        if since:
+            params['search[updated_at]'] = f'>={since}'
+
+        count = 0
+        for _ in range(max_pages):
+            resp = client.get(f'{get_danbooru_base_url()}/{endpoint}',
+                              params={**params, 'page': f'a{cursor}'})
+            records = resp.json()
+            if records:
+                self._apply(records)
+                count += len(records)
+                cursor = max(cursor, *(record['id'] for record in records))
+            if len(records) < _API_PAGE_SIZE:
+                break
+            self._set_meta(f'{table}_cursor', str(cursor))
+            self._set_meta(f'{table}_started_at', started_at)
+        else:
+            logging.warning(f'Page limit {max_pages!r} reached when updating {table!r}, '
+                            f'it will be continued from id {cursor!r} next time.')
+            return count
+
+        # fully caught up, the next run only needs the records updated since then
+        self._set_meta(f'{table}_updated_at', started_at)
+        self._del_meta(f'{table}_cursor')
+        self._del_meta(f'{table}_started_at')
+        return count
+
+    def update_from_danbooru(self, max_pages: int = 50, with_tags: bool = True) -> Dict[str, int]:
+        start_time = time.time()
+        retval = {'wiki_pages': self._update_table_from_danbooru('wiki_pages', 'wiki_pages.json', max_pages)}
+        if with_tags:
+            retval['tags'] = self._update_table_from_danbooru('tags', 'tags.json', max_pages)
+            retval['tag_aliases'] = self._update_table_from_danbooru('tag_aliases', 'tag_aliases.json', max_pages)
+        logging.info(f'Wiki index updated in {time.time() - start_time:.2f}s - {retval!r}')
+        return retval
+
+    def stats(self) -> dict:
+        conn = self._get_conn()
+        if conn is None:
+            return {'available': False}
+        with self._lock:
+            wiki_pages, = conn.execute('SELECT COUNT(*) FROM wiki_pages').fetchone()
+            other_names, = conn.execute('SELECT COUNT(*) FROM wiki_other_names').fetchone()
+            tags, = conn.execute('SELECT COUNT(*) FROM tags').fetchone()
+            tag_aliases, = conn.execute('SELECT COUNT(*) FROM tag_aliases').fetchone()
+        return {
+            'available': True,
+            'wiki_pages': wiki_pages,
+            'other_names': other_names,
+            'tags': tags,
+            'tag_aliases': tag_aliases,
+            'wiki_updated_at': self._get_last_updated_at('wiki_pages'),
+            'tags_updated_at': self._get_last_updated_at('tags'),
+            'file_size': os.path.getsize(self.db_file),
+        }
+
+
+@lru_cache()
+def get_wiki_index() -> WikiIndex:
+    return WikiIndex(os.environ.get('MAID_WIKI_INDEX') or os.path.join(get_cache_dir(), 'wiki_index.sqlite'))
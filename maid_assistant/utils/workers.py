@@ -0,0 +1,73 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from functools import lru_cache
+from typing import Callable, Awaitable, Optional, Tuple
+
+from .env import get_int_env
+
+_DEFAULT_POOL_SIZES = {
+    'search': (4, 16),
+    'explain': (4, 16),
+    'calc': (2, 16),
+}
+
+
+class PoolBusyError(Exception):
+    def __init__(self, pool_name: str, pending: int):
+        Exception.__init__(self, f'Worker pool {pool_name!r} is full, {pending} task(s) pending.')
+        self.pool_name = pool_name
+        self.pending = pending
+
+
+class WorkerPool:
+    def __init__(self, name: str, max_workers: int, max_queue: int):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f'maid_{name}')
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    @property
+    def pending(self) -> int:
+        with self._lock:
+            return self._pending
+
+    def _on_done(self, _):
+        with self._lock:
+            self._pending -= 1
+
+    def submit(self, fn, *args, **kwargs) -> Tuple[int, Future]:
+        with self._lock:
+            if self._pending >= self.max_workers + self.max_queue:
+                raise PoolBusyError(self.name, self._pending)
+            self._pending += 1
+            position = max(self._pending - self.max_workers, 0)
+
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self._on_done(None)
+            raise
+        future.add_done_callback(self._on_done)
+        return position, future
+
+    async def run(self, fn, *args, on_queued: Optional[Callable[[int], Awaitable]] = None, **kwargs):
+        position, future = self.submit(fn, *args, **kwargs)
+        if position > 0:
+            logging.info(f'Task queued in worker pool {self.name!r}, position: #{position}.')
+            if on_queued is not None:
+                await on_queued(position)
+        return await asyncio.wrap_future(future)
+
+
+@lru_cache()
+def get_worker_pool(name: str) -> WorkerPool:
+    default_workers, default_queue = _DEFAULT_POOL_SIZES.get(name, (2, 8))
+    return WorkerPool(
+        name=name,
+        max_workers=get_int_env(f'MAID_{name.upper()}_WORKERS', default_workers),
+        max_queue=get_int_env(f'MAID_{name.upper()}_QUEUE', default_queue),
+    )
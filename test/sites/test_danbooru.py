@@ -0,0 +1,83 @@
+import os
+import time
+from contextlib import contextmanager
+from tempfile import TemporaryDirectory
+
+import pytest
+
+from maid_assistant.sites import danbooru
+from maid_assistant.sites.danbooru import query_danbooru_images, QueryStats, _plan_query
+
+
+class _Response:
+    def __init__(self, data):
+        self._data = data
+
+    def json(self):
+        return self._data
+
+
+class _Client:
+    def __init__(self, n_posts: int = 5000):
+        self.post_ids = list(range(n_posts, 0, -1))
+        self.pages = 0
+        self.requests = []
+
+    def get(self, url, params):
+        self.pages += 1
+        self.requests.append(params)
+        page, limit = params['page'], int(params['limit'])
+        ids = [id_ for id_ in self.post_ids if not page.startswith('b') or id_ < int(page[1:])]
+        if not page.startswith('b'):
+            ids = ids[(int(page) - 1) * limit:]
+        return _Response([{'id': id_, 'rating': 'g', 'parent_id': None} for id_ in ids[:limit]])
+
+
+class _Pool:
+    @contextmanager
+    def mock_resource(self, resource_id, resource_info, silent: bool = False):
+        time.sleep(0.01)
+        with TemporaryDirectory() as td:
+            with open(os.path.join(td, f'{resource_id}.webp'), 'wb') as f:
+                f.write(b'image')
+            yield td, resource_info
+
+
+@pytest.fixture()
+def client(monkeypatch):
+    client = _Client()
+    monkeypatch.setattr(danbooru, 'get_danbooru_client', lambda: client)
+    monkeypatch.setattr(danbooru, 'get_danbooru_base_url', lambda: 'https://danbooru.example')
+    monkeypatch.setattr(danbooru, 'get_data_pool', lambda site: _Pool())
+    monkeypatch.setattr(danbooru, '_current_maxid', lambda: None)
+    return client
+
+
+class TestSitesDanbooru:
+    @pytest.mark.parametrize('count', [1, 4, 10])
+    def test_query_pages_for_small_count(self, client, count):
+        stats = QueryStats()
+        images = query_danbooru_images(['1girl'], count=count, stats=stats, raw=True, dedup=False)
+        assert len(images) == count
+        # wait for the background pagination, which should be held back once enough images are taken
+        time.sleep(1.5)
+        assert client.pages <= 3
+        assert stats.pages == client.pages
+
+    def test_query_starts_from_max_id(self, client, monkeypatch):
+        monkeypatch.setattr(danbooru, '_current_maxid', lambda: 1000)
+        stats = QueryStats()
+        images = query_danbooru_images(['1girl'], count=4, stats=stats, raw=True, dedup=False)
+        assert len(images) == 4
+        assert all(id_ < 1000 for id_, _ in images)
+        assert client.requests[0]['page'] == 'b1000'
+        assert client.requests[0]['tags'] == '1girl parent:none'
+        assert stats.client_filters == []
+
+    def test_plan_query(self):
+        assert _plan_query(['1girl'], {'g', 's'}, max_id=1000, tag_limit=2) == \
+               (['1girl', 'rating:g,s'], True, False, False)
+        assert _plan_query(['1girl'], {'g', 's', 'q', 'e'}, max_id=1000, tag_limit=2) == \
+               (['1girl', 'parent:none'], False, False, True)
+        assert _plan_query(['1girl', 'order:score'], {'g', 's', 'q', 'e'}, max_id=1000, tag_limit=3) == \
+               (['1girl', 'order:score', 'id:<1000'], False, True, False)
@@ -0,0 +1,148 @@
+import os
+import time
+
+import pytest
+
+from maid_assistant.utils import cache
+from maid_assistant.utils.cache import TwoLevelCache
+
+
+class _Clock:
+    def __init__(self):
+        self.current_time = 1700000000.0
+
+    def __call__(self):
+        return self.current_time
+
+    def tick(self, seconds: float = 1.0):
+        self.current_time += seconds
+
+
+@pytest.fixture()
+def clock(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(cache.time, 'time', clock)
+    return clock
+
+
+@pytest.fixture()
+def db_file(tmp_path):
+    return os.path.join(tmp_path, 'cache.sqlite')
+
+
+class TestUtilsCache:
+    def test_memory_hit(self, db_file):
+        c = TwoLevelCache('test', db_file)
+        c.set('a', {'value': 1})
+        assert c.get('a') == {'value': 1}
+        assert c.get('b') is None
+        assert c.get('b', 'x') == 'x'
+        stats = c.stats()
+        assert (stats['hits'], stats['disk_hits'], stats['misses']) == (1, 0, 2)
+
+    def test_disk_promotion(self, db_file):
+        TwoLevelCache('test', db_file).set('a', [1, 2, 3])
+
+        c = TwoLevelCache('test', db_file)
+        assert c.stats()['memory_items'] == 0
+        assert c.get('a') == [1, 2, 3]
+        assert c.get('a') == [1, 2, 3]
+        stats = c.stats()
+        assert (stats['memory_items'], stats['disk_items']) == (1, 1)
+        assert (stats['hits'], stats['disk_hits'], stats['misses']) == (2, 1, 0)
+
+    def test_memory_lru(self, db_file):
+        c = TwoLevelCache('test', db_file, max_memory_items=2)
+        c.set('a', 1)
+        c.set('b', 2)
+        assert c.get('a') == 1
+        c.set('c', 3)
+        assert list(c._memory.keys()) == ['a', 'c']
+        assert c.get('b') == 2
+        assert c.stats()['disk_hits'] == 1
+
+    def test_namespaces(self, db_file):
+        c1 = TwoLevelCache('test1', db_file)
+        c2 = TwoLevelCache('test2', db_file)
+        c1.set('a', 1)
+        assert c2.get('a') is None
+        assert c2.stats()['disk_items'] == 0
+
+    def test_ttl(self, db_file, clock):
+        c = TwoLevelCache('test', db_file, ttl=60)
+        c.set('a', 1)
+        clock.tick(30)
+        assert c.get('a') == 1
+        assert TwoLevelCache('test', db_file, ttl=60).get('a') == 1
+
+        clock.tick(31)
+        assert c.get('a') is None
+        assert c.stats()['memory_items'] == 0
+        assert c.stats()['disk_items'] == 0
+        assert TwoLevelCache('test', db_file, ttl=60).get('a') is None
+
+    def test_ttl_evicted_on_set(self, db_file, clock):
+        c = TwoLevelCache('test', db_file, ttl=60)
+        c.set('a', 1)
+        clock.tick(61)
+        c.set('b', 2)
+        assert [key for key, _, _ in c.list_items()] == ['b']
+
+    def test_max_disk_items(self, db_file, clock):
+        c = TwoLevelCache('test', db_file, max_memory_items=1, max_disk_items=3)
+        for key in ['a', 'b', 'c']:
+            c.set(key, key)
+            clock.tick()
+        assert c.get('a') == 'a'
+        clock.tick()
+        c.set('d', 'd')
+
+        assert c.stats()['disk_items'] == 3
+        assert sorted(key for key, _, _ in c.list_items()) == ['a', 'c', 'd']
+        assert c.get('b') is None
+
+    def test_get_or_create(self, db_file):
+        c = TwoLevelCache('test', db_file)
+        calls = []
+
+        def _create():
+            calls.append(1)
+            return None
+
+        assert c.get_or_create('a', _create) is None
+        assert c.get_or_create('a', _create) is None
+        assert len(calls) == 1
+
+    def test_purge_prefix(self, db_file):
+        c = TwoLevelCache('test', db_file)
+        c.set('title|a', 1)
+        c.set('title|b', 2)
+        c.set('id|1', 3)
+        assert c.purge('title|') == 2
+        assert c.get('title|a') is None
+        assert c.get('id|1') == 3
+        assert c.purge() == 1
+        assert c.stats()['disk_items'] == 0
+
+    def test_purge_in_other_instance(self, db_file):
+        c1 = TwoLevelCache('test', db_file, generation_check_interval=0)
+        c2 = TwoLevelCache('test', db_file, generation_check_interval=0)
+        c1.set('a', 1)
+        assert c2.get('a') == 1
+        assert c2.stats()['memory_items'] == 1
+
+        assert c1.purge() == 1
+        assert c2.get('a') is None
+        assert c2.stats()['memory_items'] == 0
+
+    def test_purge_seen_after_interval(self, db_file):
+        c1 = TwoLevelCache('test', db_file)
+        c2 = TwoLevelCache('test', db_file, generation_check_interval=0.2)
+        c1.set('a', 1)
+        assert c2.get('a') == 1
+
+        c1.purge()
+        # memory items of the other instance are kept until the next check
+        assert c2.get('a') == 1
+        time.sleep(0.3)
+        assert c2.get('a') is None
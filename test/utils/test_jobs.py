@@ -0,0 +1,142 @@
+import os
+import threading
+import time
+
+import pytest
+
+from maid_assistant.utils.jobs import JobQueue, JobQuotaError, JobCancelledError, JobContext, JOB_QUEUED, \
+    JOB_RUNNING, JOB_DONE, JOB_FAILED, JOB_CANCELLED
+
+
+def _create_queue(tmp_path, **kwargs) -> JobQueue:
+    queue = JobQueue('test', os.path.join(tmp_path, 'jobs.sqlite'), os.path.join(tmp_path, 'jobs'), **kwargs)
+    queue.register('echo', lambda ctx: ctx.payload)
+    return queue
+
+
+def _wait_for(fn, timeout: float = 10.0):
+    start_time = time.time()
+    while not fn():
+        assert time.time() - start_time < timeout, 'Timeout.'
+        time.sleep(0.02)
+
+
+class TestUtilsJobs:
+    def test_submit(self, tmp_path):
+        queue = _create_queue(tmp_path)
+        job_id = queue.submit('echo', {'x': 1}, user_id=1, guild_id=10, meta={'channel_id': 100})
+        job = queue.get(job_id)
+        assert job['status'] == JOB_QUEUED
+        assert job['payload'] == {'x': 1}
+        assert job['meta'] == {'channel_id': 100}
+        assert queue.position(job_id) == 1
+        assert queue.get(job_id + 1) is None
+
+        with pytest.raises(KeyError):
+            queue.submit('unknown', {})
+
+    def test_pending_quota(self, tmp_path):
+        queue = _create_queue(tmp_path, max_pending_per_user=2)
+        queue.submit('echo', {}, user_id=1)
+        queue.submit('echo', {}, user_id=1)
+        with pytest.raises(JobQuotaError):
+            queue.submit('echo', {}, user_id=1)
+        queue.submit('echo', {}, user_id=2)
+        queue.submit('echo', {})
+
+    def test_claim_quotas(self, tmp_path):
+        queue = _create_queue(tmp_path, max_running_per_user=1, max_running_per_guild=2)
+        id_u1_1 = queue.submit('echo', {}, user_id=1, guild_id=10)
+        id_u1_2 = queue.submit('echo', {}, user_id=1, guild_id=10)
+        id_u2 = queue.submit('echo', {}, user_id=2, guild_id=10)
+        id_u3 = queue.submit('echo', {}, user_id=3, guild_id=10)
+        id_u4 = queue.submit('echo', {}, user_id=4, guild_id=20)
+
+        # jobs over quota are skipped, not blocking the ones behind them
+        assert [queue._claim()['id'] for _ in range(3)] == [id_u1_1, id_u2, id_u4]
+        assert queue._claim() is None
+        assert queue.get(id_u1_2)['status'] == JOB_QUEUED
+        assert queue.get(id_u3)['status'] == JOB_QUEUED
+        assert queue.position(id_u3) == 2
+
+        queue._finish(id_u1_1, JOB_DONE)
+        assert queue._claim()['id'] == id_u1_2
+        assert queue._claim() is None
+
+    def test_stale_requeue(self, tmp_path):
+        queue = _create_queue(tmp_path, stale_timeout=30.0)
+        job_id = queue.submit('echo', {})
+        assert queue._claim()['id'] == job_id
+        with queue._condition:
+            queue._requeue_stale()
+        assert queue.get(job_id)['status'] == JOB_RUNNING
+
+        # another process takes it over after the owner stopped heartbeating
+        queue._conn.execute('UPDATE jobs SET heartbeat_at = ? WHERE id = ?', (time.time() - 60, job_id))
+        other = _create_queue(tmp_path)
+        with other._condition:
+            other._requeue_stale()
+        job = other.get(job_id)
+        assert (job['status'], job['owner']) == (JOB_QUEUED, None)
+        assert other._claim()['id'] == job_id
+
+        # result of the old owner is dropped
+        queue._finish(job_id, JOB_DONE, result={'x': 1})
+        assert other.get(job_id)['status'] == JOB_RUNNING
+        other._finish(job_id, JOB_DONE, result={'x': 2})
+        assert other.get(job_id)['result'] == {'x': 2}
+
+    def test_cancel(self, tmp_path):
+        queue = _create_queue(tmp_path)
+        id_queued = queue.submit('echo', {}, user_id=1)
+        assert queue.cancel(id_queued)
+        assert queue.get(id_queued)['status'] == JOB_CANCELLED
+        assert not queue.cancel(id_queued)
+        assert not queue.is_cancel_requested(id_queued)
+
+        id_running = queue.submit('echo', {}, user_id=1)
+        assert queue._claim()['id'] == id_running
+        ctx = JobContext(queue, id_running, {}, queue.get_output_dir(id_running))
+        ctx.report(done=1)
+        assert queue.cancel(id_running)
+        assert queue.get(id_running)['status'] == JOB_RUNNING
+        with pytest.raises(JobCancelledError):
+            ctx.report(done=2)
+        assert queue.get(id_running)['progress'] == {'done': 2}
+
+    def test_workers(self, tmp_path):
+        queue = _create_queue(tmp_path, max_workers=2, poll_interval=0.1)
+        started = threading.Event()
+
+        def _slow(ctx: JobContext):
+            started.set()
+            while True:
+                ctx.report(state='running')
+                time.sleep(0.02)
+
+        def _fail(ctx: JobContext):
+            raise ValueError('failed')
+
+        queue.register('slow', _slow)
+        queue.register('fail', _fail)
+        queue.start()
+
+        id_done = queue.submit('echo', {'x': 1}, user_id=1)
+        id_failed = queue.submit('fail', {}, user_id=2)
+        id_slow = queue.submit('slow', {}, user_id=3)
+        _wait_for(lambda: queue.get(id_done)['status'] == JOB_DONE)
+        _wait_for(lambda: queue.get(id_failed)['status'] == JOB_FAILED)
+        assert queue.get(id_done)['result'] == {'x': 1}
+        assert 'failed' in queue.get(id_failed)['error']
+
+        started.wait(timeout=10.0)
+        assert queue.cancel(id_slow)
+        _wait_for(lambda: queue.get(id_slow)['status'] == JOB_CANCELLED)
+        assert not os.path.exists(queue.get_output_dir(id_slow))
+
+        assert [job['id'] for job in queue.list_jobs(statuses=[JOB_DONE, JOB_FAILED], undelivered=True)] == \
+               [id_failed, id_done]
+        queue.mark_delivered(id_done)
+        assert not os.path.exists(queue.get_output_dir(id_done))
+        assert [job['id'] for job in queue.list_jobs(undelivered=True)] == [id_slow, id_failed]
+        assert queue.stats() == {JOB_QUEUED: 0, JOB_RUNNING: 0, JOB_DONE: 1, JOB_FAILED: 1, JOB_CANCELLED: 1}
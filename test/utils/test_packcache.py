@@ -0,0 +1,140 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from maid_assistant.utils import packcache
+from maid_assistant.utils.packcache import PackCache, make_pack_key
+
+
+class _Clock:
+    def __init__(self):
+        self.current_time = 1700000000.0
+
+    def __call__(self):
+        return self.current_time
+
+    def tick(self, seconds: float = 1.0):
+        self.current_time += seconds
+
+
+@pytest.fixture()
+def clock(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(packcache.time, 'time', clock)
+    return clock
+
+
+def _create_pack_cache(tmp_path, **kwargs) -> PackCache:
+    return PackCache(os.path.join(tmp_path, 'packs'), os.path.join(tmp_path, 'cache.sqlite'), **kwargs)
+
+
+def _make_file(directory: str, name: str, size: int) -> str:
+    filename = os.path.join(directory, name)
+    with open(filename, 'wb') as f:
+        f.write(b'x' * size)
+    return filename
+
+
+class TestUtilsPackcache:
+    def test_make_pack_key(self):
+        key = make_pack_key('danbooru', ['surtr_(arknights)', 'solo'], ['general'], 100, 10, 1024)
+        assert key == make_pack_key('danbooru', [' Solo', 'surtr_(arknights)'], ['general'], 100, 10, 1024)
+        assert key != make_pack_key('danbooru', ['surtr_(arknights)', 'solo'], ['general'], 101, 10, 1024)
+        assert key != make_pack_key('gelbooru', ['surtr_(arknights)', 'solo'], ['general'], 100, 10, 1024)
+
+    def test_put_and_get(self, tmp_path):
+        c = _create_pack_cache(tmp_path)
+        assert c.get('a') is None
+        file = c.put('a', _make_file(tmp_path, 'a.zip', 100), {'count': 1})
+        assert os.path.exists(file)
+        assert c.get('a') == (file, {'count': 1})
+        assert _create_pack_cache(tmp_path).get('a') == (file, {'count': 1})
+
+        os.remove(file)
+        assert c.get('a') is None
+        assert c.stats()['items'] == 0
+
+    def test_ttl(self, tmp_path, clock):
+        c = _create_pack_cache(tmp_path, ttl=60)
+        file = c.put('a', _make_file(tmp_path, 'a.zip', 100), {})
+        clock.tick(30)
+        assert c.get('a') is not None
+        clock.tick(31)
+        assert c.get('a') is None
+        assert not os.path.exists(file)
+
+        c.put('b', _make_file(tmp_path, 'b.zip', 100), {})
+        clock.tick(61)
+        c.put('c', _make_file(tmp_path, 'c.zip', 100), {})
+        assert c.stats()['items'] == 1
+
+    def test_lru(self, tmp_path, clock):
+        c = _create_pack_cache(tmp_path, max_size=300)
+        for key in ['a', 'b', 'c']:
+            c.put(key, _make_file(tmp_path, f'{key}.zip', 100), {})
+            clock.tick()
+        assert c.get('a') is not None
+        clock.tick()
+        c.put('d', _make_file(tmp_path, 'd.zip', 100), {})
+
+        assert c.get('b') is None
+        assert all(c.get(key) is not None for key in ['a', 'c', 'd'])
+        assert c.stats()['disk_size'] == 300
+
+        # the new pack is kept even if it is larger than the whole cache
+        c.put('e', _make_file(tmp_path, 'e.zip', 500), {})
+        assert c.get('e') is not None
+        assert c.stats()['items'] == 1
+
+    def test_get_or_create(self, tmp_path):
+        c = _create_pack_cache(tmp_path)
+        builds = []
+        lock = threading.Lock()
+
+        def _build(td: str):
+            with lock:
+                builds.append(td)
+            time.sleep(0.2)
+            return _make_file(td, 'pack.zip', 100), {'count': 100}
+
+        with ThreadPoolExecutor(max_workers=4) as tp:
+            results = list(tp.map(lambda key: c.get_or_create(key, _build), ['a', 'a', 'a', 'b']))
+        assert len(builds) == 2
+        assert results[0] == results[1] == results[2]
+        assert results[0][1] == {'count': 100}
+        assert results[0][0] != results[3][0]
+        assert c._key_locks == {}
+        assert c.stats()['hits'] == 2
+
+    def test_get_or_create_failed(self, tmp_path):
+        c = _create_pack_cache(tmp_path)
+
+        def _build(td: str):
+            raise ValueError('failed')
+
+        with pytest.raises(ValueError):
+            c.get_or_create('a', _build)
+        assert c._key_locks == {}
+        assert c.get_or_create('a', lambda td: (_make_file(td, 'pack.zip', 10), {}))[1] == {}
+
+    def test_remove_orphans(self, tmp_path):
+        c = _create_pack_cache(tmp_path)
+        c.put('a', _make_file(tmp_path, 'a.zip', 100), {})
+        os.makedirs(os.path.join(c.directory, 'orphan'))
+        os.makedirs(os.path.join(c.directory, 'moving'))
+        old_time = time.time() - 2 * 3600
+        os.utime(os.path.join(c.directory, 'orphan'), (old_time, old_time))
+
+        _create_pack_cache(tmp_path)
+        assert sorted(name for name in os.listdir(c.directory) if not name.startswith('.')) == ['a', 'moving']
+
+    def test_purge(self, tmp_path):
+        c = _create_pack_cache(tmp_path)
+        c.put('a', _make_file(tmp_path, 'a.zip', 100), {})
+        c.put('b', _make_file(tmp_path, 'b.zip', 100), {})
+        assert c.purge() == 2
+        assert c.stats()['items'] == 0
+        assert sorted(name for name in os.listdir(c.directory) if not name.startswith('.')) == []
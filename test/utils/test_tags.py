@@ -0,0 +1,75 @@
+import os
+
+import pytest
+
+from maid_assistant.utils import tags as tags_module
+from maid_assistant.utils.tags import TagResolver
+from maid_assistant.utils.wiki import WikiIndex
+
+
+@pytest.fixture()
+def resolver():
+    return TagResolver([
+        ('surtr_(arknights)', 'surtr_(arknights)', 1000),
+        ('1girl', '1girl', 100000),
+        ('solo', 'solo', 50000),
+        ('long_hair', 'long_hair', 90000),
+        ('long_hairs', 'long_hair', 90000),
+        ('スルト', 'surtr_(arknights)', 1000),
+    ], fn_lookup=lambda names: {name: 1 for name in names if name == 'rare_tag'})
+
+
+class TestUtilsTags:
+    def test_resolve_exact(self, resolver):
+        assert resolver.resolve('long_hair') == 'long_hair'
+        assert resolver.resolve('Long Hair') == 'long_hair'
+        assert resolver.resolve('long_hairs') == 'long_hair'
+        assert resolver.resolve('スルト') == 'surtr_(arknights)'
+        assert resolver.resolve('surtr_arknights') == 'surtr_(arknights)'
+        assert resolver.resolve('rare_tag') == 'rare_tag'
+
+    def test_resolve_fuzzy_threshold(self, resolver):
+        # 1 edit in 15 characters, similar enough to be corrected
+        assert resolver.resolve('surtr_(arknigts)') == 'surtr_(arknights)'
+        # 2 edits in 8 characters, only suggested
+        assert resolver.resolve('lnog_hair') is None
+        assert resolver.suggest('lnog_hair') == [('long_hair', 90000)]
+        assert resolver.resolve('surtr_(arknigts)', fuzzy=False) is None
+        assert resolver.resolve('xyzzy') is None
+
+    def test_resolve_fuzzy_custom_threshold(self):
+        resolver = TagResolver([('long_hair', 'long_hair', 90000)], min_similarity=0.7)
+        assert resolver.resolve('lnog_hair') == 'long_hair'
+        resolver = TagResolver([('surtr_(arknights)', 'surtr_(arknights)', 1000)], min_similarity=1.0)
+        assert resolver.resolve('surtr_(arknigts)') is None
+
+    def test_resolve_query(self, resolver):
+        tags, corrections, unknown = resolver.resolve_query(
+            ['surtr_(arknigts)', '-long_hairs', 'lnog_hair', 'xyzzy', 'rating:g', 'long_*', 'solo'])
+        assert tags == ['surtr_(arknights)', '-long_hair', 'lnog_hair', 'xyzzy', 'rating:g', 'long_*', 'solo']
+        assert corrections == {'surtr_(arknigts)': 'surtr_(arknights)', '-long_hairs': '-long_hair'}
+        assert unknown == {'lnog_hair': ['long_hair'], 'xyzzy': []}
+
+    def test_resolve_query_not_fuzzy(self, resolver):
+        tags, corrections, unknown = resolver.resolve_query(['surtr_(arknigts)', 'long_hairs'], fuzzy=False)
+        assert tags == ['surtr_(arknigts)', 'long_hair']
+        assert corrections == {'long_hairs': 'long_hair'}
+        assert unknown == {'surtr_(arknigts)': ['surtr_(arknights)']}
+
+    def test_get_tag_resolver_rebuilt_after_update(self, tmp_path, monkeypatch):
+        wiki_index = WikiIndex(os.path.join(tmp_path, 'wiki_index.sqlite'))
+        monkeypatch.setattr(tags_module, 'get_wiki_index', lambda: wiki_index)
+        tags_module._load_tag_resolver.cache_clear()
+        try:
+            wiki_index._apply([{'name': 'solo', 'post_count': 50000}])
+            resolver = tags_module.get_tag_resolver()
+            assert resolver.resolve('solo') == 'solo'
+            assert resolver.resolve('new_tag', fuzzy=False) is None
+            assert tags_module.get_tag_resolver() is resolver
+
+            wiki_index._apply([{'name': 'new_tag', 'post_count': 100}])
+            new_resolver = tags_module.get_tag_resolver()
+            assert new_resolver is not resolver
+            assert new_resolver.resolve('new_tag', fuzzy=False) == 'new_tag'
+        finally:
+            tags_module._load_tag_resolver.cache_clear()
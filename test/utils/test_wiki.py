@@ -0,0 +1,75 @@
+import os
+
+import pytest
+
+from maid_assistant.utils import wiki
+from maid_assistant.utils.wiki import WikiIndex
+
+
+class _Response:
+    def __init__(self, data):
+        self._data = data
+
+    def json(self):
+        return self._data
+
+
+class _WikiClient:
+    def __init__(self, n_pages: int):
+        self.pages = {
+            i: {'id': i, 'title': f'tag_{i}', 'body': f'body {i}', 'other_names': [],
+                'updated_at': f'2024-01-01T00:00:{i % 60:02d}.000+00:00'}
+            for i in range(1, n_pages + 1)
+        }
+        self.requests = []
+
+    def get(self, url, params):
+        self.requests.append(params)
+        if not url.endswith('/wiki_pages.json'):
+            return _Response([])
+        page, limit = params['page'], int(params['limit'])
+        assert page.startswith('a')
+        since = params.get('search[updated_at]', '>=')[2:]
+        records = sorted((record for id_, record in self.pages.items()
+                          if id_ > int(page[1:]) and record['updated_at'] >= since), key=lambda x: x['id'])
+        # newest first in the page, like danbooru does
+        return _Response(records[:limit][::-1])
+
+
+@pytest.fixture()
+def client(monkeypatch):
+    client = _WikiClient(1000)
+    monkeypatch.setattr(wiki, 'get_danbooru_client', lambda: client)
+    monkeypatch.setattr(wiki, 'get_danbooru_base_url', lambda: 'https://danbooru.example')
+    return client
+
+
+@pytest.fixture()
+def wiki_index(tmp_path):
+    return WikiIndex(os.path.join(tmp_path, 'wiki_index.sqlite'))
+
+
+class TestUtilsWiki:
+    def test_update_backlog_larger_than_page_limit(self, client, wiki_index):
+        assert wiki_index.update_from_danbooru(max_pages=2, with_tags=False) == {'wiki_pages': 400}
+        assert wiki_index.stats()['wiki_pages'] == 400
+        assert wiki_index.stats()['wiki_updated_at'] is None
+        assert wiki_index.get_wiki('tag_1')['body'] == 'body 1'
+
+        # continued from where the last run stopped
+        assert wiki_index.update_from_danbooru(max_pages=2, with_tags=False) == {'wiki_pages': 400}
+        assert wiki_index.update_from_danbooru(max_pages=2, with_tags=False) == {'wiki_pages': 200}
+        assert wiki_index.stats()['wiki_pages'] == 1000
+        assert wiki_index.stats()['wiki_updated_at'] is not None
+        assert client.requests[-1]['page'] == 'a1000'
+
+    def test_update_after_caught_up(self, client, wiki_index):
+        wiki_index.update_from_danbooru(max_pages=10, with_tags=False)
+        assert wiki_index.stats()['wiki_pages'] == 1000
+
+        client.pages[3] = {**client.pages[3], 'body': 'new body', 'updated_at': '2999-01-01T00:00:00.000+00:00'}
+        client.requests.clear()
+        assert wiki_index.update_from_danbooru(max_pages=10, with_tags=False) == {'wiki_pages': 1}
+        assert client.requests[0]['page'] == 'a0'
+        assert client.requests[0]['search[updated_at]'].startswith('>=')
+        assert wiki_index.get_wiki('tag_3')['body'] == 'new body'